@@ -0,0 +1,85 @@
+from __future__ import division
+
+import csv
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+from brainsearch import knn
+
+# Columns of the CSV results, in order.
+FIELDS = ['hashing', 'nbits', 'tables', 'probes',
+          'build_time', 'index_bytes', 'nb_buckets',
+          'candidates_per_query', 'buckets_per_query', 'queries_per_sec', 'recall']
+
+
+def configurations(hashtypes, nbits, tables=(1,), probes=(0,)):
+    """ Every hashing configuration of the sweep.
+
+    Several tables are only tried with LSH: PCA and SH are deterministic,
+    their tables would all be identical.
+    """
+    for hashtype in hashtypes:
+        for nb_bits in nbits:
+            for nb_tables in (tables if hashtype.upper() == "LSH" else [1]):
+                for nb_probes in probes:
+                    yield {'hashing': hashtype.upper(), 'nbits': nb_bits, 'tables': nb_tables, 'probes': nb_probes}
+
+
+def builds(configurations):
+    """ Configurations grouped by the brain database they query, i.e. only differing by their probes. """
+    groups = OrderedDict()
+    for config in configurations:
+        groups.setdefault((config['hashing'], config['nbits'], config['tables']), []).append(config)
+
+    return groups.values()
+
+
+def sample_queries(brains_patches, nb_queries, rng=None, spatial_weight=0.):
+    """ Uniform sample of `nb_queries` patches among the patches of every brain.
+
+    Returns
+    -------
+    queries : dict
+        Maps 'patches', 'vectors', 'positions' and 'ids' to the values of the sampled patches.
+    """
+    rng = rng if rng is not None else np.random.RandomState()
+    offsets = np.r_[0, np.cumsum([len(brain_patches) for brain_patches in brains_patches])]
+    rows = np.sort(rng.choice(offsets[-1], size=min(nb_queries, offsets[-1]), replace=False))
+
+    queries = {'patches': [], 'vectors': [], 'positions': [], 'ids': []}
+    for i, brain_patches in enumerate(brains_patches):
+        indices = rows[(rows >= offsets[i]) & (rows < offsets[i+1])] - offsets[i]
+        queries['patches'].append(brain_patches.patches[indices])
+        queries['vectors'].append(brain_patches.create_vectors(spatial_weight)[indices])
+        queries['positions'].append(brain_patches.positions[indices])
+        queries['ids'].append(brain_patches.brain_ids[indices])
+
+    return dict((name, np.concatenate(values)) for name, values in queries.items())
+
+
+def exact_uids(queries, brains_patches, k, nb_threads=1):
+    """ Unique identifiers (see `knn.patch_uids`) of the exact kNN of every query. """
+    exact = knn.ExactKNN(queries['patches'], k, nb_threads=nb_threads)
+    for brain_patches in brains_patches:
+        exact.update(brain_patches.patches, ids=brain_patches.brain_ids, positions=brain_patches.positions.astype(np.int32))
+
+    return knn.patch_uids(exact.attributes['ids'], exact.attributes['positions'])
+
+
+def recall(neighbors, true_uids):
+    """ Mean recall@K of dense neighbors (see `QueryPlanner.execute`) against the exact ones. """
+    found_uids = knn.patch_uids(neighbors['id'], neighbors['position'])
+    return float(np.mean(knn.recall_at_k(found_uids, true_uids)))
+
+
+def write_results(results, prefix):
+    """ Writes benchmark results in '{prefix}.json' and '{prefix}.csv'. """
+    with open(prefix + ".json", 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    with open(prefix + ".csv", 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
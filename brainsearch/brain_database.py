@@ -1,20 +1,59 @@
+import os
+import zlib
+import json
 import pickle
 
 import numpy as np
 from nearpy import Engine
-from nearpy.storage import storage_factory
+from nearpy.hashes import LocalitySensitiveHashing
 
-from nearpy.filters import NearestFilter
+from nearpy.filters import NearestFilter, DistanceThresholdFilter
 from nearpy.data import NumpyData
 
+from itertools import chain
 from collections import defaultdict
+from multiprocessing import Pool
+
+from brainsearch import knn
+from brainsearch.brain_data import BrainPatches
+from brainsearch.codes import SignCodes
+from brainsearch.training import fingerprint
+from brainsearch.query import QueryPlanner, iter_neighbors, table_bucketkeys
+from brainsearch.stats import BucketStats, BucketBrains, merge_summaries, write_details, read_details, remove_details
+from brainsearch.storage import storage_factory, PipelinedRedisStorage, HashTableStorage
+from brainsearch.storage import MmapStorage, ReadOnlyInfoStorage, write_snapshot, read_snapshot_header, remove_snapshot
 
 
 class BrainDatabase(object):
-    def __init__(self, name, storage, engine):
+    # Number of extra bits used every time an oversized bucket is split.
+    SPLIT_NBITS = 4
+    # Oversized buckets are not split more than this number of times.
+    MAX_SPLIT_DEPTH = 8
+    # Attributes of the patches sampled in large buckets (see `BucketStats`).
+    SAMPLED_ATTRIBUTES = ['patch', 'position']
+
+    def __init__(self, name, storage, engine=None, engine_factory=None, details_path=None):
         self.name = name
         self.storage = storage
-        self.engine = engine
+        self._engine = engine
+        self._engine_factory = engine_factory
+        self._stats = None
+        self._bucket_brains = None
+        self._brains = None
+        # File of the bucket sizes, samples and brains, too large to be saved in the catalog after every write.
+        self.details_path = details_path
+        self._details = None
+
+        info = self.storage.get_info(self.name)
+        self.max_bucket_size = int(info.get("max_bucket_size") or 0)
+        self._split_hashes = pickle.loads(info["split_hashing_config"]) if info.get("split_hashing_config") else []
+        # Binary codes stored along every patch (None if the database has none).
+        self.coder = pickle.loads(info["codes_config"]) if info.get("codes_config") else None
+        self.rerank = int(info.get("rerank") or 0)
+
+        # Split buckets and their depth (-1 if its patches cannot be told apart).
+        splits = self.storage.get_info(self.name + "_splits") or {}
+        self._splits = dict((key, int(depth)) for key, depth in splits.items())
 
         #Initialize metadata
         metadata = defaultdict(lambda: {})
@@ -32,10 +71,271 @@ class BrainDatabase(object):
         for key, value in metadata.items():
             self._metadata[key] = NumpyData(key, value['dtype'], tuple(value['shape']))
 
+    @property
+    def engine(self):
+        # Unpickling hash functions and connecting to the storage is deferred until needed.
+        if self._engine is None:
+            self._engine = self._engine_factory()
+
+        return self._engine
+
     @property
     def metadata(self):
         return self._metadata
 
+    @property
+    def stats(self):
+        """ Bucket sizes statistics, None if the database predates them or they are outdated. """
+        if self._stats is None:
+            summary = self.storage.get_info(self.name + "_stats")
+            if not summary:
+                return None
+
+            details = self._read_details(summary)
+            if details is None:
+                return None
+
+            self._stats = BucketStats(summary, sizes=details['sizes'], samples=details['samples'])
+
+        return self._stats
+
+    def _read_details(self, summary):
+        """ Details saved along `summary` by `save_stats`, None if missing or outdated. """
+        if self._details is None:
+            details = None
+            if self.details_path is not None:
+                details = read_details(self.details_path, summary.get('generation', 0))
+
+            if details is None:
+                print "Bucket statistics of '{}' are outdated, they are no longer maintained.".format(self.name)
+
+            self._details = details or {}
+
+        return self._details or None
+
+    @property
+    def bucket_brains(self):
+        """ Patches of every brain in every bucket, None if the database predates them or they are outdated. """
+        if self._bucket_brains is None:
+            summary = self.storage.get_info(self.name + "_stats")
+            if not summary:
+                return None
+
+            details = self._read_details(summary)
+            if details is None or 'bucket_brains' not in details:
+                return None
+
+            self._bucket_brains = details['bucket_brains']
+
+        return self._bucket_brains
+
+    @property
+    def brains(self):
+        """ Buckets every brain has patches in, None if the database predates them or they are outdated. """
+        if self._brains is None:
+            summary = self.storage.get_info(self.name + "_stats")
+            if not summary:
+                return None
+
+            details = self._read_details(summary)
+            if details is None:
+                return None
+
+            if 'brains' in details:
+                self._brains = details['brains']
+            else:
+                # Kept in the catalog before being saved along the details.
+                self._brains = self.storage.get_info(self.name + "_brains") or {}
+
+        return self._brains
+
+    def bucket_votes(self, vectors, patches, exclude_ids=()):
+        """ Label counts of the buckets every query falls in (one vote per table).
+
+        Only the per-bucket summaries are used: no patch is retrieved and no
+        distance is computed.
+
+        Returns
+        -------
+        votes : 2D array (nb_queries, nb_labels)
+        """
+        if self.bucket_brains is None:
+            raise ValueError("No per-bucket summaries maintained for brain database: " + self.name)
+
+        votes = np.zeros((len(vectors), 2), dtype=np.int64)
+        for bucketkeys in self.hashkeys(vectors, patches):
+            votes += self.bucket_brains.label_counts(bucketkeys, exclude_ids)
+
+        return votes
+
+    def bucket_stats_summary(self):
+        """ Summary of bucket sizes (see `BucketStats.summary`), without loading every size. """
+        summary = self.storage.get_info(self.name + "_stats")
+        if not summary or summary.get('generation', 0) != self.generation:
+            return None  # Buckets were written without maintaining it.
+
+        return summary
+
+    def bucket_samples(self):
+        """ Reservoir samples of the patches of large buckets. """
+        return self.stats.samples if self.stats is not None else {}
+
+    def _fetch_samples(self, bucketkey):
+        return dict((name, self.engine.storage.retrieve([bucketkey], attribute=self.metadata[name])[0])
+                    for name in self.SAMPLED_ATTRIBUTES)
+
+    def _save_summary(self):
+        if self._stats is None:
+            return
+
+        summary = self._stats.summary()
+        summary['generation'] = self.generation
+        self.storage.set_info(self.name + "_stats", summary)
+
+    def save_stats(self):
+        """ Saves bucket sizes, samples and brains, once a batch of writes (e.g. `add`) is done.
+
+        Until then, only the summary of bucket sizes is saved after every write.
+        """
+        if self.stats is None:
+            return
+
+        details = {'sizes': self.stats.sizes, 'samples': self.stats.samples}
+        if self.bucket_brains is not None:
+            details['bucket_brains'] = self.bucket_brains
+
+        if self.brains is not None:
+            details['brains'] = self.brains
+
+        self._save_summary()
+        write_details(self.details_path, self.generation, **details)
+
+    @property
+    def lshashes(self):
+        return self.engine.lshashes
+
+    @property
+    def nb_tables(self):
+        return len(self.engine.lshashes)
+
+    def hashkeys(self, vectors, patches=None):
+        """ Bucket keys of `vectors` in every hash table (one list per table).
+
+        If some buckets were split, `patches` are needed to find in which
+        sub-bucket every vector goes.
+        """
+        lshashes = self.engine.lshashes
+        hashkeys = table_bucketkeys(lshashes, [lhash.hash_vector(vectors) for lhash in lshashes])
+        if len(self._splits) > 0:
+            hashkeys = [self.resolve(keys, patches) for keys in hashkeys]
+
+        return hashkeys
+
+    def resolve(self, bucketkeys, patches):
+        """ Follows split buckets down to the sub-buckets `patches` fall in. """
+        bucketkeys = list(bucketkeys)
+        if len(self._splits) == 0:
+            return bucketkeys
+
+        patches = patches.reshape((len(patches), -1))
+        pending = [i for i, key in enumerate(bucketkeys) if self._splits.get(key, -1) >= 0]
+        while len(pending) > 0:
+            by_depth = defaultdict(list)
+            for i in pending:
+                by_depth[self._splits[bucketkeys[i]]].append(i)
+
+            for depth, indices in by_depth.items():
+                subkeys = self._split_hash(depth).hash_vector(patches[indices])
+                for i, subkey in zip(indices, subkeys):
+                    bucketkeys[i] += "/" + subkey
+
+            pending = [i for i in pending if self._splits.get(bucketkeys[i], -1) >= 0]
+
+        return bucketkeys
+
+    def _split_hash(self, depth):
+        while len(self._split_hashes) <= depth:
+            lhash = LocalitySensitiveHashing("{}_split{}".format(self.name, len(self._split_hashes)),
+                                             nbits=self.SPLIT_NBITS,
+                                             dimension=int(np.prod(self.metadata['patch'].shape)))
+            self._split_hashes.append(lhash)
+            info = self.storage.get_info(self.name)
+            info["split_hashing_config"] = pickle.dumps(self._split_hashes)
+            self.storage.set_info(self.name, info)
+
+        return self._split_hashes[depth]
+
+    def split_buckets(self, bucketkeys, max_size=None):
+        """ Splits the buckets holding more than `max_size` patches.
+
+        The patches of an oversized bucket are re-hashed with extra bits and
+        moved to sub-buckets, which are themselves split if still too large.
+        Returns the number of buckets that were split.
+        """
+        max_size = max_size or self.max_bucket_size
+        bucketkeys = [key for key in set(bucketkeys) if key not in self._splits]
+        if max_size <= 0 or len(bucketkeys) == 0:
+            return 0
+
+        sizes = self._bucket_sizes(bucketkeys)
+        return sum(self._split_bucket(key, max_size) for key, size in zip(bucketkeys, sizes) if size > max_size)
+
+    def _bucket_sizes(self, bucketkeys):
+        """ Sizes of buckets, from the maintained stats or the storage, rather than reading the buckets. """
+        if self.stats is not None:
+            return [self.stats.sizes.get(key, 0) for key in bucketkeys]
+
+        if hasattr(self.engine.storage, "bucket_sizes"):
+            return self.engine.storage.bucket_sizes(bucketkeys)
+
+        return map(len, self.engine.storage.retrieve(bucketkeys, attribute=self.metadata['id']))
+
+    def _split_bucket(self, bucketkey, max_size):
+        depth = bucketkey.count("/")
+        if depth >= self.MAX_SPLIT_DEPTH:
+            return self._unsplittable(bucketkey)
+
+        data = {}
+        for attribute in self.metadata.values():
+            data[attribute] = self.engine.storage.retrieve([bucketkey], attribute=attribute)[0]
+
+        patches = data[self.metadata['patch']]
+        subkeys = self._split_hash(depth).hash_vector(patches.reshape((len(patches), -1)))
+        if len(set(subkeys)) == 1:
+            # Splitting would not help (e.g. bucket full of identical patches).
+            return self._unsplittable(bucketkey)
+
+        subkeys = [bucketkey + "/" + subkey for subkey in subkeys]
+        self.engine.storage.clear([bucketkey])
+        self.engine.storage.store(subkeys, data)
+        self._splits[bucketkey] = depth
+        self.storage.set_info(self.name + "_splits", self._splits)
+        self.bump_generation()  # Bucket keys changed, not the number of patches.
+
+        if self.stats is not None:
+            self.stats.set_size(bucketkey, 0)
+            self.stats.add_batch(subkeys, dict((name, data[self.metadata[name]]) for name in self.SAMPLED_ATTRIBUTES),
+                                 self._fetch_samples)
+
+        if self.bucket_brains is not None:
+            self.bucket_brains.remove(bucketkey)
+            self.bucket_brains.add_batch(subkeys, data[self.metadata['id']], data[self.metadata['label']])
+
+        return 1 + self.split_buckets(subkeys, max_size)
+
+    def _unsplittable(self, bucketkey):
+        self._splits[bucketkey] = -1
+        self.storage.set_info(self.name + "_splits", self._splits)
+        return 0
+
+    def rebalance(self, max_size=None):
+        """ Splits every bucket holding more than `max_size` patches. """
+        sizes, bucketkeys = self.buckets_size()
+        max_size = max_size or self.max_bucket_size
+        nb_splits = self.split_buckets([key for key, size in zip(bucketkeys, sizes) if size > max_size], max_size)
+        self.save_stats()
+        return nb_splits
+
     def nb_patches(self, check_integrity=False):
         nb_patches = self.storage.get_info(self.name)["nb_patches"]
         nb_patches = int(nb_patches) if nb_patches is not None else 0
@@ -49,8 +349,12 @@ class BrainDatabase(object):
         return nb_patches
 
     def nb_buckets(self, check_integrity=False):
-        nb_buckets = self.storage.get_info(self.name)["nb_buckets"]
-        nb_buckets = int(nb_buckets) if nb_buckets is not None else 0
+        summary = self.bucket_stats_summary()
+        if summary is not None:
+            nb_buckets = summary['nb_buckets']
+        else:
+            nb_buckets = self.storage.get_info(self.name)["nb_buckets"]
+            nb_buckets = int(nb_buckets) if nb_buckets is not None else 0
 
         if check_integrity:
             true_nb_buckets = self.engine.nb_buckets()
@@ -139,12 +443,130 @@ class BrainDatabase(object):
         data[self.metadata['position']] = brain_patches.positions
         data[self.metadata['label']] = brain_patches.labels
         data[self.metadata['id']] = brain_patches.brain_ids
+        if self.coder is not None:
+            data[self.metadata['code']] = self.coder.encode(brain_patches.patches)
+
+        if (len(self._splits) > 0 or self.nb_tables > 1 or
+                isinstance(self.engine.storage, (PipelinedRedisStorage, HashTableStorage))):
+            # Nearpy's engine knows neither about split buckets, tables' namespaces nor brainsearch's storages.
+            tables_keys = self.hashkeys(vectors, brain_patches.patches)
+            for bucketkeys in tables_keys:
+                self.engine.storage.store(bucketkeys, data)
+
+            hashkeys = tables_keys[0]
+        else:
+            hashkeys = self.engine.store_batch(vectors, data)
+            tables_keys = self.hashkeys(vectors)
 
-        hashkeys = self.engine.store_batch(vectors, data)
         self.update(nb_patches=len(vectors))
         self.update(labels_count=np.bincount(brain_patches.labels))
+        self.bump_generation()
+
+        self._add_brains_buckets(brain_patches.brain_ids, tables_keys)
+
+        if self.stats is not None:
+            rows = {'patch': brain_patches.patches, 'position': brain_patches.positions}
+            for bucketkeys in tables_keys:
+                self.stats.add_batch(bucketkeys, rows, self._fetch_samples)
+
+        if self.bucket_brains is not None:
+            for bucketkeys in tables_keys:
+                self.bucket_brains.add_batch(bucketkeys, brain_patches.brain_ids, brain_patches.labels)
+
+        if self.max_bucket_size > 0:
+            self.split_buckets(chain(*tables_keys))
+
+        self._save_summary()
         return hashkeys
 
+    def _add_brains_buckets(self, brain_ids, tables_keys):
+        """ Keeps track of the buckets every brain has patches in, saved by `save_stats`. """
+        if self.brains is None:
+            return
+
+        brain_ids = np.asarray(brain_ids).flatten()
+        for brain_id in np.unique(brain_ids):
+            rows = np.where(brain_ids == brain_id)[0]
+            bucketkeys = set(self.brains.get(str(brain_id), []))
+            for keys in tables_keys:
+                bucketkeys.update(keys[i] for i in rows)
+
+            self.brains[str(brain_id)] = sorted(bucketkeys)
+
+    def _leaf_buckets(self, bucketkeys):
+        """ Buckets holding the patches once stored in `bucketkeys` (following splits). """
+        leaves = []
+        pending = list(bucketkeys)
+        while len(pending) > 0:
+            bucketkey = pending.pop()
+            if self._splits.get(bucketkey, -1) < 0:
+                leaves.append(bucketkey)
+                continue
+
+            codes = ["{:0{}b}".format(code, self.SPLIT_NBITS) for code in range(2**self.SPLIT_NBITS)]
+            pending.extend(bucketkey + "/" + code for code in codes)
+
+        return sorted(set(leaves))
+
+    def remove_brain(self, brain_id):
+        """ Removes every patch of a brain from the database.
+
+        Only the buckets the brain has patches in are rewritten. Brains
+        inserted before buckets were tracked, or whose tracking is outdated,
+        require a scan of every bucket.
+        Returns the number of removed patches.
+        """
+        storage = self.engine.storage
+        brains = self.brains or {}
+        if str(brain_id) in brains:
+            bucketkeys = self._leaf_buckets(brains[str(brain_id)])
+        else:
+            bucketkeys = list(storage.bucketkeys())
+
+        nb_removed = 0
+        labels_count = np.zeros(2, dtype=np.int64)
+        for start in range(0, len(bucketkeys), 1000):
+            keys = bucketkeys[start:start+1000]
+            ids = storage.retrieve(keys, attribute=self.metadata['id'])
+            for i, key in enumerate(keys):
+                removed = ids[i].flatten() == brain_id
+                if not np.any(removed):
+                    continue
+
+                data = {}
+                for attribute in self.metadata.values():
+                    data[attribute] = storage.retrieve([key], attribute=attribute)[0]
+
+                labels = data[self.metadata['label']][removed].flatten()
+                labels_count[:len(np.bincount(labels))] += np.bincount(labels)
+                nb_removed += np.sum(removed)
+
+                kept = np.logical_not(removed)
+                storage.clear([key])
+                if np.any(kept):
+                    storage.store([key] * np.sum(kept), dict((attribute, values[kept]) for attribute, values in data.items()))
+
+                if self.stats is not None:
+                    self.stats.set_size(key, np.sum(kept))
+
+                if self.bucket_brains is not None:
+                    self.bucket_brains.remove(key, brain_id)
+
+        # Every hash table holds a copy of the patches.
+        nb_removed //= self.nb_tables
+        self.update(nb_patches=-nb_removed, labels_count=-(labels_count // self.nb_tables))
+        if nb_removed > 0:
+            self.bump_generation()  # A brain of the same size added back must not revive the snapshot.
+
+        brains.pop(str(brain_id), None)
+        self._save_summary()
+        return nb_removed
+
+    def replace_brain(self, vectors, brain_patches):
+        """ Replaces every patch of a brain by the ones given (see `insert`). """
+        self.remove_brain(brain_patches.brain.id)
+        return self.insert(vectors, brain_patches)
+
     def insert_with_pos(self, patches, labels, positions, brain_ids):
         data = {}
         data[self.metadata['label']] = labels
@@ -153,25 +575,53 @@ class BrainDatabase(object):
         hashkeys = self.engine.store_batch_with_pos(patches, positions, data)
         self.update(nb_patches=len(patches))
         self.update(labels_count=np.bincount(labels))
+        self.bump_generation()
         return hashkeys
 
-    def get_neighbors(self, vectors, patches, attributes=None):
+    def get_neighbors(self, vectors, patches, attributes=None, k=None, threshold=None, probes=0, positions=None, radius=None,
+                      exclude_ids=None):
         if attributes is None:
             attributes = ['patch', 'label', 'position', 'id']
 
-        for i, attribute in enumerate(attributes):
-            attributes[i] = self.metadata[attribute]
+        return iter_neighbors(self.get_neighbors_dense(vectors, patches, attributes, k, threshold, probes, positions, radius, exclude_ids))
+
+    def get_neighbors_dense(self, vectors, patches, attributes, k=None, threshold=None, probes=0, positions=None, radius=None,
+                            exclude_ids=None, query_exclude_ids=None):
+        """ Neighbors of every patch as dense arrays (see `QueryPlanner.execute`).
+
+        Arrays are K-padded: missing neighbors have a distance of NaN and
+        attributes of -1 (NaN for floating point ones).
+        """
+        # Unless given, K and threshold are taken from the engine's filters.
+        for f in self.engine.filters:
+            if k is None and isinstance(f, NearestFilter):
+                k = f.N
+            elif threshold is None and isinstance(f, DistanceThresholdFilter):
+                threshold = f.distance_threshold
 
-        return self.engine.neighbors_batch(vectors, patches, *attributes)
+        if k is None:
+            raise ValueError("A number of neighbors K is required to query brain database: " + self.name)
+
+        threshold = np.inf if threshold is None else threshold
+        planner = QueryPlanner(self, k=k, threshold=threshold, probes=probes, radius=radius, exclude_ids=exclude_ids,
+                               rerank=self.rerank)
+        return planner.execute(vectors, patches, attributes, positions=positions, query_exclude_ids=query_exclude_ids)
 
     def get_neighbors_with_pos(self, patches, positions, radius, attributes=None):
         if attributes is None:
             attributes = ['patch', 'label', 'id']
 
-        for i, attribute in enumerate(attributes):
-            attributes[i] = self.metadata[attribute]
+        return self.get_neighbors(patches, patches, attributes, positions=positions, radius=radius)
+
+    @property
+    def generation(self):
+        """ Number of writes to the buckets so far, snapshots of another generation are outdated. """
+        return int(self.storage.get_info(self.name).get("generation") or 0)
 
-        return self.engine.neighbors_batch_with_pos(patches, positions, radius, *attributes)
+    def bump_generation(self):
+        info = self.storage.get_info(self.name)
+        info["generation"] = int(info.get("generation") or 0) + 1
+        self.storage.set_info(self.name, info)
 
     def update(self, nb_patches=None, labels_count=None, nb_buckets=None, overwrite=False):
         info = self.storage.get_info(self.name)
@@ -207,39 +657,402 @@ class BrainDatabase(object):
         return self.engine.neighbors_from_iter(data)
 
 
+# Shards opened by a worker process of `ShardedBrainDatabase`, kept open across queries.
+_worker_manager = None
+_worker_shards = {}
+
+
+def _init_shard_worker(storage_type, storage_params):
+    global _worker_manager
+    _worker_manager = BrainDatabaseManager(storage_type, **storage_params)
+    _worker_shards.clear()
+
+
+def _shard_neighbors(task):
+    shard_name, args = task
+    if shard_name not in _worker_shards:
+        _worker_shards[shard_name] = _worker_manager.open_brain_database(shard_name)
+
+    return _worker_shards[shard_name].get_neighbors_dense(*args)
+
+
+class ShardedBrainDatabase(object):
+    """ Brain database partitioned into several shards.
+
+    Every shard is a regular brain database, with its own keyspace, using
+    the same hash functions. Patches are assigned to a shard either by the
+    id of the brain they come from (partition="id") or by the key of their
+    bucket in the first hash table (partition="bucket").
+
+    Queries are sent to every shard and the per-shard K nearest neighbors
+    are merged to keep the K nearest overall. If the storage is shared
+    between processes (e.g. redis, file), shards can be queried in parallel
+    by `processes` worker processes, each opening the shards once. The
+    processes live as long as the database, until `close` is called.
+    """
+    PARTITIONS = ["id", "bucket"]
+
+    def __init__(self, name, storage, shards, partition="id", manager=None, processes=1):
+        self.name = name
+        self.storage = storage
+        self.shards = shards
+        self.partition = partition
+        self.manager = manager
+        self.processes = processes
+        self._pool = None
+
+    @staticmethod
+    def shard_names(name, nb_shards):
+        return ["{}_shard{}".format(name, i) for i in range(nb_shards)]
+
+    @property
+    def metadata(self):
+        return self.shards[0].metadata
+
+    @property
+    def lshashes(self):
+        return self.shards[0].lshashes
+
+    @property
+    def nb_tables(self):
+        return self.shards[0].nb_tables
+
+    @property
+    def max_bucket_size(self):
+        return self.shards[0].max_bucket_size
+
+    def rebalance(self, max_size=None):
+        return sum(shard.rebalance(max_size) for shard in self.shards)
+
+    def remove_brain(self, brain_id):
+        return sum(shard.remove_brain(brain_id) for shard in self.shards)
+
+    def replace_brain(self, vectors, brain_patches):
+        self.remove_brain(brain_patches.brain.id)
+        return self.insert(vectors, brain_patches)
+
+    def nb_patches(self, check_integrity=False):
+        return sum(shard.nb_patches(check_integrity) for shard in self.shards)
+
+    def nb_buckets(self, check_integrity=False):
+        return sum(shard.nb_buckets(check_integrity) for shard in self.shards)
+
+    def labels_count(self, check_integrity=False):
+        return np.sum([shard.labels_count(check_integrity) for shard in self.shards], axis=0)
+
+    def label_proportions(self, check_integrity=False):
+        labels_count = self.labels_count(check_integrity).astype(np.float32)
+        return labels_count / labels_count.sum()
+
+    def bucket_votes(self, vectors, patches, exclude_ids=()):
+        return np.sum([shard.bucket_votes(vectors, patches, exclude_ids) for shard in self.shards], axis=0)
+
+    def bucket_stats_summary(self):
+        summaries = [shard.bucket_stats_summary() for shard in self.shards]
+        if None in summaries:
+            return None  # A partial summary would be misleading.
+
+        return merge_summaries(summaries)
+
+    def save_stats(self):
+        for shard in self.shards:
+            shard.save_stats()
+
+    def bucket_samples(self):
+        samples = {}
+        for shard in self.shards:
+            samples.update(shard.bucket_samples())
+
+        return samples
+
+    def buckets_size(self):
+        sizes, bucketkeys = [], []
+        for shard in self.shards:
+            shard_sizes, shard_bucketkeys = shard.buckets_size()
+            sizes.extend(shard_sizes)
+            bucketkeys.extend(shard_bucketkeys)
+
+        return sizes, bucketkeys
+
+    def shard_of(self, vectors, brain_patches):
+        """ Index of the shard every patch belongs to. """
+        if self.partition == "id":
+            return brain_patches.brain_ids % len(self.shards)
+
+        bucketkeys = self.shards[0].lshashes[0].hash_vector(vectors)
+        return np.array([(zlib.crc32(key) & 0xffffffff) % len(self.shards) for key in bucketkeys])
+
+    def insert(self, vectors, brain_patches):
+        shard_ids = self.shard_of(vectors, brain_patches)
+
+        hashkeys = []
+        for i, shard in enumerate(self.shards):
+            rows = np.where(shard_ids == i)[0]
+            if len(rows) > 0:
+                patches = BrainPatches(brain_patches.brain, brain_patches.patches[rows], brain_patches.positions[rows])
+                hashkeys.extend(shard.insert(vectors[rows], patches))
+
+        return hashkeys
+
+    def get_neighbors(self, vectors, patches, attributes=None, k=None, threshold=None, probes=0, positions=None, radius=None,
+                      exclude_ids=None):
+        if attributes is None:
+            attributes = ['patch', 'label', 'position', 'id']
+
+        return iter_neighbors(self.get_neighbors_dense(vectors, patches, attributes, k, threshold, probes, positions, radius, exclude_ids))
+
+    def get_neighbors_dense(self, vectors, patches, attributes, k=None, threshold=None, probes=0, positions=None, radius=None,
+                            exclude_ids=None, query_exclude_ids=None):
+        if k is None:
+            raise ValueError("A number of neighbors K is required to query brain database: " + self.name)
+
+        args = (vectors, patches, attributes, k, threshold, probes, positions, radius, exclude_ids, query_exclude_ids)
+        if self.processes > 1 and self.manager is not None:
+            if self._pool is None:
+                self._pool = Pool(min(self.processes, len(self.shards)), initializer=_init_shard_worker,
+                                  initargs=(self.manager.storage_type, self.manager.storage_params))
+
+            try:
+                results = self._pool.map(_shard_neighbors, [(shard.name, args) for shard in self.shards])
+            except:
+                self.close(terminate=True)
+                raise
+        else:
+            results = [shard.get_neighbors_dense(*args) for shard in self.shards]
+
+        dists, neighbors = knn.merge_top_k(k, [result['dist'] for result in results],
+                                           **dict((name, [result[name] for result in results]) for name in attributes))
+        neighbors['dist'] = dists
+        return neighbors
+
+    def close(self, terminate=False):
+        """ Stops the worker processes querying the shards, if any. """
+        if self._pool is None:
+            return
+
+        try:
+            if terminate:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+
+            self._pool.join()
+        finally:
+            self._pool = None
+
+
 class BrainDatabaseManager(object):
     DATABASES_LIST_KEY = "BRAIN_DB"
+    HASH_MODELS_LIST_KEY = "HASH_MODELS"
 
-    def __init__(self, storage_type, **storage_params):
+    def __init__(self, storage_type, shard_processes=1, **storage_params):
         self.storage_type = storage_type
         self.storage_params = storage_params
-        self.storage = storage_factory("file", **storage_params)
+        # Number of worker processes querying the shards of a sharded brain database.
+        self.shard_processes = shard_processes
+        self.readonly = storage_params.get("readonly", False)
+        # Batch size only concerns the pipelined redis storage, not the catalog.
+        self.storage = storage_factory("file", **dict((k, v) for k, v in storage_params.items() if k != "batch_size"))
+        if self.readonly:
+            # Catalog and metadata are loaded once and never written.
+            self.storage = ReadOnlyInfoStorage(self.storage)
 
         #Retrieves existing brain databases
         self.brain_databases_names = self.storage.get_info(BrainDatabaseManager.DATABASES_LIST_KEY)
 
+        # Opened brain databases.
+        self._handles = {}
+
     def __getitem__(self, name):
         if name not in self.brain_databases_names:
             raise ValueError("Unknown database: '{}'".format(name))
 
+        if name in self._handles:
+            return self._handles[name]
+
         try:
-            lhash = pickle.loads(self.storage.get_info(name)["hashing_config"])
-            db_storage = storage_factory(self.storage_type, keyprefix=name, **self.storage_params)
+            info = self.storage.get_info(name)
+            if info.get("nb_shards"):
+                shards = [self.open_brain_database(shard_name)
+                          for shard_name in ShardedBrainDatabase.shard_names(name, int(info["nb_shards"]))]
+                brain_db = ShardedBrainDatabase(name, self.storage, shards, partition=info["partition"], manager=self,
+                                                processes=self.shard_processes)
+            else:
+                brain_db = self.open_brain_database(name)
 
-            engine = Engine(lshashes=[lhash], storage=db_storage)
-            brain_database = BrainDatabase(name, self.storage, engine)
-            return brain_database
+            self._handles[name] = brain_db
+            return brain_db
         except Exception as e:
             print "Cannot opened '{}'".format(name)
             print e.message[-100:]
 
         return None
 
-    def new_brain_database(self, name, lhash, metadata={}):
+    def catalog(self, name):
+        """ Lightweight description of a brain database, read from the catalog only.
+
+        Nothing is unpickled nor opened. Sharded brain databases are
+        described by their aggregated counters.
+        """
+        info = self.storage.get_info(name)
+        names = [name]
+        if info.get("nb_shards"):
+            names = ShardedBrainDatabase.shard_names(name, int(info["nb_shards"]))
+
+        infos = [self.storage.get_info(shard_name) for shard_name in names]
+        metadata = self.storage.get_info(names[0] + "_metadata")
+        entry = {'name': name,
+                 'patch_shape': tuple(metadata["patch_shape"]),
+                 'hashing_name': infos[0]["hashing_name"],
+                 'nb_tables': int(infos[0].get("nb_tables") or 1),
+                 'nb_patches': sum(int(i["nb_patches"] or 0) for i in infos),
+                 'nb_buckets': sum(int(i["nb_buckets"] or 0) for i in infos),
+                 'labels_count': [sum(int(i["label_count_{}".format(label)] or 0) for i in infos) for label in range(2)]}
+
+        # Summaries of buckets written without maintaining them are left out.
+        summaries = [self.storage.get_info(shard_name + "_stats") for shard_name in names]
+        entry['bucket_stats'] = None
+        if all(summary and summary.get('generation', 0) == int(i.get("generation") or 0)
+               for summary, i in zip(summaries, infos)):
+            entry['bucket_stats'] = merge_summaries(summaries)
+
+        if entry['bucket_stats'] is not None:
+            entry['nb_buckets'] = entry['bucket_stats']['nb_buckets']
+
+        if info.get("nb_shards"):
+            entry['nb_shards'] = int(info["nb_shards"])
+            entry['partition'] = info["partition"]
+
+        return entry
+
+    def open_brain_database(self, name):
+        def _open_engine():
+            lhashes = pickle.loads(self.storage.get_info(name)["hashing_config"])
+            if not isinstance(lhashes, list):
+                lhashes = [lhashes]  # Brain database created with a single hash table.
+
+            db_storage = None
+            if self.readonly:
+                db_storage = self._open_snapshot(name)
+
+            if db_storage is None:
+                db_storage = storage_factory(self.storage_type, keyprefix=name, **self.storage_params)
+
+            return Engine(lshashes=lhashes, storage=db_storage)
+
+        return BrainDatabase(name, self.storage, engine_factory=_open_engine, details_path=self.details_path(name))
+
+    def snapshot_path(self, name):
+        return os.path.join(self.storage_params.get("dir", "./"), name + ".snapshot")
+
+    def details_path(self, name):
+        return os.path.join(self.storage_params.get("dir", "./"), name + ".stats")
+
+    def _open_snapshot(self, name):
+        """ Memory-mapped storage of `name`'s snapshot, if it is up to date. """
+        if not self._snapshot_is_current(name):
+            return None
+
+        return MmapStorage(self.snapshot_path(name))
+
+    def _snapshot_is_current(self, name):
+        header = read_snapshot_header(self.snapshot_path(name))
+        if header is None:
+            return False
+
+        info = self.storage.get_info(name)
+        if (header["nb_patches"] != int(info["nb_patches"] or 0) or
+                header.get("generation", 0) != int(info.get("generation") or 0)):
+            print "Snapshot of '{}' is outdated, not using it.".format(name)
+            return False
+
+        return True
+
+    def has_current_snapshot(self, name):
+        """ Whether read-only opens of `name` (every shard of it) use an up-to-date snapshot. """
+        info = self.storage.get_info(name)
+        names = [name]
+        if info.get("nb_shards"):
+            names = ShardedBrainDatabase.shard_names(name, int(info["nb_shards"]))
+
+        return all(self._snapshot_is_current(shard_name) for shard_name in names)
+
+    def compact_brain_database(self, brain_database):
+        """ Rewrites a brain database into a fresh snapshot, used by read-only opens.
+
+        Empty buckets are left out of the snapshot and removed from the storage.
+        Returns the number of buckets in the snapshot.
+        """
+        if isinstance(brain_database, ShardedBrainDatabase):
+            return sum(self.compact_brain_database(shard) for shard in brain_database.shards)
+
+        bucketkeys, empty_bucketkeys = write_snapshot(brain_database.engine.storage, brain_database.metadata,
+                                                      self.snapshot_path(brain_database.name),
+                                                      generation=brain_database.generation)
+        if len(empty_bucketkeys) > 0:
+            brain_database.engine.storage.clear(empty_bucketkeys)
+
+        brain_database.update(nb_buckets=len(bucketkeys), overwrite=True)
+        return len(bucketkeys)
+
+    def new_brain_database(self, name, lhashes, metadata={}, max_bucket_size=0, code_nbits=0, rerank=0):
+        if name in self.brain_databases_names:
+            raise ValueError("Brain database already exists: " + name)
+
+        coder = self._new_coder(metadata, code_nbits)
+        brain_database = self._create_brain_database(name, lhashes, metadata, max_bucket_size, coder, rerank)
+
+        # Add new DB to the list of all DBs
+        self.storage.set_info(BrainDatabaseManager.DATABASES_LIST_KEY, name, append=True)
+        self.brain_databases_names.append(name)
+        self._handles[name] = brain_database
+        return brain_database
+
+    def new_sharded_brain_database(self, name, lhashes, metadata={}, nb_shards=2, partition="id", max_bucket_size=0,
+                                   code_nbits=0, rerank=0):
         if name in self.brain_databases_names:
             raise ValueError("Brain database already exists: " + name)
 
-        lhash.name = name + "_" + lhash.name
+        if partition not in ShardedBrainDatabase.PARTITIONS:
+            raise ValueError("Unknown partition '{}', must be one of {}".format(partition, ShardedBrainDatabase.PARTITIONS))
+
+        if not isinstance(lhashes, list):
+            lhashes = [lhashes]
+
+        # Every shard hashes and encodes patches the same way.
+        coder = self._new_coder(metadata, code_nbits)
+        shards = []
+        for shard_name in ShardedBrainDatabase.shard_names(name, nb_shards):
+            shard_lhashes = pickle.loads(pickle.dumps(lhashes))
+            shards.append(self._create_brain_database(shard_name, shard_lhashes, metadata, max_bucket_size, coder, rerank))
+
+        self.storage.set_info(name, {"name": name,
+                                     "nb_shards": nb_shards,
+                                     "partition": partition})
+
+        # Add new DB to the list of all DBs (shards are not listed).
+        self.storage.set_info(BrainDatabaseManager.DATABASES_LIST_KEY, name, append=True)
+        self.brain_databases_names.append(name)
+        self._handles[name] = ShardedBrainDatabase(name, self.storage, shards, partition=partition, manager=self,
+                                                   processes=self.shard_processes)
+        return self._handles[name]
+
+    def _new_coder(self, metadata, code_nbits):
+        if code_nbits <= 0:
+            return None
+
+        return SignCodes(code_nbits, dimension=int(np.prod(metadata[b"patch"]["shape"])))
+
+    def _create_brain_database(self, name, lhashes, metadata, max_bucket_size=0, coder=None, rerank=0):
+        if not isinstance(lhashes, list):
+            lhashes = [lhashes]
+
+        if coder is not None:
+            metadata = dict(metadata)
+            metadata[b"code"] = {"dtype": np.dtype(np.uint64).str, "shape": (coder.nb_words,)}
+
+        for lhash in lhashes:
+            lhash.name = name + "_" + lhash.name
 
         # Save general information about the new brain database
         # and save information about hashing function
@@ -248,11 +1061,12 @@ class BrainDatabaseManager(object):
                                      "nb_buckets": 0,
                                      "label_count_0": 0,
                                      "label_count_1": 0,
-                                     "hashing_config": pickle.dumps(lhash),
-                                     "hashing_name": lhash.name})
-
-        # Add new DB to the list of all DBs
-        self.storage.set_info(BrainDatabaseManager.DATABASES_LIST_KEY, name, append=True)
+                                     "nb_tables": len(lhashes),
+                                     "max_bucket_size": max_bucket_size,
+                                     "hashing_config": pickle.dumps(lhashes),
+                                     "codes_config": pickle.dumps(coder) if coder is not None else None,
+                                     "rerank": rerank,
+                                     "hashing_name": ",".join(lhash.name for lhash in lhashes)})
 
         # Save information about metadata
         metadata_key = name + "_metadata"
@@ -262,27 +1076,113 @@ class BrainDatabaseManager(object):
             metadata_dict[attribute_name + "_shape"] = attribute_info['shape']
 
         self.storage.set_info(metadata_key, metadata_dict)
+        self._reset_stats(name)
 
         db_storage = storage_factory(self.storage_type, keyprefix=name, **self.storage_params)
-        engine = Engine(lshashes=[lhash], storage=db_storage)
-        brain_database = BrainDatabase(name, self.storage, engine)
-        self.brain_databases_names.append(name)
-        return brain_database
+        engine = Engine(lshashes=lhashes, storage=db_storage)
+        return BrainDatabase(name, self.storage, engine, details_path=self.details_path(name))
+
+    def close(self):
+        """ Stops the worker processes of opened brain databases, if any. """
+        for brain_database in self._handles.values():
+            if isinstance(brain_database, ShardedBrainDatabase):
+                brain_database.close()
 
     def remove_brain_database(self, brain_database, full=False):
+        if isinstance(brain_database, ShardedBrainDatabase):
+            brain_database.close()
+            for shard in brain_database.shards:
+                self._remove_brain_database(shard, full)
+
+            if full:
+                self.storage.del_info(brain_database.name)
+        else:
+            self._remove_brain_database(brain_database, full)
+
+        if full:
+            self.storage.del_info(BrainDatabaseManager.DATABASES_LIST_KEY, brain_database.name)
+            self._handles.pop(brain_database.name, None)
+
+    def _remove_brain_database(self, brain_database, full=False):
+        remove_snapshot(self.snapshot_path(brain_database.name))
+
         if full:
             self.storage.del_info(brain_database.name)
             self.storage.del_info(brain_database.name + "_metadata")
-            self.storage.del_info(BrainDatabaseManager.DATABASES_LIST_KEY, brain_database.name)
+            self.storage.del_info(brain_database.name + "_splits")
+            self.storage.del_info(brain_database.name + "_brains")
+            for suffix in ["_stats", "_bucket_sizes", "_samples", "_bucket_brains"]:
+                self.storage.del_info(brain_database.name + suffix)
+            remove_details(self.details_path(brain_database.name))
             brain_database.engine.storage.clear()
         else:
             brain_database.engine.clean_all_buckets()
+            brain_database.bump_generation()
+            self.storage.set_info(brain_database.name + "_splits", {})
+            self.storage.del_info(brain_database.name + "_brains")
+            self._reset_stats(brain_database.name, brain_database.generation)
+
+        brain_database._stats = None
+        brain_database._bucket_brains = None
+        brain_database._brains = None
+        brain_database._details = None
+
+    def _reset_stats(self, name, generation=0):
+        summary = BucketStats().summary()
+        summary['generation'] = generation
+        self.storage.set_info(name + "_stats", summary)
+        write_details(self.details_path(name), generation, sizes={}, samples={}, bucket_brains=BucketBrains(), brains={})
 
     def remove_all_brain_databases(self, full=False):
         for name in self.brain_databases_names:
             brain_db = self[name]
             self.remove_brain_database(brain_db, full)
 
+    @property
+    def hash_models_names(self):
+        return self.storage.get_info(BrainDatabaseManager.HASH_MODELS_LIST_KEY) or []
+
+    def new_hash_model(self, name, model, inputs):
+        """ Registers a trained hash model so brain databases can share it.
+
+        Parameters
+        ----------
+        name : str
+        model : object
+            Trained model (e.g. `training.PCAModel`), pickled.
+        inputs : dict
+            What the model was trained with (patch shape, trainset, ...), fingerprinted.
+        """
+        if name in self.hash_models_names:
+            raise ValueError("Hash model already exists: " + name)
+
+        self.storage.set_info("hash_model_" + name, {"name": name,
+                                                     "type": type(model).__name__,
+                                                     "inputs": json.dumps(inputs, sort_keys=True),
+                                                     "fingerprint": fingerprint(inputs),
+                                                     "nb_components": model.nb_components,
+                                                     "nb_patches": model.nb_patches,
+                                                     "model": pickle.dumps(model)})
+        self.storage.set_info(BrainDatabaseManager.HASH_MODELS_LIST_KEY, name, append=True)
+
+    def hash_model(self, name, load_model=True):
+        """ Entry of a registered hash model, its trained model being unpickled unless `load_model` is False. """
+        if name not in self.hash_models_names:
+            raise ValueError("Unknown hash model: '{}'".format(name))
+
+        entry = dict(self.storage.get_info("hash_model_" + name))
+        entry["inputs"] = json.loads(entry["inputs"])
+        if load_model:
+            entry["model"] = pickle.loads(entry["model"])
+        else:
+            del entry["model"]
+
+        return entry
+
+    def remove_hash_model(self, name):
+        self.storage.del_info("hash_model_" + name)
+        self.storage.del_info(BrainDatabaseManager.HASH_MODELS_LIST_KEY, name)
+
     def __contains__(self, name):
         return name in self.brain_databases_names
 
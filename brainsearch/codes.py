@@ -0,0 +1,90 @@
+import numpy as np
+
+# Constants of the SWAR popcount (bit counts of 2, 4 then 8 bits wide fields).
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def nb_words(nbits):
+    """ Number of uint64 words holding a code of `nbits` bits. """
+    return (nbits + 63) // 64
+
+
+def pack_bits(bits):
+    """ Packs binary codes into uint64 words, first bit being the most significant.
+
+    Parameters
+    ----------
+    bits : 2D boolean array (nb_codes, nbits)
+
+    Returns
+    -------
+    codes : 2D uint64 array (nb_codes, nb_words(nbits))
+    """
+    bits = np.asarray(bits, dtype=bool).reshape((len(bits), -1))
+    padded = np.zeros((len(bits), 64 * nb_words(bits.shape[1])), dtype=bool)
+    padded[:, :bits.shape[1]] = bits
+    return np.packbits(padded, axis=1).view(">u8").astype(np.uint64)
+
+
+def popcount(words):
+    """ Number of bits set in every uint64 word. """
+    words = np.asarray(words, dtype=np.uint64)
+    words = words - ((words >> np.uint64(1)) & _M1)
+    words = (words & _M2) + ((words >> np.uint64(2)) & _M2)
+    words = (words + (words >> np.uint64(4))) & _M4
+    return ((words * _H01) >> np.uint64(56)).astype(np.int32)
+
+
+def hamming_distances(queries, codes):
+    """ Hamming distance between every query code and every code.
+
+    Parameters
+    ----------
+    queries : 2D uint64 array (nb_queries, nb_words)
+    codes : 2D uint64 array (nb_codes, nb_words)
+
+    Returns
+    -------
+    distances : 2D int array (nb_queries, nb_codes)
+    """
+    queries = queries.reshape((len(queries), -1))
+    codes = codes.reshape((len(codes), -1))
+    distances = np.zeros((len(queries), len(codes)), dtype=np.int32)
+    for word in range(queries.shape[1]):
+        distances += popcount(queries[:, word, None] ^ codes[None, :, word])
+
+    return distances
+
+
+class SignCodes(object):
+    """ Binary codes of patches: signs of random projections.
+
+    Unlike bucket keys, codes are stored for every patch, so the candidates
+    of a bucket can be ranked by the Hamming distance between their code and
+    the query's (see `QueryPlanner`'s `rerank`). The angle between two
+    patches is about pi times the proportion of bits their codes differ by.
+
+    Parameters
+    ----------
+    nbits : int
+        Length of the codes.
+    dimension : int
+        Dimension of the encoded patches.
+    rng : `numpy.random.RandomState`, optional
+    """
+    def __init__(self, nbits, dimension, rng=None):
+        rng = rng if rng is not None else np.random.RandomState()
+        self.nbits = nbits
+        self.normals = rng.randn(nbits, dimension).astype(np.float32)
+
+    @property
+    def nb_words(self):
+        return nb_words(self.nbits)
+
+    def encode(self, patches):
+        """ Packed codes of `patches`, array of shape (nb_patches, nb_words). """
+        patches = np.asarray(patches).reshape((len(patches), -1))
+        return pack_bits(np.dot(patches, self.normals.T) > 0)
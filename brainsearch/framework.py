@@ -4,14 +4,18 @@ from __future__ import division
 import os
 from os.path import join as pjoin
 
+import copy
 import json
 import time
+import shutil
+import tempfile
 import numpy as np
 import pylab as plt
 import itertools
 import nibabel as nib
 
 from itertools import izip, chain
+from multiprocessing import Pool
 import brainsearch.vizu as vizu
 
 from brainsearch.utils import Timer
@@ -19,6 +23,11 @@ import brainsearch.utils as brainutil
 #from brainsearch.imagespeed import blockify
 from brainsearch.brain_database import BrainDatabaseManager
 from brainsearch.brain_data import brain_data_factory
+from brainsearch.stats import describe as describe_bucket_stats
+from brainsearch import training
+from brainsearch import benchmark
+from brainsearch import maps
+from brainsearch.query import QueryPlanner
 
 import nearpy
 from nearpy.hashes import LocalitySensitiveHashing, PCAHashing, SpectralHashing
@@ -108,30 +117,61 @@ def main(brain_manager=None):
 
 
 def list(brain_manager, name, verbose=False, check_integrity=False):
-    def print_info(name, brain_db):
+    def print_info(name):
+        # Unless checking integrity, everything comes from the catalog: nothing is opened.
+        entry = brain_manager.catalog(name)
+        if check_integrity:
+            brain_db = brain_manager[name]
+            entry['labels_count'] = brain_db.labels_count(check_integrity=True)
+            entry['nb_patches'] = brain_db.nb_patches(check_integrity=True)
+            entry['nb_buckets'] = brain_db.nb_buckets(check_integrity=True)
+
         print name
-        #print "\tMetadata:", brain_db.metadata
-        print "\tPatch size:", brain_db.metadata["patch"].shape
-        print "\tHashes:", map(str, brain_db.engine.lshashes)
+        print "\tPatch size:", entry['patch_shape']
+        print "\tHashes:", entry['hashing_name'].split(",")
+        print "\tTables:", entry['nb_tables']
+        if 'nb_shards' in entry:
+            print "\tShards: {} (partition by {})".format(entry['nb_shards'], entry['partition'])
         if verbose:
-            labels_counts = ["{}: {:,}".format(i, label_count) for i, label_count in enumerate(brain_db.labels_count(check_integrity=check_integrity))]
+            labels_counts = ["{}: {:,}".format(i, label_count) for i, label_count in enumerate(entry['labels_count'])]
             print "\tLabels: {" + "; ".join(labels_counts) + "}"
-            print "\tPatches: {:,}".format(brain_db.nb_patches(check_integrity=check_integrity))
-            print "\tBuckets: {:,}".format(brain_db.nb_buckets(check_integrity=check_integrity))
+            print "\tPatches: {:,}".format(entry['nb_patches'])
+            print "\tBuckets: {:,}".format(entry['nb_buckets'])
+            if entry.get('bucket_stats') is not None:
+                stats = describe_bucket_stats(entry['bucket_stats'])
+                print "\tBucket sizes: avg. {mean:.2f}, std. {std:.2f}, max. {max:,}".format(**stats)
 
     if name in brain_manager:
-        print_info(name, brain_manager[name])
+        print_info(name)
     else:
         print "{} available brain databases: ".format(len(brain_manager.brain_databases_names))
         for name in brain_manager.brain_databases_names:
             try:
-                print_info(name, brain_manager[name])
+                print_info(name)
                 print ""
             except:
                 import traceback
                 traceback.print_exc()
                 print "*Brain database '{}' is corrupted!*\n".format(name)
 
+        hash_models_names = brain_manager.hash_models_names
+        if len(hash_models_names) > 0:
+            print "{} available hash models: ".format(len(hash_models_names))
+            for model_name in hash_models_names:
+                entry = brain_manager.hash_model(model_name, load_model=False)
+                if entry.get('nb_components') is None:
+                    # Hash model registered before its counts were kept in the catalog.
+                    model = brain_manager.hash_model(model_name)['model']
+                    entry.update(nb_components=model.nb_components, nb_patches=model.nb_patches)
+
+                print model_name
+                print "\tType: {} ({} components, {:,} patches)".format(entry['type'], entry['nb_components'],
+                                                                        entry['nb_patches'])
+                print "\tFingerprint:", entry['fingerprint']
+                if verbose:
+                    for key, value in sorted(entry['inputs'].items()):
+                        print "\t{}: {}".format(key, value)
+
 
 def clear(brain_manager, names, force=False):
     start = time.time()
@@ -151,17 +191,28 @@ def clear(brain_manager, names, force=False):
 
 
 def hashing_factory(hashtype, dimension, nbits, **kwargs):
+    # Patches of the trainset are read once, only `train_budget` of them are kept (0: all).
+    train_budget = kwargs.get('train_budget', training.DEFAULT_BUDGET)
+
     if hashtype.upper() == "SH":
         hash_name = "SH{nbits}".format(nbits=nbits)
+        trainset = kwargs['trainset']
+        if train_budget > 0:
+            sample = training.subsample(trainset(), train_budget)
+            trainset = lambda: training.iter_chunks(sample)
+
         return SpectralHashing(hash_name,
                                nbits=nbits,
                                dimension=dimension,
-                               trainset=kwargs['trainset'],
+                               trainset=trainset,
                                pca_pkl=kwargs['pca_pkl'],
                                bounds_pkl=kwargs['bounds_pkl'])
 
     elif hashtype.upper() == "PCA":
         hash_name = "PCAH{nbits}".format(nbits=nbits)
+        if kwargs.get('pca_pkl') is None:
+            return training.train_pca_hash(hash_name, nbits, kwargs['trainset'](), budget=train_budget)
+
         return PCAHashing(hash_name,
                           nbits=nbits,
                           dimension=dimension,
@@ -182,17 +233,69 @@ def hashing_factory(hashtype, dimension, nbits, **kwargs):
     raise ValueError("Unknown hashing method: {}".format(hashtype))
 
 
-def init(brain_manager, name, patch_shape, hashing):
+def train(brain_manager, name, trainset, inputs, nb_components=None, train_budget=training.DEFAULT_BUDGET):
+    """ Trains a PCA hash model once and registers it under `name`.
+
+    Brain databases built later with `hash_model_hashing` share it, whatever
+    their number of bits.
+    """
+    if name in brain_manager.hash_models_names:
+        raise ValueError("Hash model already exists: " + name)
+
+    model = training.train_pca(trainset, nb_components, budget=train_budget)
+    brain_manager.new_hash_model(name, model, inputs)
+    entry = brain_manager.hash_model(name, load_model=False)
+    print "Trained hash model '{}' on {:,} patches ({} components), fingerprint {}.".format(
+        name, model.nb_patches, model.nb_components, entry['fingerprint'])
+
+
+def hash_model_hashing(brain_manager, model_name, nbits, inputs):
+    """ PCA hash of `nbits` bits out of a registered hash model.
+
+    `inputs` describe how patches of the new brain database are extracted,
+    they must match the ones the model was trained with.
+    """
+    entry = brain_manager.hash_model(model_name)
+    try:
+        training.check_inputs(entry['inputs'], inputs)
+    except ValueError as e:
+        raise ValueError("Cannot use hash model '{}': {}".format(model_name, e.message))
+
+    return entry['model'].hash("PCAH{}_{}".format(nbits, model_name), nbits)
+
+
+def hash_tables_factory(hashtype, dimension, nbits, nb_tables=1, **kwargs):
+    if nb_tables > 1 and hashtype.upper() != "LSH":
+        # PCA and SH are deterministic given their trainset, all tables would be identical.
+        raise ValueError("Multiple hash tables are only supported for LSH, not {}".format(hashtype))
+
+    lhashes = []
+    for table_id in range(nb_tables):
+        lhash = hashing_factory(hashtype, dimension, nbits, **kwargs)
+        if nb_tables > 1:
+            lhash.name += "_T{}".format(table_id)
+
+        lhashes.append(lhash)
+
+    return lhashes
+
+
+def init(brain_manager, name, patch_shape, hashing, max_bucket_size=0, nb_shards=1, partition="id", code_nbits=0, rerank=0):
     metadata = {b"patch": {"dtype": np.dtype(np.float32).str, "shape": patch_shape},
                 b"label": {"dtype": np.dtype(np.int8).str, "shape": (1,)},
                 b"id": {"dtype": np.dtype(np.int32).str, "shape": (1,)},
                 b"position": {"dtype": np.dtype(np.int32).str, "shape": (len(patch_shape),)},
                 }
 
-    brain_manager.new_brain_database(name, hashing, metadata)
+    if nb_shards > 1:
+        brain_manager.new_sharded_brain_database(name, hashing, metadata, nb_shards=nb_shards, partition=partition,
+                                                 max_bucket_size=max_bucket_size, code_nbits=code_nbits, rerank=rerank)
+    else:
+        brain_manager.new_brain_database(name, hashing, metadata, max_bucket_size=max_bucket_size,
+                                         code_nbits=code_nbits, rerank=rerank)
 
 
-def add(brain_manager, name, brain_data, min_nonempty=0, spatial_weight=0.):
+def add(brain_manager, name, brain_data, min_nonempty=0, spatial_weight=0., replace=False):
     brain_db = brain_manager[name]
     if brain_db is None:
         raise ValueError("Unexisting brain database: " + name)
@@ -208,19 +311,86 @@ def add(brain_manager, name, brain_data, min_nonempty=0, spatial_weight=0.):
             brain_patches = brain.extract_patches(patch_shape, min_nonempty=min_nonempty)
             vectors = brain_patches.create_vectors(spatial_weight=spatial_weight)
 
-        hashkeys = brain_db.insert(vectors, brain_patches)
+        if replace:
+            hashkeys = brain_db.replace_brain(vectors, brain_patches)
+        else:
+            hashkeys = brain_db.insert(vectors, brain_patches)
 
         print "ID: {0} (label:{3}), {1:,} patches in {2:.2f} sec.".format(brain_id, len(hashkeys), time.time()-start_brain, brain.label)
         nb_elements_total += len(hashkeys)
 
+    brain_db.save_stats()
     print "Inserted {0:,} patches ({1} brains) in {2:.2f} sec.".format(nb_elements_total, brain_id+1, time.time()-start)
 
 
-def check(brain_manager, name, spatial_weight=0.):
+def remove_brains(brain_manager, name, brain_ids):
     brain_db = brain_manager[name]
     if brain_db is None:
         raise ValueError("Unexisting brain database: " + name)
 
+    for brain_id in brain_ids:
+        with Timer("Removing brain #{}".format(brain_id)):
+            nb_removed = brain_db.remove_brain(brain_id)
+
+        print "Removed {:,} patches".format(nb_removed)
+
+    brain_db.save_stats()
+
+
+def check(brain_manager, name, spatial_weight=0., full=False):
+    brain_db = brain_manager[name]
+    if brain_db is None:
+        raise ValueError("Unexisting brain database: " + name)
+
+    summary = brain_db.bucket_stats_summary()
+    if full or summary is None:
+        if not full:
+            print "No bucket statistics maintained for this database, scanning every bucket."
+
+        return check_full(brain_db, name, spatial_weight)
+
+    # Report stats maintained as patches were inserted, no bucket is read.
+    stats = describe_bucket_stats(summary)
+    print "Counted {nb_patches:,} candidates for {nb_buckets:,} buckets".format(**stats)
+    print "Avg. candidates per bucket: {0:.2f}".format(stats['mean'])
+    print "Std. candidates per bucket: {0:.2f}".format(stats['std'])
+    print "Min. candidates per bucket: {0:,} (bin lower bound)".format(stats['min_bin'])
+    print "Max. candidates per bucket: {0:,}".format(stats['max'])
+    print "Sum_bucket |bucket|*(|bucket|-1): {0:,}".format(stats['nb_pairs'])
+
+    # Large buckets are evaluated on their samples.
+    samples = brain_db.bucket_samples().values()
+    std_voxels = [np.std(sample['patch'], axis=0) for sample in samples]
+    avg_spatial_distances = []
+    std_positions = []
+    for sample in samples:
+        positions = sample['position'].astype(np.float64)
+        std_positions.append(np.std(positions, axis=0))
+        distances = np.sqrt(np.sum((positions[:, None] - positions[None, :])**2, axis=2))
+        avg_spatial_distances.append(distances[np.triu_indices(len(positions), k=1)].mean())
+
+    print "\nLarge buckets sampled: {:,}".format(len(samples))
+    if len(samples) > 0:
+        print "Avg. std. of voxels values per bucket: {0:.4f}".format(np.mean(std_voxels))
+        print "Avg. spatial distance per bucket: {0:.2f}".format(np.mean(avg_spatial_distances))
+        print "Std. spatial distance per bucket: {0:.2f}".format(np.std(avg_spatial_distances))
+        print "Avg. of position std.: {}".format(np.mean(std_positions, axis=0))
+
+    histogram = np.trim_zeros(np.asarray(summary['histogram']), 'b')
+    plt.clf()
+    plt.bar(2.**np.arange(len(histogram)), histogram, width=2.**np.arange(len(histogram)), align='edge', log=True)
+    plt.xlabel('Bucket sizes')
+    plt.ylabel('Count')
+    plt.xscale('log')
+
+    FIGURES_FOLDER = './figs'
+    if not os.path.isdir(FIGURES_FOLDER):
+        os.mkdir(FIGURES_FOLDER)
+
+    plt.savefig(pjoin(FIGURES_FOLDER, name), bbox_inches='tight')
+
+
+def check_full(brain_db, name, spatial_weight=0.):
     # Simply report stats about buckets size.
     with Timer('Counting'):
         sizes, bucketkeys = brain_db.buckets_size()
@@ -284,48 +454,211 @@ def check(brain_manager, name, spatial_weight=0.):
     #brain_db.show_large_buckets(sizes, bucketkeys, spatial_weight)
 
 
-def create_map(brain_manager, name, brain_data, K=100, threshold=np.inf, min_nonempty=0, spatial_weight=0., use_dist=False):
-    brain_db = brain_manager[name.strip("/").split("/")[-1]]
+def rebalance(brain_manager, name, max_size=None):
+    brain_db = brain_manager[name]
     if brain_db is None:
         raise ValueError("Unexisting brain database: " + name)
 
-    patch_shape = brain_db.metadata['patch'].shape
+    max_size = max_size or brain_db.max_bucket_size
+    if max_size <= 0:
+        raise ValueError("No maximum bucket size given nor set for: " + name)
 
-    brain_db.engine.distance = nearpy.distances.EuclideanDistance(brain_db.metadata['patch'])
-    #brain_db.engine.distance = nearpy.distances.CorrelationDistance(brain_db.metadata['patch'])
+    with Timer('Splitting buckets larger than {:,}'.format(max_size)):
+        nb_splits = brain_db.rebalance(max_size)
 
-    # TODO: find how to compute a good threshood :/ ?!?
-    #brain_db.engine.filters = [DistanceThresholdFilter(threshold), NearestFilter(K)]
-    brain_db.engine.filters = [NearestFilter(K)]
+    print "Split {:,} buckets".format(nb_splits)
 
-    half_patch_size = np.array(patch_shape) // 2
+
+def compact(brain_manager, name):
+    brain_db = brain_manager[name]
+    if brain_db is None:
+        raise ValueError("Unexisting brain database: " + name)
+
+    with Timer('Compacting ' + name):
+        nb_buckets = brain_manager.compact_brain_database(brain_db)
+
+    print "Wrote {:,} non-empty buckets".format(nb_buckets)
+
+
+def benchmark_hashing(brain_data, patch_shape, configurations, K=10, nb_queries=1000, min_nonempty=0, spatial_weight=0.,
+                      train_budget=training.DEFAULT_BUDGET, out="benchmark", seed=1234):
+    """ Builds an in-memory brain database per hashing configuration and measures it.
+
+    Queries are sampled among the patches of `brain_data`, their exact kNN
+    serve as ground truth. Build time, index size, candidates per query, query
+    throughput and recall@K of every configuration (see
+    `benchmark.configurations`) are written in '{out}.json' and '{out}.csv'.
+    Configurations only differing by their probes query the same database.
+    """
+    rng = np.random.RandomState(seed)
+    with Timer("Extracting patches"):
+        brains_patches = [brain.extract_patches(patch_shape, min_nonempty=min_nonempty) for brain in brain_data]
+
+    queries = benchmark.sample_queries(brains_patches, nb_queries, rng, spatial_weight)
+    with Timer("Finding exact {}-NN of {:,} queries".format(K, len(queries['patches']))):
+        true_uids = benchmark.exact_uids(queries, brains_patches, K)
+
+    def _trainset():
+        return (brain_patches.create_vectors(spatial_weight) for brain_patches in brains_patches)
+
+    dimension = queries['vectors'].shape[1]
+    results = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        brain_manager = BrainDatabaseManager("memory", dir=tmpdir)
+        for i, group in enumerate(benchmark.builds(configurations)):
+            name = "bench{}".format(i)
+            start = time.time()
+            hashing = hash_tables_factory(group[0]['hashing'], dimension, group[0]['nbits'], nb_tables=group[0]['tables'],
+                                          trainset=_trainset, pca_pkl=None, bounds_pkl=None, train_budget=train_budget)
+            init(brain_manager, name, patch_shape, hashing)
+            brain_db = brain_manager[name]
+            for brain_patches in brains_patches:
+                brain_db.insert(brain_patches.create_vectors(spatial_weight), brain_patches)
+
+            build_time = time.time() - start
+            storage = brain_db.engine.storage
+            index_bytes = storage.nbytes() if hasattr(storage, "nbytes") else None
+            nb_buckets = len(storage.bucketkeys())
+
+            for config in group:
+                planner = QueryPlanner(brain_db, k=K, probes=config['probes'])
+                start = time.time()
+                neighbors = planner.execute(queries['vectors'], queries['patches'], ['id', 'position'])
+                query_time = max(time.time() - start, 1e-6)
+
+                result = dict(config)
+                result.update(build_time=build_time,
+                              index_bytes=index_bytes,
+                              nb_buckets=nb_buckets,
+                              candidates_per_query=planner.nb_candidates / len(true_uids),
+                              buckets_per_query=planner.nb_buckets_fetched / len(true_uids),
+                              queries_per_sec=len(true_uids) / query_time,
+                              recall=benchmark.recall(neighbors, true_uids))
+                results.append(result)
+                print ("{hashing}{nbits} x{tables} ({probes} probes): built in {build_time:.2f} sec., "
+                       "{candidates_per_query:,.0f} candidates/query, {queries_per_sec:,.0f} queries/sec., "
+                       "recall@{K} {recall:.3f}").format(K=K, **result)
+
+            brain_manager.remove_brain_database(brain_db, full=True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    benchmark.write_results(results, out)
+    print "Results written in {0}.json and {0}.csv".format(out)
+    return results
+
+
+def create_map(brain_manager, name, brain_data, K=100, threshold=np.inf, min_nonempty=0, spatial_weight=0., use_dist=False, probes=0, radius=None,
+               mode="knn", jobs=1):
+    brain_db = brain_manager[name.strip("/").split("/")[-1]]
+    if brain_db is None:
+        raise ValueError("Unexisting brain database: " + name)
+
+    options = dict(K=K, threshold=threshold, min_nonempty=min_nonempty, spatial_weight=spatial_weight, use_dist=use_dist,
+                   probes=probes, radius=radius, mode=mode)
 
     print "Found {} brains to map".format(len(brain_data))
+    if jobs > 1:
+        _map_brains_parallel(brain_manager, brain_db.name, brain_data, jobs, options)
+        return
+
     for i, brain in enumerate(brain_data):
-        print "Mapping {}...".format(brain.name)
-        brain_patches = brain.extract_patches(patch_shape, min_nonempty=min_nonempty)
-        vectors = brain_patches.create_vectors(spatial_weight=spatial_weight)
+        map_brain(brain_db, brain_data.name, brain, i, **options)
 
-        # Position of extracted patches represent to top left corner.
-        center_positions = brain_patches.positions + half_patch_size
 
-        nids = -1 * np.ones((len(brain_patches), K), dtype=np.int32)
-        nlabels = -1 * np.ones((len(brain_patches), K), dtype=np.uint8)
-        ndists = np.nan * np.ones((len(brain_patches), K), dtype=np.float32)
-        #npositions = -1 * np.ones((len(brain_patches), K, 3), dtype=np.uint16)
-        #npatches = -1 * np.ones((len(brain_patches), K, int(np.prod(patch_shape))), dtype=np.float32)
+# Brain database opened once by every worker process of `_map_brains_parallel`.
+_map_worker_db = None
+
+
+def _init_map_worker(storage_type, storage_params, name):
+    global _map_worker_db
+    _map_worker_db = BrainDatabaseManager(storage_type, **storage_params)[name]
+
+
+def _map_brain_task(task):
+    brain_data, i, options = task
+    start = time.time()
+    names = []
+    for brain in brain_data:  # Only brain #i, see `brain_data.id`.
+        map_brain(_map_worker_db, brain_data.name, brain, i, **options)
+        names.append(brain.name)
+
+    return names, time.time() - start
 
-        start_brain = time.time()
-        for patch_id, neighbors in brain_db.get_neighbors(vectors, brain_patches.patches, attributes=["id", "label"]):
-            nlabels[patch_id, :len(neighbors['label'])] = neighbors['label'].flatten()
-            nids[patch_id, :len(neighbors['id'])] = neighbors['id'].flatten()
-            ndists[patch_id, :len(neighbors['dist'])] = neighbors['dist'].flatten()
-            #npositions[patch_id, :len(neighbors['position']), :] = neighbors['position']
-            #npatches[patch_id, :len(neighbors['patch']), :] = neighbors['patch'].reshape((-1, int(np.prod(patch_shape))))
 
-            # if np.all(center_positions[patch_id] == (84, 114, 115)):
-            #     print patch_id
-            #     from ipdb import set_trace; set_trace()
+def _map_brains_parallel(brain_manager, name, brain_data, jobs, options):
+    """ Maps brains of `brain_data` in `jobs` worker processes.
+
+    The brain database is only read while mapping: every worker opens it
+    once, read-only (i.e. from its memory-mapped snapshot if it has been
+    compacted, which the workers then share), and maps one brain at a time,
+    writing its own results. Progress is reported by the parent process.
+    """
+    if not isinstance(brain_manager, BrainDatabaseManager):
+        raise ValueError("Mapping with several jobs requires a local brain database, not a query server.")
+
+    if brain_manager.storage_type == "memory":
+        raise ValueError("Mapping with several jobs requires a persistent storage, workers cannot open a 'memory' one.")
+
+    if not brain_manager.has_current_snapshot(name):
+        print "No up-to-date snapshot of '{}' (see compact), every worker reads the storage on its own.".format(name)
+
+    tasks = []
+    for i in range(len(brain_data)):
+        if brain_data.id is None or brain_data.id == i:
+            brain_data_i = copy.copy(brain_data)
+            brain_data_i.id = i
+            tasks.append((brain_data_i, i, options))
+
+    storage_params = dict(brain_manager.storage_params, readonly=True)
+    pool = Pool(min(jobs, len(tasks)), initializer=_init_map_worker,
+                initargs=(brain_manager.storage_type, storage_params, name))
+
+    start = time.time()
+    try:
+        for done, (names, duration) in enumerate(pool.imap_unordered(_map_brain_task, tasks), start=1):
+            elapsed = time.time() - start
+            print "[{}/{}] Mapped {} in {:.2f} sec. ({:.2f} sec. elapsed, about {:.0f} sec. left)".format(
+                done, len(tasks), ", ".join(names), duration, elapsed, elapsed / done * (len(tasks) - done))
+    except:
+        pool.terminate()  # Don't leave workers mapping the remaining brains.
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def map_brain(brain_db, brain_data_name, brain, i, K=100, threshold=np.inf, min_nonempty=0, spatial_weight=0., use_dist=False,
+              probes=0, radius=None, mode="knn"):
+    """ Maps a single brain, results are written in './results/{brain_db.name}/{brain_data_name}/'. """
+    patch_shape = brain_db.metadata['patch'].shape
+
+    # TODO: find how to compute a good threshood :/ ?!?
+    half_patch_size = np.array(patch_shape) // 2
+
+    print "Mapping {}...".format(brain.name)
+    brain_patches = brain.extract_patches(patch_shape, min_nonempty=min_nonempty)
+    vectors = brain_patches.create_vectors(spatial_weight=spatial_weight)
+
+    # Position of extracted patches represent to top left corner.
+    center_positions = brain_patches.positions + half_patch_size
+
+    start_brain = time.time()
+    if mode == "bucket-vote":
+        # Count labels of the buckets' patches, leaving the query brain out, without reading any bucket.
+        votes = brain_db.bucket_votes(vectors, brain_patches.patches, exclude_ids=[brain.id])
+        control, parkinson = votes[:, 0], votes[:, 1]
+        n = control + parkinson  # sample size
+        print "{3}. Brain #{0} ({2:,} patches) counted votes in {1:.2f} sec.".format(brain.id, time.time()-start_brain, len(brain_patches), i)
+        print "Patches with no votes: {:,}".format(np.sum(n == 0))
+    else:
+        # Leave-one-out: patches of the query brain are excluded from the search, not filtered afterwards.
+        # Neighbors come back K-padded (-1 labels and ids, NaN distances).
+        neighbors = brain_db.get_neighbors_dense(vectors, brain_patches.patches, ["id", "label"], k=K, probes=probes,
+                                                 positions=brain_patches.positions, radius=radius, exclude_ids=[brain.id])
+        nids, nlabels, ndists = neighbors['id'], neighbors['label'], neighbors['dist']
 
         print "{4}. Brain #{0} ({3:,} patches) found {1:,} neighbors in {2:.2f} sec.".format(brain.id, np.sum(nlabels != -1), time.time()-start_brain, len(brain_patches), i)
         print "Patches with no neighbors: {:,}".format(np.all(nlabels == -1, axis=1).sum())
@@ -351,78 +684,79 @@ def create_map(brain_manager, name, brain_data, K=100, threshold=np.inf, min_non
             # control = np.sum((1-ndists) * np.logical_and(nlabels == 0, nids != brain.id), axis=1)
             # parkinson = np.sum((1-ndists) * np.logical_and(nlabels == 1, nids != brain.id), axis=1)
 
-        P0 = brain_db.label_proportions()[1]  # Hypothesized population proportion
-        p = parkinson / (parkinson+control)  # sample proportion
-        p[np.isnan(p)] = P0
         n = np.sum(nlabels != -1, axis=1)     # sample size
 
-        z_statistic, pvalue = two_tailed_test_of_population_proportion(P0, p, n)
-
-        #prop = np.zeros_like(brain.image, dtype=np.float32)
-        #prop[zip(*center_positions)] = p
+    P0 = brain_db.label_proportions()[1]  # Hypothesized population proportion
+    p = parkinson / (parkinson+control)  # sample proportion
+    p[np.isnan(p)] = P0
 
-        zmap = np.zeros_like(brain.image, dtype=np.float32)
-        zmap_smooth = np.zeros_like(brain.image, dtype=np.float32)
-        pmap = np.ones_like(brain.image, dtype=np.float32)
-        counts = np.zeros_like(brain.image, dtype=np.float32)
+    z_statistic, pvalue = two_tailed_test_of_population_proportion(P0, p, n)
 
-        # Patches composite z-scores
-        # see https://en.wikipedia.org/wiki/Fisher%27s_method#Relation_to_Stouffer.27s_Z-score_method
-        for z in range(patch_shape[2]):
-            for y in range(patch_shape[1]):
-                for x in range(patch_shape[0]):
-                    pos = brain_patches.positions + np.array((x, y, z))
-                    zmap_smooth[zip(*pos)] += z_statistic * np.sqrt(n)
-                    counts[zip(*pos)] += n
+    #prop = np.zeros_like(brain.image, dtype=np.float32)
+    #prop[zip(*center_positions)] = p
 
-        #zmap_smooth[zip(*center_positions)] /= np.sqrt(counts2[zip(*center_positions)])
-        zmap_smooth /= np.sqrt(counts)
-        #zmap_smooth[zip(*center_positions)] /= np.sqrt(np.prod(patch_shape))
-        zmap_smooth[np.isnan(zmap_smooth)] = 0.
+    zmap = np.zeros_like(brain.image, dtype=np.float32)
+    zmap_smooth = np.zeros_like(brain.image, dtype=np.float32)
+    pmap = np.ones_like(brain.image, dtype=np.float32)
+    counts = np.zeros_like(brain.image, dtype=np.float32)
 
-        zmap[zip(*center_positions)] = z_statistic
-        zmap[np.isnan(zmap)] = 0.
+    # Patches composite z-scores
+    # see https://en.wikipedia.org/wiki/Fisher%27s_method#Relation_to_Stouffer.27s_Z-score_method
+    for z in range(patch_shape[2]):
+        for y in range(patch_shape[1]):
+            for x in range(patch_shape[0]):
+                pos = brain_patches.positions + np.array((x, y, z))
+                zmap_smooth[zip(*pos)] += z_statistic * np.sqrt(n)
+                counts[zip(*pos)] += n
 
-        import scipy.stats as stat
-        pmap = 2 * stat.norm.cdf(-abs(zmap_smooth))  # Two-tailed test, take twice the lower tail.
-        pmap[np.isnan(pmap)] = 1.
+    #zmap_smooth[zip(*center_positions)] /= np.sqrt(counts2[zip(*center_positions)])
+    zmap_smooth /= np.sqrt(counts)
+    #zmap_smooth[zip(*center_positions)] /= np.sqrt(np.prod(patch_shape))
+    zmap_smooth[np.isnan(zmap_smooth)] = 0.
 
-        #pmap[zip(*center_positions)] = pvalue
-        #pmap[np.isnan(pmap)] = 1.
-        counts = np.zeros_like(brain.image, dtype=np.float32)
-        counts[zip(*center_positions)] = n
-
-        results_folder = pjoin('.', 'results', brain_db.name, brain_data.name)
-        if use_dist:
-            results_folder = pjoin('.', 'results', brain_db.name, brain_data.name, "distance_weighting")
+    zmap[zip(*center_positions)] = z_statistic
+    zmap[np.isnan(zmap)] = 0.
 
-        if not os.path.isdir(results_folder):
-            os.makedirs(results_folder)
-
-        save_nifti(brain.image, brain.infos['affine'], pjoin(results_folder, "{}.nii.gz".format(brain.name)))
-        #save_nifti(prop, brain.infos['affine'], pjoin(results_folder, "{}_prop.nii.gz".format(brain.name)))
-        save_nifti(pmap, brain.infos['affine'], pjoin(results_folder, "{}_pmap.nii.gz".format(brain.name)))
-        #save_nifti(1-pmap, brain.infos['affine'], pjoin(results_folder, "{}_pmap_inv.nii.gz".format(brain.name)))
-        save_nifti(zmap, brain.infos['affine'], pjoin(results_folder, "{}_zmap.nii.gz".format(brain.name)))
-        save_nifti(zmap_smooth, brain.infos['affine'], pjoin(results_folder, "{}_zmap_smooth.nii.gz".format(brain.name)))
-        save_nifti(counts, brain.infos['affine'], pjoin(results_folder, "{}_count.nii.gz".format(brain.name)))
-        #np.savez(pjoin(results_folder, name), dists=ndists, labels=nlabels, ids=nids, positions=npositions, voxels_positions=center_positions)
-
-        from ipdb import set_trace as dbg
-        dbg()
-
-
-def create_proximity_map(brain_manager, name, brain_data, K=100, threshold=np.inf, min_nonempty=0, spatial_weight=0.):
+    import scipy.stats as stat
+    pmap = 2 * stat.norm.cdf(-abs(zmap_smooth))  # Two-tailed test, take twice the lower tail.
+    pmap[np.isnan(pmap)] = 1.
+
+    #pmap[zip(*center_positions)] = pvalue
+    #pmap[np.isnan(pmap)] = 1.
+    counts = np.zeros_like(brain.image, dtype=np.float32)
+    counts[zip(*center_positions)] = n
+
+    results_folder = pjoin('.', 'results', brain_db.name, brain_data_name)
+    if use_dist:
+        results_folder = pjoin('.', 'results', brain_db.name, brain_data_name, "distance_weighting")
+    elif mode == "bucket-vote":
+        results_folder = pjoin('.', 'results', brain_db.name, brain_data_name, "bucket_vote")
+
+    try:
+        os.makedirs(results_folder)
+    except OSError:
+        if not os.path.isdir(results_folder):  # Otherwise created meanwhile by another worker.
+            raise
+
+    save_nifti(brain.image, brain.infos['affine'], pjoin(results_folder, "{}.nii.gz".format(brain.name)))
+    #save_nifti(prop, brain.infos['affine'], pjoin(results_folder, "{}_prop.nii.gz".format(brain.name)))
+    save_nifti(pmap, brain.infos['affine'], pjoin(results_folder, "{}_pmap.nii.gz".format(brain.name)))
+    #save_nifti(1-pmap, brain.infos['affine'], pjoin(results_folder, "{}_pmap_inv.nii.gz".format(brain.name)))
+    save_nifti(zmap, brain.infos['affine'], pjoin(results_folder, "{}_zmap.nii.gz".format(brain.name)))
+    save_nifti(zmap_smooth, brain.infos['affine'], pjoin(results_folder, "{}_zmap_smooth.nii.gz".format(brain.name)))
+    save_nifti(counts, brain.infos['affine'], pjoin(results_folder, "{}_count.nii.gz".format(brain.name)))
+    #np.savez(pjoin(results_folder, name), dists=ndists, labels=nlabels, ids=nids, positions=npositions, voxels_positions=center_positions)
+
+
+def create_proximity_map(brain_manager, name, brain_data, K=100, threshold=np.inf, min_nonempty=0, spatial_weight=0.,
+                         weighting="1-dist", alpha=20000.):
     brain_db = brain_manager[name.strip("/").split("/")[-1]]
     if brain_db is None:
         raise ValueError("Unexisting brain database: " + name)
 
     patch_shape = brain_db.metadata['patch'].shape
 
-    brain_db.engine.distance = EuclideanDistance(brain_db.metadata['patch'])
-
     # TODO: find how to compute a good threshood :/ ?!?
-    brain_db.engine.filters = [DistanceThresholdFilter(threshold), NearestFilter(K)]
     half_patch_size = np.array(patch_shape) // 2
 
     print "Found {} brains/regions for wich to compute a proximity-map".format(len(brain_data))
@@ -431,43 +765,17 @@ def create_proximity_map(brain_manager, name, brain_data, K=100, threshold=np.in
         brain_patches = brain.extract_patches(patch_shape, min_nonempty=min_nonempty)
         vectors = brain_patches.create_vectors(spatial_weight=spatial_weight)
 
-        #nids = -1 * np.ones((len(brain_patches), K), dtype=np.uint8)  # No more than 256, okay for now,
-        #nlabels = -1 * np.ones((len(brain_patches), K), dtype=np.uint8)
-        ndists = -1 * np.ones((len(brain_patches), K), dtype=np.float32)
-        npositions = -1 * np.ones((len(brain_patches), K, 3), dtype=np.uint16)
-
-        center_positions = brain_patches.positions + half_patch_size
-
         start_brain = time.time()
-        for patch_id, neighbors in brain_db.get_neighbors(vectors, brain_patches.patches, attributes=["id", "label", "position"]):
-        #for patch_id, neighbors in brain_db.get_neighbors(vectors, brain_patches.patches, attributes=["label"]):
-            ndists[patch_id, :len(neighbors['dist'])] = neighbors['dist'].flatten()
-            #nlabels[patch_id, :len(neighbors['label'])] = neighbors['label'].flatten()
-            #nids[patch_id, :len(neighbors['id'])] = neighbors['id'].flatten()
-            npositions[patch_id, :len(neighbors['position']), :] = neighbors['position']
-
-            #if np.any(np.all(neighbors['position']+half_patch_size == (130, 41, 34), axis=1)):
-            #  from ipdb import set_trace; set_trace()
+        neighbors = brain_db.get_neighbors_dense(vectors, brain_patches.patches, ["position"], k=K, threshold=threshold)
+        found = np.isfinite(neighbors['dist'])
 
-        print "{4}. Brain #{0} ({3:,} patches) found {1:,} neighbors in {2:.2f} sec.".format(brain.id, np.sum(ndists != -1), time.time()-start_brain, len(brain_patches), i)
-        print "Patches with no neighbors: {:,}".format(np.all(ndists == -1, axis=1).sum())
+        print "{4}. Brain #{0} ({3:,} patches) found {1:,} neighbors in {2:.2f} sec.".format(brain.id, np.sum(found), time.time()-start_brain, len(brain_patches), i)
+        print "Patches with no neighbors: {:,}".format(np.sum(~np.any(found, axis=1)))
 
         ## Generate proximity-map ##
-        positions = npositions.reshape((-1, 3))
-        idx_to_keep = np.where(positions[:, 0] != -1)[0]
-        positions = positions[idx_to_keep]
-        distances = ndists.flatten()
-        distances = distances[idx_to_keep]
-
         # Position of extracted patches represent to top left corner.
-        center_positions = positions + half_patch_size
-
-        #proxmap = np.nan * np.ones_like(brain.image, dtype=int)
-        proxmap = np.zeros_like(brain.image, dtype=np.float32)
-        for (x, y, z), dist in zip(center_positions, distances):
-            #proxmap[x, y, z] += 1
-            proxmap[x, y, z] += 1-dist
-            #proxmap[x, y, z] += np.exp(-20000*dist)
+        proxmap = maps.proximity_map(brain.image.shape, neighbors['position'], neighbors['dist'], offset=half_patch_size,
+                                     weighting=weighting, alpha=alpha)
 
         results_folder = pjoin('.', 'results', brain_db.name, brain_data.name)
         if not os.path.isdir(results_folder):
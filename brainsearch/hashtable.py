@@ -0,0 +1,145 @@
+import hashlib
+
+import numpy as np
+
+# Multiplier of Fibonacci hashing (2^64 divided by the golden ratio).
+_FIBONACCI = np.uint64(0x9E3779B97F4A7C15)
+# Longest binary keys converted to their value rather than hashed.
+MAX_BINARY_LENGTH = 62
+
+
+def key_codes(bucketkeys):
+    """ uint64 codes of bucket keys.
+
+    Integer keys are kept as is. Binary keys (strings of '0' and '1', at
+    most 62 bits) are converted all at once: the code is the binary number
+    prefixed with a 1 bit, so keys of different lengths get different
+    codes. Other keys (e.g. sub-buckets of split buckets) are hashed.
+    """
+    bucketkeys = np.asarray(bucketkeys)
+    if len(bucketkeys) == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    if bucketkeys.dtype.kind in "iu":
+        return bucketkeys.astype(np.uint64).ravel()
+
+    bucketkeys = bucketkeys.astype(str)
+    width = bucketkeys.dtype.itemsize
+    chars = bucketkeys.view(np.uint8).reshape((len(bucketkeys), width))
+    lengths = np.sum(chars != 0, axis=1)
+    binary = np.all((chars == ord('0')) | (chars == ord('1')) | (chars == 0), axis=1) & (lengths <= MAX_BINARY_LENGTH)
+
+    # Bits of a key as the most significant ones of a word, then shifted down.
+    bits = np.zeros((len(bucketkeys), 64), dtype=bool)
+    bits[:, :min(width, 64)] = chars[:, :64] == ord('1')
+    words = np.packbits(bits, axis=1).view(">u8").astype(np.uint64).ravel()
+    shifts = np.minimum(64 - lengths, 63).astype(np.uint64)
+    codes = np.where(lengths > 0, words >> shifts, np.uint64(0)).astype(np.uint64)
+    codes |= np.uint64(1) << np.minimum(lengths, MAX_BINARY_LENGTH).astype(np.uint64)
+
+    # Hashed keys have their highest bit set, binary ones never do.
+    for i in np.flatnonzero(~binary):
+        digest = hashlib.md5(bucketkeys[i]).digest()[:8]
+        codes[i] = np.frombuffer(digest, dtype=">u8").astype(np.uint64)[0] | np.uint64(1 << 63)
+
+    return codes
+
+
+class HashTable(object):
+    """ Open-addressing hash table of uint64 codes, built on NumPy arrays.
+
+    Every code inserted is given the next integer (0, 1, 2, ...). Collisions
+    are resolved by linear probing, and lookups and inserts of a whole batch
+    of codes are vectorized: all codes are probed at once, one slot further
+    for those not resolved yet. The table doubles once half full.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        Initial number of slots (a power of 2).
+    """
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.nbits = max(int(capacity - 1).bit_length(), 1)
+        self.slot_codes = np.zeros(2**self.nbits, dtype=np.uint64)
+        self.slot_values = -np.ones(2**self.nbits, dtype=np.int64)
+
+    def __len__(self):
+        return self.size
+
+    def _slots(self, codes):
+        return ((codes * _FIBONACCI) >> np.uint64(64 - self.nbits)).astype(np.int64)
+
+    def lookup(self, codes):
+        """ Values of `codes`, -1 for codes not in the table. """
+        codes = np.asarray(codes, dtype=np.uint64).ravel()
+        values = -np.ones(len(codes), dtype=np.int64)
+        slots = self._slots(codes)
+        mask = len(self.slot_values) - 1
+
+        pending = np.arange(len(codes))
+        while len(pending) > 0:
+            filled = self.slot_values[slots] >= 0
+            found = filled & (self.slot_codes[slots] == codes[pending])
+            values[pending[found]] = self.slot_values[slots[found]]
+
+            # An empty slot ends the probing: the code is absent.
+            unresolved = filled & ~found
+            pending = pending[unresolved]
+            slots = (slots[unresolved] + 1) & mask
+
+        return values
+
+    def insert(self, codes):
+        """ Values of `codes`, adding the ones not in the table yet. """
+        codes = np.asarray(codes, dtype=np.uint64).ravel()
+        uniques, firsts, inverse = np.unique(codes, return_index=True, return_inverse=True)
+        values = self.lookup(uniques)
+
+        # New codes get their value in order of first appearance.
+        new = np.flatnonzero(values < 0)
+        new = new[np.argsort(firsts[new])]
+        if len(new) > 0:
+            values[new] = self.size + np.arange(len(new))
+            if 2 * (self.size + len(new)) > len(self.slot_values):
+                self._resize(2 * (self.size + len(new)))
+
+            self._place(uniques[new], values[new])
+            self.size += len(new)
+
+        return values[inverse]
+
+    def codes(self):
+        """ Codes of the table, ordered by value. """
+        filled = np.flatnonzero(self.slot_values >= 0)
+        codes = np.zeros(self.size, dtype=np.uint64)
+        codes[self.slot_values[filled]] = self.slot_codes[filled]
+        return codes
+
+    def _resize(self, capacity):
+        filled = np.flatnonzero(self.slot_values >= 0)
+        codes, values = self.slot_codes[filled], self.slot_values[filled]
+        self._allocate(capacity)
+        self._place(codes, values)
+
+    def _place(self, codes, values):
+        # `codes` are distinct and none of them is in the table.
+        slots = self._slots(codes)
+        mask = len(self.slot_values) - 1
+
+        pending = np.arange(len(codes))
+        while len(pending) > 0:
+            # Among codes probing the same free slot, the first one takes it.
+            _, first = np.unique(slots, return_index=True)
+            placed = np.zeros(len(pending), dtype=bool)
+            placed[first] = True
+            placed &= self.slot_values[slots] < 0
+
+            self.slot_codes[slots[placed]] = codes[pending[placed]]
+            self.slot_values[slots[placed]] = values[pending[placed]]
+
+            pending = pending[~placed]
+            slots = (slots[~placed] + 1) & mask
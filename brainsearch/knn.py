@@ -0,0 +1,202 @@
+from __future__ import division
+
+import numpy as np
+
+
+def squared_norms(X):
+    X = X.reshape((len(X), -1))
+    return np.einsum('ij,ij->i', X, X)
+
+
+def squared_distances(queries, dataset, dataset_sqnorms=None):
+    """ Squared euclidean distance between every query and every dataset row.
+
+    Computed as ||q||^2 - 2*q.x + ||x||^2 so the bulk of the work is a single
+    matrix product (i.e. BLAS's GEMM).
+
+    Parameters
+    ----------
+    queries : 2D array (nb_queries, dim)
+    dataset : 2D array (nb_rows, dim)
+    dataset_sqnorms : 1D array (nb_rows,), optional
+        Precomputed squared norms of the dataset rows.
+
+    Returns
+    -------
+    distances : 2D array (nb_queries, nb_rows)
+    """
+    queries = queries.reshape((len(queries), -1))
+    dataset = dataset.reshape((len(dataset), -1))
+    if dataset_sqnorms is None:
+        dataset_sqnorms = squared_norms(dataset)
+
+    distances = np.dot(queries, dataset.T)
+    distances *= -2
+    distances += squared_norms(queries)[:, None]
+    distances += dataset_sqnorms[None, :]
+    np.maximum(distances, 0, out=distances)  # Rounding errors.
+    return distances
+
+
+def shortlist_squared_distances(queries, dataset, shortlist):
+    """ Squared euclidean distance between every query and its own subset of dataset rows.
+
+    Parameters
+    ----------
+    queries : 2D array (nb_queries, dim)
+    dataset : 2D array (nb_rows, dim)
+    shortlist : 2D int array (nb_queries, nb_shortlisted)
+        Rows of the dataset to compare every query with.
+
+    Returns
+    -------
+    distances : 2D array (nb_queries, nb_shortlisted)
+    """
+    queries = queries.reshape((len(queries), -1))
+    dataset = dataset.reshape((len(dataset), -1))
+    differences = dataset[shortlist] - queries[:, None, :]
+    return np.einsum('ijk,ijk->ij', differences, differences)
+
+
+def top_k(distances, k):
+    """ Column indices of the `k` smallest distances of every row, sorted. """
+    k = min(k, distances.shape[1])
+    rows = np.arange(len(distances))[:, None]
+    if k == 0:
+        return np.zeros((len(distances), 0), dtype=int)
+    elif k < distances.shape[1]:
+        indices = np.argpartition(distances, k-1, axis=1)[:, :k]
+    else:
+        indices = np.tile(np.arange(k), (len(distances), 1))
+
+    order = np.argsort(distances[rows, indices], axis=1)
+    return indices[rows, order]
+
+
+def merge_top_k(k, dists, **attributes):
+    """ Merges several lists of neighbors into a single top-K list.
+
+    Parameters
+    ----------
+    k : int
+        Number of neighbors to keep.
+    dists : list of 2D arrays (nb_queries, k_i)
+        Distances of every list of neighbors (NaN/inf for missing ones).
+    **attributes : lists of arrays (nb_queries, k_i, ...)
+        Attributes of the neighbors, aligned with `dists`.
+
+    Returns
+    -------
+    dists : 2D array (nb_queries, k)
+    attributes : dict of arrays (nb_queries, k, ...)
+    """
+    dists = np.concatenate(dists, axis=1)
+    best = top_k(dists, k)
+    rows = np.arange(len(dists))[:, None]
+    merged = dict((name, np.concatenate(values, axis=1)[rows, best]) for name, values in attributes.items())
+    return dists[rows, best], merged
+
+
+def patch_uids(ids, positions):
+    """ Unique identifiers of patches given their brain id and position.
+
+    Coordinates must be smaller than 1024. Missing patches (id of -1) get a
+    negative identifier.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    uids = ids << 30
+    for axis in range(positions.shape[-1]):
+        uids |= positions[..., axis] << (10 * (positions.shape[-1] - axis - 1))
+
+    uids[ids < 0] = -1
+    return uids
+
+
+def recall_at_k(found_uids, true_uids):
+    """ Proportion of the true nearest neighbors that were found, per query. """
+    recalls = np.zeros(len(true_uids), dtype=np.float32)
+    for i, (found, true) in enumerate(zip(found_uids, true_uids)):
+        true = true[true >= 0]
+        if len(true) > 0:
+            recalls[i] = np.in1d(true, found).mean()
+
+    return recalls
+
+
+class ExactKNN(object):
+    """ Exact k-nearest neighbors of a set of queries, by brute force.
+
+    Datasets can be given in several calls to `update` (e.g. brain by brain).
+    Distances between a block of queries and a block of dataset rows are
+    computed with a matrix product (see `squared_distances`) and a running
+    top-K per query is maintained with `argpartition` as blocks go by. Query
+    blocks are processed by parallel threads (BLAS releases the GIL).
+
+    Being exact, it serves as ground truth for approximate (LSH) searches.
+
+    Parameters
+    ----------
+    queries : 2D array (nb_queries, dim)
+    k : int
+        Number of neighbors to find per query.
+    query_block_size : int, optional
+    dataset_block_size : int, optional
+        Bound the memory used by a block of distances to
+        query_block_size*dataset_block_size floats per thread.
+    nb_threads : int, optional
+    """
+    def __init__(self, queries, k, query_block_size=1024, dataset_block_size=16384, nb_threads=1):
+        self.queries = queries.reshape((len(queries), -1))
+        self.k = k
+        self.query_block_size = query_block_size
+        self.dataset_block_size = dataset_block_size
+        self.nb_threads = nb_threads
+
+        self.sqdists = np.inf * np.ones((len(queries), k), dtype=np.float32)
+        self.attributes = {}
+
+    @property
+    def dists(self):
+        return np.sqrt(self.sqdists)
+
+    def update(self, dataset, **attributes):
+        """ Looks for nearest neighbors in `dataset`.
+
+        Attributes (arrays aligned with `dataset`'s rows) of the nearest
+        neighbors are kept in `self.attributes`.
+        """
+        dataset = dataset.reshape((len(dataset), -1))
+        sqnorms = squared_norms(dataset)
+
+        for name, values in attributes.items():
+            if name not in self.attributes:
+                self.attributes[name] = np.empty((len(self.queries), self.k) + values.shape[1:], dtype=values.dtype)
+                self.attributes[name].fill(-1)
+
+        def _process(start):
+            end = min(start + self.query_block_size, len(self.queries))
+            queries = self.queries[start:end]
+            rows = np.arange(end-start)[:, None]
+
+            for offset in range(0, len(dataset), self.dataset_block_size):
+                block = slice(offset, offset + self.dataset_block_size)
+                sqdists = squared_distances(queries, dataset[block], sqnorms[block])
+                indices = top_k(sqdists, self.k)
+                neighbors = indices + offset
+
+                sqdists, merged = merge_top_k(self.k, [self.sqdists[start:end], sqdists[rows, indices]],
+                                              **dict((name, [self.attributes[name][start:end], values[neighbors]])
+                                                     for name, values in attributes.items()))
+                self.sqdists[start:end] = sqdists
+                for name, values in merged.items():
+                    self.attributes[name][start:end] = values
+
+        starts = range(0, len(self.queries), self.query_block_size)
+        if self.nb_threads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.nb_threads)
+            pool.map(_process, starts)
+            pool.close()
+        else:
+            map(_process, starts)
@@ -0,0 +1,68 @@
+from __future__ import division
+
+import numpy as np
+
+# How much a neighbor contributes to the proximity-map, given its distance.
+WEIGHTINGS = ["count", "1-dist", "exp"]
+
+
+def neighbor_weights(dists, weighting="1-dist", alpha=20000.):
+    """ Contribution of neighbors to a proximity-map.
+
+    Parameters
+    ----------
+    dists : array
+        Distances of the neighbors.
+    weighting : {'count', '1-dist', 'exp'}, optional
+        'count': every neighbor counts for 1; '1-dist': 1-dist;
+        'exp': exp(-alpha*dist).
+    alpha : float, optional
+        Decay of the 'exp' weighting.
+    """
+    dists = np.asarray(dists, dtype=np.float64)
+    if weighting == "count":
+        return np.ones_like(dists)
+    elif weighting == "1-dist":
+        return 1 - dists
+    elif weighting == "exp":
+        return np.exp(-alpha * dists)
+
+    raise ValueError("Unknown weighting: {} (choose among {}).".format(weighting, ", ".join(WEIGHTINGS)))
+
+
+def proximity_map(shape, positions, dists, offset=0, weighting="1-dist", alpha=20000., chunk_size=2**22):
+    """ Sums the weights of neighbors (see `neighbor_weights`) at their position.
+
+    Neighbors are accumulated chunk by chunk, as linear indices in the
+    volume counted with `np.bincount`, so at most `chunk_size` of them are
+    converted at once.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the volume.
+    positions : int array (..., ndim)
+        Positions of the neighbors (e.g. dense K-padded ones).
+    dists : float array (...)
+        Distances of the neighbors, NaN for missing ones.
+    offset : int or array (ndim,), optional
+        Added to every position (e.g. half a patch, to map patch centers).
+
+    Returns
+    -------
+    proxmap : float32 array of shape `shape`
+    """
+    dists = np.asarray(dists).ravel()
+    positions = np.asarray(positions).reshape((len(dists), len(shape)))
+    offset = np.asarray(offset, dtype=np.int64)
+
+    proxmap = np.zeros(int(np.prod(shape)), dtype=np.float64)
+    for start in range(0, len(dists), chunk_size):
+        chunk_dists = dists[start:start+chunk_size]
+        found = np.isfinite(chunk_dists)
+        coords = (positions[start:start+chunk_size][found].astype(np.int64) + offset).T
+        indices = np.ravel_multi_index(tuple(coords), shape)
+        weights = neighbor_weights(chunk_dists[found], weighting, alpha)
+        proxmap += np.bincount(indices, weights=weights, minlength=len(proxmap))
+
+    return proxmap.reshape(shape).astype(np.float32)
@@ -0,0 +1,84 @@
+import itertools
+import numpy as np
+
+# Probes are chosen among the subsets of the MAX_PROBED_BITS least confident
+# bits of a hash code (i.e. at most 2**MAX_PROBED_BITS-1 perturbations).
+MAX_PROBED_BITS = 10
+
+
+def projection_margins(lhash, vectors):
+    """ Confidence of every bit of the hash codes of `vectors`.
+
+    The margin of a bit is the absolute value of the projection whose sign
+    gave that bit. Hashes that do not expose their projections get the same
+    margin for every bit, multi-probing then visits codes by increasing
+    Hamming distance.
+    """
+    vectors = np.asarray(vectors).reshape((len(vectors), -1))
+    if hasattr(lhash, "project"):
+        projections = lhash.project(vectors)
+    elif hasattr(lhash, "normals"):
+        projections = np.dot(vectors, np.asarray(lhash.normals).T)
+    else:
+        return None
+
+    return np.abs(projections)
+
+
+def perturbations(margins, nb_probes):
+    """ Finds, for every code, the `nb_probes` sets of bits to flip.
+
+    Sets are ranked by the sum of the margins of their bits, so the first
+    probes flip the least confident bits of a code.
+
+    Parameters
+    ----------
+    margins : 2D array (nb_codes, nbits)
+        Confidence of every bit of every code.
+    nb_probes : int
+        Number of probes to generate per code.
+
+    Returns
+    -------
+    flips : 3D boolean array (nb_codes, nb_probes, nbits)
+        flips[i, j] is the mask of the bits to flip for the j-th probe of code i.
+    """
+    nb_codes, nbits = margins.shape
+    nb_candidates = min(nbits, nb_probes, MAX_PROBED_BITS)
+
+    # Least confident bits first.
+    least_confident = np.argsort(margins, axis=1)[:, :nb_candidates]
+    sorted_margins = margins[np.arange(nb_codes)[:, None], least_confident]
+
+    # All non-empty subsets of the candidate bits.
+    subsets = np.array(list(itertools.product([0, 1], repeat=nb_candidates))[1:], dtype=margins.dtype)
+    scores = np.dot(sorted_margins, subsets.T)
+    scores += np.sum(subsets, axis=1) * 1e-6  # Prefer flipping fewer bits on ties.
+
+    nb_probes = min(nb_probes, len(subsets))
+    best = np.argsort(scores, axis=1)[:, :nb_probes]
+
+    flips = np.zeros((nb_codes, nb_probes, nbits), dtype=bool)
+    rows = np.arange(nb_codes)[:, None, None]
+    chosen = subsets[best].astype(bool)  # (nb_codes, nb_probes, nb_candidates)
+    flips[rows, np.arange(nb_probes)[None, :, None], least_confident[:, None, :]] = chosen
+    return flips
+
+
+def flip_key(key, flip):
+    """ Flips the bits of a bucket key (a string ending with its binary code). """
+    nbits = len(flip)
+    code = np.array(list(key[-nbits:])) == '1'
+    code ^= flip
+    return key[:-nbits] + "".join('1' if bit else '0' for bit in code)
+
+
+def probe_keys(lhash, vectors, keys, nb_probes):
+    """ Bucket keys to probe, after the exact ones, for every vector. """
+    margins = projection_margins(lhash, vectors)
+    if margins is None:
+        nbits = len(keys[0]) if len(keys) > 0 else 0
+        margins = np.ones((len(keys), nbits), dtype=np.float32)
+
+    flips = perturbations(margins, nb_probes)
+    return [[flip_key(key, flip) for flip in code_flips] for key, code_flips in zip(keys, flips)]
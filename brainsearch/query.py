@@ -0,0 +1,337 @@
+from __future__ import division
+
+import numpy as np
+from collections import defaultdict
+
+from brainsearch import knn
+from brainsearch import codes
+from brainsearch import probing
+from brainsearch import spatial
+
+
+def fill_value(dtype):
+    return np.nan if np.issubdtype(dtype, np.floating) else -1
+
+
+def table_bucketkeys(lshashes, tables_keys):
+    """ Bucket keys of every hash table in the table's own namespace.
+
+    Every table shares the storage of its brain database, the same key of
+    two tables must not end up in the same bucket. Keys of databases with a
+    single table are left as is.
+    """
+    if len(lshashes) == 1:
+        return [list(keys) for keys in tables_keys]
+
+    return [[lhash.name + "_" + key for key in keys] for lhash, keys in zip(lshashes, tables_keys)]
+
+
+def iter_neighbors(neighbors):
+    """ Yields (patch_id, neighbors) pairs out of dense, K-padded, results. """
+    counts = np.sum(np.isfinite(neighbors['dist']), axis=1)
+    for patch_id, count in enumerate(counts):
+        yield patch_id, dict((name, values[patch_id, :count]) for name, values in neighbors.items())
+
+
+class QueryPlanner(object):
+    """ Resolves a batch of queries bucket by bucket.
+
+    Queries are grouped by the set of buckets they have to look at (exact
+    bucket of every hash table, plus probed buckets if any). Every distinct
+    bucket is fetched once per batch, and the distances between the
+    queries of a group and their candidates are computed with matrix
+    products followed by partial sorts.
+
+    Parameters
+    ----------
+    brain_db : `BrainDatabase` object
+    k : int
+        Number of neighbors to return per query.
+    threshold : float, optional
+        Only keep neighbors closer than this distance.
+    probes : int, optional
+        Number of nearby codes to probe per table if less than `k`
+        candidates were found in the exact buckets.
+    radius : float, optional
+        Only keep neighbors whose position is within this distance (in
+        voxels) of the query's position. Candidates of a bucket are then
+        indexed by a coarse spatial grid and queries only look at the cells
+        overlapping their search sphere.
+    batch_size : int, optional
+        Number of queries sharing a bucket cache. Queries are sorted by
+        bucket before being batched, so neighboring patches end up together.
+    exclude_ids : list of int, optional
+        Patches of these brains are never returned. They are dropped from the
+        candidates, so every query still gets K neighbors when possible.
+    rerank : int, optional
+        If the brain database stores binary codes of its patches, only the
+        `rerank` candidates of a query closest in Hamming distance get their
+        euclidean distance computed (0: every candidate does).
+    query_block_size : int, optional
+    candidate_block_size : int, optional
+        Bound the memory used by distances to query_block_size*candidate_block_size
+        values: queries and their candidates are compared a block at a time,
+        keeping a running top-K per query.
+    """
+    def __init__(self, brain_db, k, threshold=np.inf, probes=0, radius=None, batch_size=10000, exclude_ids=None,
+                 rerank=0, query_block_size=1024, candidate_block_size=16384):
+        self.brain_db = brain_db
+        self.k = k
+        self.threshold = threshold
+        self.probes = probes
+        self.radius = radius
+        self.batch_size = batch_size
+        self.exclude_ids = tuple(sorted(set(int(i) for i in np.ravel(exclude_ids if exclude_ids is not None else []))))
+        self.rerank = max(rerank, k) if rerank > 0 else 0
+        self.query_block_size = query_block_size
+        self.candidate_block_size = candidate_block_size
+
+        # Some stats about the last execution.
+        self.nb_buckets_fetched = 0
+        self.nb_candidates = 0
+
+    def bucketkeys(self, vectors, patches):
+        """ Buckets to look at, round by round: one bucket per table per round.
+
+        Returns a list where rounds[r][i] is the tuple of bucket keys (one per
+        hash table) query i looks at during round r. Round 0 contains the
+        exact buckets, the following ones the probed buckets.
+        """
+        lshashes = self.brain_db.engine.lshashes
+        tables_keys = [lhash.hash_vector(vectors) for lhash in lshashes]
+        rounds = [table_bucketkeys(lshashes, tables_keys)]
+        if self.probes > 0 and len(vectors) > 0:
+            # tables_probes[t][i][j]: j-th probe of the i-th query in table t.
+            tables_probes = [probing.probe_keys(lhash, vectors, keys, self.probes)
+                             for lhash, keys in zip(lshashes, tables_keys)]
+            for j in range(len(tables_probes[0][0])):
+                probed_keys = [[probes_keys[j] for probes_keys in table_probes] for table_probes in tables_probes]
+                rounds.append(table_bucketkeys(lshashes, probed_keys))
+
+        # Split buckets are followed down to the sub-bucket of every query.
+        return [zip(*[self.brain_db.resolve(keys, patches) for keys in round_keys]) for round_keys in rounds]
+
+    def execute(self, vectors, patches, attributes, positions=None, query_exclude_ids=None):
+        """ Finds the neighbors of every query.
+
+        `positions` of the queries are required when a radius is used.
+        `query_exclude_ids` lists, for every query, brains excluded for this
+        query only (on top of `exclude_ids`).
+
+        Returns
+        -------
+        neighbors : dict
+            Maps 'dist' and every attribute's name to an array of shape
+            (nb_queries, k, ...) padded with NaN (float) or -1 (int).
+        """
+        if self.radius is not None and positions is None:
+            raise ValueError("Positions of the queries are needed to search within a radius.")
+
+        metadata = self.brain_db.metadata
+        patches = patches.reshape((len(patches), -1))
+        rounds = self.bucketkeys(vectors, patches)
+
+        neighbors = {'dist': np.nan * np.ones((len(patches), self.k), dtype=np.float32)}
+        for name in attributes:
+            shape = tuple(s for s in metadata[name].shape if s != 1)
+            neighbors[name] = np.empty((len(patches), self.k) + shape, dtype=metadata[name].dtype)
+            neighbors[name].fill(fill_value(metadata[name].dtype))
+
+        self.nb_buckets_fetched = 0
+        self.nb_candidates = 0
+
+        query_codes = None
+        if self.rerank > 0 and 'code' in metadata:
+            query_codes = self.brain_db.coder.encode(patches)
+
+        excluded = [self.exclude_ids] * len(patches)
+        if query_exclude_ids is not None:
+            # Queries usually come in runs excluding the same brains.
+            merged = {}
+            excluded = []
+            for ids in query_exclude_ids:
+                ids = tuple(ids)
+                if ids not in merged:
+                    merged[ids] = tuple(sorted(set(self.exclude_ids) | set(int(i) for i in ids)))
+
+                excluded.append(merged[ids])
+
+        order = sorted(range(len(patches)), key=lambda i: rounds[0][i])
+        for start in range(0, len(order), self.batch_size):
+            self._execute_batch(np.array(order[start:start+self.batch_size]), patches, positions, rounds, attributes, neighbors,
+                                excluded, query_codes)
+
+        return neighbors
+
+    def _fetch(self, bucketkeys, names, cache):
+        bucketkeys = list(bucketkeys)
+        if len(bucketkeys) == 0:
+            return
+
+        storage = self.brain_db.engine.storage
+        for name in names:
+            values = storage.retrieve(bucketkeys, attribute=self.brain_db.metadata[name])
+            for bucketkey, value in zip(bucketkeys, values):
+                cache[bucketkey][name] = value
+
+        self.nb_buckets_fetched += len(bucketkeys)
+
+    def _size(self, bucketkey, excluded, cache, sizes):
+        """ Number of patches of a bucket, patches of `excluded` brains left out. """
+        if (bucketkey, excluded) not in sizes:
+            ids = cache[bucketkey]['id']
+            sizes[bucketkey, excluded] = len(ids) - (np.sum(np.in1d(ids.ravel(), excluded)) if len(excluded) > 0 else 0)
+
+        return sizes[bucketkey, excluded]
+
+    def _candidates(self, bucketkeys, names, cache, excluded=()):
+        if len(bucketkeys) == 1:
+            candidates = cache[bucketkeys[0]]
+        else:
+            candidates = self._merge_candidates(bucketkeys, names, cache)
+
+        if len(excluded) > 0:
+            kept = np.logical_not(np.in1d(candidates['id'].ravel(), excluded))
+            if not np.all(kept):
+                candidates = dict((name, values[kept]) for name, values in candidates.items())
+
+        return candidates
+
+    def _merge_candidates(self, bucketkeys, names, cache):
+        candidates = dict((name, np.concatenate([cache[key][name] for key in bucketkeys])) for name in names)
+
+        # A patch can be found in several buckets (e.g. one per hash table).
+        uids = np.c_[candidates['id'].reshape((-1, 1)), candidates['position']]
+        _, indices = np.unique(uids, axis=0, return_index=True)
+        if len(indices) < len(uids):
+            indices.sort()
+            candidates = dict((name, values[indices]) for name, values in candidates.items())
+
+        return candidates
+
+    def _execute_batch(self, queries, patches, positions, rounds, attributes, neighbors, excluded, query_codes=None):
+        names = set(attributes) | set(['patch', 'id', 'position'])
+        if query_codes is not None:
+            names.add('code')
+
+        cache = defaultdict(dict)
+
+        # Gather the buckets of every query, probing until K candidates (not excluded) are found.
+        keysets = [[] for _ in queries]
+        counts = np.zeros(len(queries), dtype=np.int64)
+        sizes = {}
+        active = np.arange(len(queries))
+        for round_keys in rounds:
+            if len(active) == 0:
+                break
+
+            new_keys = set(key for i in active for key in round_keys[queries[i]]) - set(cache.keys())
+            self._fetch(new_keys, names, cache)
+            for i in active:
+                for key in round_keys[queries[i]]:
+                    keysets[i].append(key)
+                    counts[i] += self._size(key, excluded[queries[i]], cache, sizes)
+
+            active = active[counts[active] < self.k]
+
+        # Queries looking at the same buckets, and excluding the same brains, are resolved together.
+        groups = defaultdict(list)
+        for i, keys in enumerate(keysets):
+            groups[tuple(sorted(set(keys))), excluded[queries[i]]].append(i)
+
+        for (bucketkeys, excluded_ids), members in groups.items():
+            candidates = self._candidates(bucketkeys, names, cache, excluded_ids)
+            if len(candidates['id']) == 0:
+                continue
+
+            query_ids = queries[members]
+            if self.radius is None:
+                self._nearest(query_ids, patches, candidates, attributes, neighbors, query_codes=query_codes)
+                continue
+
+            # Queries of a same grid cell share the candidates of the cells around it.
+            grid = spatial.SpatialGrid(candidates['position'], cell_size=max(self.radius, 1))
+            for lower, upper, subset in spatial.group_by_cell(positions[query_ids], grid.cell_size):
+                rows = grid.query(lower, upper, self.radius)
+                if len(rows) > 0:
+                    subcandidates = dict((name, values[rows]) for name, values in candidates.items())
+                    self._nearest(query_ids[subset], patches, subcandidates, attributes, neighbors, positions, query_codes)
+
+    def _nearest(self, query_ids, patches, candidates, attributes, neighbors, positions=None, query_codes=None):
+        shortlisting = query_codes is not None and len(candidates['code']) > self.rerank
+        block_size = self.query_block_size
+        if shortlisting:
+            # Shortlisted patches of a block of queries are gathered, keep them within a block of values.
+            block_size = max(self.query_block_size * self.candidate_block_size // (self.rerank * patches.shape[1]), 1)
+
+        for start in range(0, len(query_ids), block_size):
+            block = query_ids[start:start+block_size]
+            block_positions = positions[block] if positions is not None else None
+            if shortlisting:
+                sqdists, indices = self._nearest_shortlisted(patches[block], query_codes[block], block_positions, candidates)
+            else:
+                sqdists, indices = self._nearest_blockwise(patches[block], block_positions, candidates)
+
+            self._store(block, sqdists, indices, candidates, attributes, neighbors)
+
+    def _too_far(self, positions, candidate_positions, shortlist=None):
+        positions = positions.astype(np.float64)
+        candidate_positions = candidate_positions.astype(np.float64)
+        if shortlist is None:
+            return knn.squared_distances(positions, candidate_positions) > self.radius**2
+
+        return knn.shortlist_squared_distances(positions, candidate_positions, shortlist) > self.radius**2
+
+    def _nearest_blockwise(self, patches, positions, candidates):
+        """ K nearest candidates of queries, candidates being compared a block at a time (see `knn.ExactKNN`). """
+        rows = np.arange(len(patches))[:, None]
+        sqdists = np.zeros((len(patches), 0), dtype=np.float32)
+        indices = np.zeros((len(patches), 0), dtype=np.int64)
+        for offset in range(0, len(candidates['patch']), self.candidate_block_size):
+            block = slice(offset, offset + self.candidate_block_size)
+            distances = knn.squared_distances(patches, candidates['patch'][block])
+            if positions is not None:
+                distances[self._too_far(positions, candidates['position'][block])] = np.inf
+
+            self.nb_candidates += distances.size
+            best = knn.top_k(distances, self.k)
+            sqdists, merged = knn.merge_top_k(self.k, [sqdists, distances[rows, best]], indices=[indices, best + offset])
+            indices = merged['indices']
+
+        return sqdists, indices
+
+    def _shortlist(self, query_codes, candidate_codes):
+        """ Candidates whose code is the closest to the query's, `rerank` per query. """
+        rows = np.arange(len(query_codes))[:, None]
+        hammings = np.zeros((len(query_codes), 0), dtype=np.int32)
+        shortlist = np.zeros((len(query_codes), 0), dtype=np.int64)
+        for offset in range(0, len(candidate_codes), self.candidate_block_size):
+            distances = codes.hamming_distances(query_codes, candidate_codes[offset:offset+self.candidate_block_size])
+            best = knn.top_k(distances, self.rerank)
+            hammings, merged = knn.merge_top_k(self.rerank, [hammings, distances[rows, best]], shortlist=[shortlist, best + offset])
+            shortlist = merged['shortlist']
+
+        return shortlist
+
+    def _nearest_shortlisted(self, patches, query_codes, positions, candidates):
+        """ K nearest candidates of queries among the ones closest in Hamming distance. """
+        shortlist = self._shortlist(query_codes, candidates['code'])
+        distances = knn.shortlist_squared_distances(patches, candidates['patch'], shortlist)
+        if positions is not None:
+            distances[self._too_far(positions, candidates['position'], shortlist)] = np.inf
+
+        self.nb_candidates += distances.size
+        rows = np.arange(len(patches))[:, None]
+        best = knn.top_k(distances, self.k)
+        return distances[rows, best], shortlist[rows, best]
+
+    def _store(self, query_ids, sqdists, indices, candidates, attributes, neighbors):
+        dists = np.sqrt(sqdists)
+        invalid = np.logical_not(dists < self.threshold)
+        nb_neighbors = indices.shape[1]
+        dists[invalid] = np.nan
+        neighbors['dist'][query_ids, :nb_neighbors] = dists
+        for name in attributes:
+            values = candidates[name][indices].reshape(indices.shape + neighbors[name].shape[2:])
+            values[invalid] = fill_value(values.dtype)
+            neighbors[name][query_ids, :nb_neighbors] = values
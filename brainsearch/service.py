@@ -0,0 +1,295 @@
+""" Long-running neighbor query service.
+
+A `QueryServer` keeps brain databases open and answers neighbor queries
+sent over a Unix or TCP socket. Concurrent requests are coalesced into
+micro-batches so the query planner resolves them together.
+
+Messages are pickled: only listen on sockets reachable by trusted clients.
+"""
+import time
+import socket
+import struct
+import cPickle as pickle
+import threading
+import SocketServer
+from Queue import Queue, Empty
+from collections import namedtuple, defaultdict
+
+import numpy as np
+
+Attribute = namedtuple("Attribute", ["name", "dtype", "shape"])
+
+HEADER = struct.Struct("!Q")
+
+
+def parse_address(address):
+    """ 'host:port' is a TCP address, anything else a Unix socket path. """
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        return (host, int(port))
+
+    return address
+
+
+def send_message(sock, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_message(sock):
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+
+    return pickle.loads(_recv_exactly(sock, HEADER.unpack(header)[0]))
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return "".join(chunks)
+
+
+class _PendingQuery(object):
+    def __init__(self, request):
+        self.request = request
+        self.result = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(threading.Thread):
+    """ Coalesces concurrent neighbor queries into micro-batches.
+
+    Waits at most `max_delay` seconds after the first pending query for
+    others to arrive (or until `max_batch_size` query patches are pending),
+    then resolves together the queries sharing a database and parameters.
+    Excluded brains are applied per query, they don't split batches.
+    """
+    def __init__(self, databases, max_delay=0.005, max_batch_size=100000):
+        super(MicroBatcher, self).__init__()
+        self.daemon = True
+        self.databases = databases
+        self.max_delay = max_delay
+        self.max_batch_size = max_batch_size
+        self.queue = Queue()
+
+        self.nb_batches = 0
+        self.nb_queries = 0
+
+    def submit(self, request):
+        pending = _PendingQuery(request)
+        self.queue.put(pending)
+        pending.done.wait()
+        return pending.result
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            nb_rows = len(batch[0].request['vectors'])
+            deadline = time.time() + self.max_delay
+            while nb_rows < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                    nb_rows += len(batch[-1].request['vectors'])
+                except Empty:
+                    break
+
+            self._process(batch)
+
+    def _process(self, batch):
+        groups = defaultdict(list)
+        for pending in batch:
+            request = pending.request
+            key = (request['name'], tuple(request['attributes']), request['k'], request['threshold'],
+                   request['probes'], request['radius'], request['positions'] is None)
+            groups[key].append(pending)
+
+        for (name, attributes, k, threshold, probes, radius, no_positions), group in groups.items():
+            try:
+                requests = [pending.request for pending in group]
+                vectors = np.concatenate([request['vectors'] for request in requests])
+                patches = np.concatenate([request['patches'] for request in requests])
+                positions = None if no_positions else np.concatenate([request['positions'] for request in requests])
+                query_exclude_ids = [request.get('exclude_ids') or [] for request in requests
+                                     for _ in range(len(request['vectors']))]
+
+                neighbors = self.databases[name].get_neighbors_dense(vectors, patches, list(attributes), k, threshold,
+                                                                     probes, positions, radius,
+                                                                     query_exclude_ids=query_exclude_ids)
+
+                offset = 0
+                for pending in group:
+                    size = len(pending.request['vectors'])
+                    pending.result = dict((key, values[offset:offset+size]) for key, values in neighbors.items())
+                    offset += size
+            except Exception as e:
+                for pending in group:
+                    pending.result = {'error': "{}: {}".format(type(e).__name__, e)}
+
+            self.nb_batches += 1
+            self.nb_queries += len(group)
+            for pending in group:
+                pending.done.set()
+
+
+class _QueryHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        while True:
+            request = recv_message(self.request)
+            if request is None:
+                break  # Client disconnected.
+
+            send_message(self.request, self.server.answer(request))
+
+
+class QueryServer(object):
+    """ Serves neighbor queries for already opened brain databases.
+
+    Parameters
+    ----------
+    databases : dict
+        Maps names to opened brain databases.
+    address : str
+        'host:port' to listen on TCP, otherwise path of a Unix socket.
+    max_delay : float, optional
+        Seconds to wait for concurrent queries to join a micro-batch.
+    max_batch_size : int, optional
+        Maximum number of query patches per micro-batch.
+    """
+    def __init__(self, databases, address, max_delay=0.005, max_batch_size=100000):
+        self.databases = databases
+        self.address = parse_address(address)
+        self.batcher = MicroBatcher(databases, max_delay=max_delay, max_batch_size=max_batch_size)
+
+        if isinstance(self.address, tuple):
+            server_class = SocketServer.ThreadingTCPServer
+        else:
+            server_class = SocketServer.ThreadingUnixStreamServer
+
+        server_class.allow_reuse_address = True
+        server_class.daemon_threads = True
+        self.server = server_class(self.address, _QueryHandler)
+        self.server.answer = self.answer
+
+    def describe(self, name):
+        brain_db = self.databases[name]
+        return {'name': name,
+                'metadata': dict((key, (value.dtype.str, tuple(value.shape))) for key, value in brain_db.metadata.items()),
+                'labels_count': brain_db.labels_count(),
+                'nb_patches': brain_db.nb_patches()}
+
+    def answer(self, request):
+        if request.get('name') not in self.databases:
+            return {'error': "Unknown database: '{}'".format(request.get('name'))}
+
+        if request['type'] == "describe":
+            return self.describe(request['name'])
+        elif request['type'] == "neighbors":
+            return self.batcher.submit(request)
+        elif request['type'] == "bucket_votes":
+            # No patch is retrieved, not worth batching.
+            try:
+                return {'votes': self.databases[request['name']].bucket_votes(request['vectors'], request['patches'],
+                                                                              request['exclude_ids'] or ())}
+            except Exception as e:
+                return {'error': "{}: {}".format(type(e).__name__, e)}
+
+        return {'error': "Unknown request type: '{}'".format(request['type'])}
+
+    def serve_forever(self):
+        self.batcher.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if not isinstance(self.address, tuple):
+                import os
+                if os.path.exists(self.address):
+                    os.remove(self.address)
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+class QueryClient(object):
+    """ Thin client of a `QueryServer`.
+
+    Brain databases served by the server are accessed by name, like with a
+    `BrainDatabaseManager`, and can be used by `framework.create_map`.
+    """
+    def __init__(self, address):
+        self.address = parse_address(address)
+        family = socket.AF_INET if isinstance(self.address, tuple) else socket.AF_UNIX
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(self.address)
+        self.lock = threading.Lock()
+
+    def request(self, message):
+        with self.lock:
+            send_message(self.sock, message)
+            answer = recv_message(self.sock)
+
+        if answer is None:
+            raise IOError("Connection closed by the query server.")
+
+        if 'error' in answer:
+            raise ValueError(answer['error'])
+
+        return answer
+
+    def __getitem__(self, name):
+        return RemoteBrainDatabase(self, name)
+
+    def close(self):
+        self.sock.close()
+
+
+class RemoteBrainDatabase(object):
+    """ Brain database served by a `QueryServer` (read-only). """
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+        description = client.request({'type': "describe", 'name': name})
+        self.metadata = dict((key, Attribute(key, np.dtype(dtype), shape))
+                             for key, (dtype, shape) in description['metadata'].items())
+        self._labels_count = description['labels_count']
+        self._nb_patches = description['nb_patches']
+
+    def nb_patches(self, check_integrity=False):
+        return self._nb_patches
+
+    def labels_count(self, check_integrity=False):
+        return self._labels_count
+
+    def label_proportions(self, check_integrity=False):
+        labels_count = np.asarray(self._labels_count, dtype=np.float32)
+        return labels_count / labels_count.sum()
+
+    def get_neighbors(self, vectors, patches, attributes=None, k=None, threshold=None, probes=0, positions=None, radius=None,
+                      exclude_ids=None):
+        from brainsearch.query import iter_neighbors
+        if attributes is None:
+            attributes = ['patch', 'label', 'position', 'id']
+
+        return iter_neighbors(self.get_neighbors_dense(vectors, patches, attributes, k, threshold, probes, positions, radius, exclude_ids))
+
+    def get_neighbors_dense(self, vectors, patches, attributes, k=None, threshold=None, probes=0, positions=None, radius=None,
+                            exclude_ids=None):
+        return self.client.request({'type': "neighbors", 'name': self.name,
+                                    'vectors': vectors, 'patches': patches, 'positions': positions,
+                                    'attributes': list(attributes), 'k': k, 'threshold': threshold,
+                                    'probes': probes, 'radius': radius,
+                                    'exclude_ids': list(exclude_ids) if exclude_ids is not None else None})
+
+    def bucket_votes(self, vectors, patches, exclude_ids=()):
+        return self.client.request({'type': "bucket_votes", 'name': self.name,
+                                    'vectors': vectors, 'patches': patches,
+                                    'exclude_ids': list(exclude_ids)})['votes']
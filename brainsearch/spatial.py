@@ -0,0 +1,94 @@
+from __future__ import division
+
+import numpy as np
+
+
+def group_by_cell(positions, cell_size):
+    """ Groups positions by the grid cell they fall in.
+
+    Yields (lower, upper, indices) where [lower, upper] is the bounding box of
+    the cell and `indices` the rows of `positions` falling in it.
+    """
+    positions = np.asarray(positions).reshape((len(positions), -1))
+    cells = positions // cell_size
+    _, inverse = np.unique(cells, axis=0, return_inverse=True)
+    order = np.argsort(inverse, kind="mergesort")
+    boundaries = np.flatnonzero(np.diff(inverse[order])) + 1
+    for indices in np.split(order, boundaries):
+        if len(indices) > 0:
+            lower = cells[indices[0]] * cell_size
+            yield lower, lower + cell_size - 1, indices
+
+
+class SpatialGrid(object):
+    """ Partitions positions into a coarse grid of cubic cells.
+
+    Rows are sorted by cell so the rows of a cell are contiguous, which
+    makes gathering the rows of a handful of cells cheap.
+
+    Parameters
+    ----------
+    positions : 2D array (nb_rows, nb_dims)
+        Integer positions (e.g. voxel coordinates) to index.
+    cell_size : int
+        Size (in voxels) of every side of a cell.
+    """
+    def __init__(self, positions, cell_size):
+        self.positions = np.asarray(positions).reshape((len(positions), -1))
+        self.cell_size = max(int(cell_size), 1)
+
+        cells = self.positions // self.cell_size
+        nb_dims = self.positions.shape[1]
+        self.origin = cells.min(axis=0) if len(cells) > 0 else np.zeros(nb_dims, dtype=int)
+        self.shape = cells.max(axis=0) - self.origin + 1 if len(cells) > 0 else np.zeros(nb_dims, dtype=int)
+
+        linear = np.ravel_multi_index((cells - self.origin).T, self.shape) if len(cells) > 0 else np.zeros(0, dtype=int)
+        self.rows = np.argsort(linear, kind="mergesort")
+        self.offsets = np.searchsorted(linear[self.rows], np.arange(int(np.prod(self.shape)) + 1))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def cells_near(self, lower, upper, radius):
+        """ Linear ids of the cells within `radius` of the box [lower, upper].
+
+        With `lower` == `upper`, these are the cells overlapping the ball of
+        radius `radius` centered at that position.
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=int)
+
+        lower, upper = np.asarray(lower), np.asarray(upper)
+        first = np.maximum((lower - radius) // self.cell_size - self.origin, 0).astype(int)
+        last = np.minimum((upper + radius) // self.cell_size - self.origin, self.shape - 1).astype(int)
+        if np.any(first > last):
+            return np.zeros(0, dtype=int)
+
+        ranges = [np.arange(f, l+1) for f, l in zip(first, last)]
+        cells = np.array(np.meshgrid(*ranges, indexing='ij')).reshape((len(ranges), -1)).T
+
+        # Distance between the box and every cell (0 along overlapping axes).
+        cells_lower = (cells + self.origin) * self.cell_size
+        cells_upper = cells_lower + self.cell_size - 1
+        gaps = np.maximum(0, np.maximum(cells_lower - upper, lower - cells_upper))
+        cells = cells[np.sum(gaps**2, axis=1) <= radius**2]
+
+        return np.ravel_multi_index(cells.T, self.shape)
+
+    def query(self, lower, upper, radius):
+        """ Rows lying in cells within `radius` of the box [lower, upper].
+
+        This is a superset of the rows within `radius` of any position in
+        the box: exact distances still have to be checked.
+        """
+        cells = self.cells_near(lower, upper, radius)
+        if len(cells) == 0:
+            return np.zeros(0, dtype=int)
+
+        return np.concatenate([self.rows[self.offsets[c]:self.offsets[c+1]] for c in cells])
+
+    def query_ball(self, center, radius):
+        """ Rows within `radius` of `center`. """
+        rows = self.query(center, center, radius)
+        sqdists = np.sum((self.positions[rows] - center)**2, axis=1)
+        return rows[sqdists <= radius**2]
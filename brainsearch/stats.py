@@ -0,0 +1,266 @@
+from __future__ import division
+
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+
+def size_bin(size):
+    """ Bin of the log2 histogram of bucket sizes: [2^b, 2^(b+1)). """
+    return int(size).bit_length() - 1
+
+
+def merge_summaries(summaries):
+    """ Summary of the buckets of several summaries (e.g. shards). """
+    summaries = [summary for summary in summaries if summary]
+    if len(summaries) == 0:
+        return None
+
+    return {'nb_buckets': sum(summary['nb_buckets'] for summary in summaries),
+            'nb_patches': sum(summary['nb_patches'] for summary in summaries),
+            'sum_squares': sum(summary['sum_squares'] for summary in summaries),
+            'max': max(summary['max'] for summary in summaries),
+            'histogram': np.sum([summary['histogram'] for summary in summaries], axis=0).tolist()}
+
+
+def write_details(path, generation, **details):
+    """ Pickles what is too large for the catalog (e.g. the size of every bucket).
+
+    The file is replaced atomically and stamped with `generation`, the write
+    generation of the brain database it describes.
+    """
+    details['generation'] = generation
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(details, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except:
+        os.remove(tmp_path)
+        raise
+
+    os.rename(tmp_path, path)  # Atomic.
+
+
+def read_details(path, generation):
+    """ Details written by `write_details`, None if missing or of another generation. """
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, 'rb') as f:
+        details = pickle.load(f)
+
+    if details.get('generation') != generation:
+        return None
+
+    return details
+
+
+def remove_details(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def describe(summary):
+    """ Distribution stats of bucket sizes out of a summary. """
+    nb_buckets = max(summary['nb_buckets'], 1)
+    mean = summary['nb_patches'] / nb_buckets
+    histogram = np.asarray(summary['histogram'])
+    nonempty_bins = np.flatnonzero(histogram)
+    return {'nb_buckets': summary['nb_buckets'],
+            'nb_patches': summary['nb_patches'],
+            'mean': mean,
+            'std': np.sqrt(max(summary['sum_squares'] / nb_buckets - mean**2, 0)),
+            'max': summary['max'],
+            'min_bin': 2**nonempty_bins[0] if len(nonempty_bins) > 0 else 0,
+            'nb_pairs': summary['sum_squares'] - summary['nb_patches']}  # Sum_bucket |bucket|*(|bucket|-1)
+
+
+class BucketStats(object):
+    """ Statistics about bucket sizes, maintained as buckets change.
+
+    Besides the size of every bucket, a log2 histogram of the sizes along
+    with their sum, sum of squares and max are kept up to date, so their
+    distribution is known without walking the buckets. Buckets holding at
+    least `min_sampled_size` patches also keep a reservoir sample of the
+    attributes of their patches.
+
+    Parameters
+    ----------
+    summary : dict, optional
+        Summary of existing buckets (see `summary`).
+    sizes : dict, optional
+        Size of existing buckets.
+    samples : dict, optional
+        Reservoir samples of existing buckets.
+    sample_size : int, optional
+        Number of patches sampled per large bucket.
+    min_sampled_size : int, optional
+        Only buckets holding this many patches are sampled.
+    rng : `numpy.random.RandomState`, optional
+    """
+    NB_BINS = 64
+
+    def __init__(self, summary=None, sizes=None, samples=None, sample_size=64, min_sampled_size=100, rng=None):
+        summary = summary or {}
+        self.sizes = dict(sizes or {})
+        self.samples = dict(samples or {})
+        self.histogram = np.zeros(self.NB_BINS, dtype=np.int64)
+        self.histogram[:len(summary.get('histogram', []))] = summary.get('histogram', [])
+        self.nb_patches = int(summary.get('nb_patches', 0))
+        self.sum_squares = int(summary.get('sum_squares', 0))
+        self.max = int(summary.get('max', 0))
+        self.sample_size = min(sample_size, min_sampled_size)
+        self.min_sampled_size = min_sampled_size
+        self.rng = rng if rng is not None else np.random.RandomState()
+
+    @property
+    def nb_buckets(self):
+        return len(self.sizes)
+
+    def summary(self):
+        return {'nb_buckets': self.nb_buckets,
+                'nb_patches': self.nb_patches,
+                'sum_squares': self.sum_squares,
+                'max': self.max,
+                'histogram': self.histogram.tolist()}
+
+    def set_size(self, bucketkey, size):
+        """ Sets the size of a bucket (0 if it is now empty). """
+        size = int(size)
+        old_size = self.sizes.get(bucketkey, 0)
+        if size == old_size:
+            return
+
+        if old_size > 0:
+            self.histogram[size_bin(old_size)] -= 1
+            self.nb_patches -= old_size
+            self.sum_squares -= old_size**2
+
+        if size > 0:
+            self.histogram[size_bin(size)] += 1
+            self.nb_patches += size
+            self.sum_squares += size**2
+            self.sizes[bucketkey] = size
+        else:
+            del self.sizes[bucketkey]
+
+        if size >= self.max:
+            self.max = size
+        elif old_size == self.max:
+            self.max = max(self.sizes.values()) if len(self.sizes) > 0 else 0
+
+        if size < old_size:
+            # The sample may hold patches that are gone.
+            self.samples.pop(bucketkey, None)
+
+    def add(self, bucketkey, rows, fetch=None):
+        """ Accounts for patches appended to a bucket.
+
+        Parameters
+        ----------
+        bucketkey : str
+        rows : dict
+            Maps attributes' name to the values of the appended patches.
+        fetch : callable, optional
+            Returns the attributes of every patch of a bucket given its key.
+            Used to start the sample of a bucket reaching `min_sampled_size`.
+        """
+        nb_rows = len(rows.values()[0])
+        size = self.sizes.get(bucketkey, 0) + nb_rows
+        self.set_size(bucketkey, size)
+        if size < self.min_sampled_size:
+            return
+
+        if bucketkey not in self.samples:
+            if fetch is not None:
+                values = fetch(bucketkey)
+                indices = self.rng.choice(size, size=self.sample_size, replace=False)
+                self.samples[bucketkey] = dict((name, values[name][indices]) for name in values)
+                self.samples[bucketkey]['seen'] = size
+
+            return
+
+        # Reservoir sampling: the i-th patch seen replaces a sampled one with probability sample_size/i.
+        sample = self.samples[bucketkey]
+        seen = np.arange(sample['seen'] + 1, sample['seen'] + nb_rows + 1)
+        slots = (self.rng.rand(nb_rows) * seen).astype(np.int64)
+        for i in np.flatnonzero(slots < self.sample_size):
+            for name in rows:
+                sample[name][slots[i]] = rows[name][i]
+
+        sample['seen'] += nb_rows
+
+    def add_batch(self, bucketkeys, rows, fetch=None):
+        """ Accounts for patches appended to buckets, `bucketkeys[i]` receiving the i-th one. """
+        bucketkeys = np.asarray(bucketkeys)
+        uniques, inverse = np.unique(bucketkeys, return_inverse=True)
+        order = np.argsort(inverse, kind="mergesort")
+        boundaries = np.searchsorted(inverse[order], np.arange(len(uniques) + 1))
+        for i, bucketkey in enumerate(uniques):
+            indices = order[boundaries[i]:boundaries[i+1]]
+            self.add(str(bucketkey), dict((name, values[indices]) for name, values in rows.items()), fetch)
+
+
+class BucketBrains(object):
+    """ Number of patches every brain has in every bucket.
+
+    Along with the label of every brain, it gives the label counts of a
+    bucket (leaving some brains out if needed) without reading it.
+
+    Parameters
+    ----------
+    counts : dict, optional
+        Maps bucket keys to dicts mapping brain ids to their number of patches.
+    labels : dict, optional
+        Maps brain ids to their label.
+    """
+    def __init__(self, counts=None, labels=None):
+        self.counts = dict(counts or {})
+        self.labels = dict(labels or {})
+
+    def add_batch(self, bucketkeys, brain_ids, labels):
+        """ Accounts for patches appended to buckets, `bucketkeys[i]` receiving the i-th one. """
+        brain_ids = np.asarray(brain_ids).flatten()
+        labels = np.asarray(labels).flatten()
+        if len(brain_ids) == 0:
+            return
+
+        uniques, inverse = np.unique(np.asarray(bucketkeys), return_inverse=True)
+        pairs, counts = np.unique(np.c_[inverse, brain_ids], axis=0, return_counts=True)
+        for (i, brain_id), count in zip(pairs, counts):
+            bucket = self.counts.setdefault(str(uniques[i]), {})
+            bucket[int(brain_id)] = bucket.get(int(brain_id), 0) + int(count)
+
+        for brain_id, label in set(zip(brain_ids.tolist(), labels.tolist())):
+            self.labels[brain_id] = label
+
+    def remove(self, bucketkey, brain_id=None):
+        """ Forgets about a brain's patches in a bucket (or every patch if no brain is given). """
+        if brain_id is None:
+            self.counts.pop(bucketkey, None)
+            return
+
+        bucket = self.counts.get(bucketkey, {})
+        bucket.pop(brain_id, None)
+        if len(bucket) == 0:
+            self.counts.pop(bucketkey, None)
+
+    def label_counts(self, bucketkeys, exclude_ids=(), nb_labels=2):
+        """ Number of patches of every label in every bucket, leaving out brains `exclude_ids`.
+
+        Returns
+        -------
+        label_counts : 2D array (len(bucketkeys), nb_labels)
+        """
+        exclude_ids = set(int(brain_id) for brain_id in exclude_ids)
+        uniques, inverse = np.unique(np.asarray(bucketkeys), return_inverse=True)
+        label_counts = np.zeros((len(uniques), nb_labels), dtype=np.int64)
+        for i, bucketkey in enumerate(uniques):
+            for brain_id, count in self.counts.get(str(bucketkey), {}).items():
+                if brain_id not in exclude_ids:
+                    label_counts[i, self.labels[brain_id]] += count
+
+        return label_counts[inverse]
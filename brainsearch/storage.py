@@ -0,0 +1,430 @@
+import os
+import json
+import shutil
+import tempfile
+import cPickle as pickle
+from os.path import join as pjoin
+
+import numpy as np
+
+from brainsearch.hashtable import HashTable, key_codes
+
+SNAPSHOT_VERSION = 1
+
+
+def read_snapshot_header(path):
+    """ Header of the snapshot at `path` (None if there is none). """
+    if not os.path.isfile(pjoin(path, "header.json")):
+        return None
+
+    with open(pjoin(path, "header.json")) as f:
+        return json.load(f)
+
+
+def remove_snapshot(path):
+    if os.path.islink(path):
+        target = os.path.realpath(path)
+        os.remove(path)
+        path = target
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def write_snapshot(storage, metadata, path, bucketkeys=None, chunk_size=1000, generation=0):
+    """ Writes the buckets of `storage` into a snapshot directory.
+
+    The snapshot contains a header, an index (bucket keys and offsets) and
+    a .npy file per attribute (data aligned on 64 bytes) in which the
+    patches of every bucket are contiguous, so a snapshot can be
+    memory-mapped by `MmapStorage` and read sequentially. Empty buckets are
+    left out.
+
+    The snapshot is written aside then swapped in atomically: `path` is a
+    symlink to the latest snapshot. Readers having opened the previous one
+    keep their memory mappings of it.
+
+    Parameters
+    ----------
+    storage : nearpy's storage
+    metadata : dict
+        Maps attributes' name to their `NumpyData`.
+    path : str
+        Where to write the snapshot.
+    bucketkeys : list of str, optional
+        Buckets to write (default: all buckets of `storage`).
+    chunk_size : int, optional
+        Number of buckets retrieved at once.
+    generation : int, optional
+        Generation of the brain database (see `BrainDatabase.generation`)
+        the snapshot is taken at, recorded in the header.
+
+    Returns
+    -------
+    bucketkeys : list of str
+        Buckets written in the snapshot.
+    empty_bucketkeys : list of str
+        Empty buckets that were left out.
+    """
+    if bucketkeys is None:
+        bucketkeys = storage.bucketkeys()
+
+    bucketkeys = sorted(bucketkeys)
+    sizes = []
+    for start in range(0, len(bucketkeys), chunk_size):
+        sizes.extend(map(len, storage.retrieve(bucketkeys[start:start+chunk_size], attribute=metadata['id'])))
+
+    empty_bucketkeys = [key for key, size in zip(bucketkeys, sizes) if size == 0]
+    bucketkeys = [key for key, size in zip(bucketkeys, sizes) if size > 0]
+    offsets = np.r_[0, np.cumsum([size for size in sizes if size > 0])].astype(np.int64)
+    chunks = [bucketkeys[i:i+chunk_size] for i in range(0, len(bucketkeys), chunk_size)]
+
+    path = path.rstrip("/")
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + ".", dir=dirname)
+    try:
+        header = {'version': SNAPSHOT_VERSION, 'nb_patches': int(offsets[-1]), 'nb_buckets': len(bucketkeys),
+                  'generation': generation, 'attributes': {}}
+        for name, attribute in metadata.items():
+            values = np.lib.format.open_memmap(pjoin(tmp_path, name + ".npy"), mode="w+", dtype=attribute.dtype,
+                                               shape=(int(offsets[-1]),) + tuple(attribute.shape))
+            start = 0
+            for keys in chunks:
+                for bucket in storage.retrieve(keys, attribute=attribute):
+                    values[start:start+len(bucket)] = bucket.reshape((len(bucket),) + tuple(attribute.shape))
+                    start += len(bucket)
+
+            values.flush()
+            del values
+            header['attributes'][name] = {'dtype': np.dtype(attribute.dtype).str, 'shape': list(attribute.shape)}
+
+        np.savez(pjoin(tmp_path, "index.npz"), keys=np.array(bucketkeys, dtype=str), offsets=offsets)
+
+        # The header is written last: a snapshot without one is incomplete.
+        with open(pjoin(tmp_path, "header.json"), 'w') as f:
+            json.dump(header, f, indent=2)
+    except:
+        shutil.rmtree(tmp_path)
+        raise
+
+    previous = os.path.realpath(path) if os.path.islink(path) else None
+    if os.path.isdir(path) and previous is None:
+        shutil.rmtree(path)  # Snapshot written in place by an older version.
+
+    link = tmp_path + ".link"
+    os.symlink(os.path.basename(tmp_path), link)
+    os.rename(link, path)  # Atomic.
+
+    if previous is not None and os.path.isdir(previous):
+        shutil.rmtree(previous)
+
+    return bucketkeys, empty_bucketkeys
+
+
+class MmapStorage(object):
+    """ Read-only storage over a snapshot of a brain database.
+
+    Attributes are memory-mapped, so processes reading the same snapshot
+    share a single page-cached copy of it. Nothing is ever written.
+    """
+    def __init__(self, path):
+        # Keep reading this snapshot even if a new one is swapped in.
+        self.path = os.path.realpath(path)
+        self.header = read_snapshot_header(self.path)
+        if self.header is None:
+            raise IOError("No snapshot found: " + path)
+
+        index = np.load(pjoin(self.path, "index.npz"))
+        self.keys = index['keys'].tolist()
+        self.offsets = index['offsets']
+        self.nb_patches = self.header['nb_patches']
+        self._rows = dict((key, i) for i, key in enumerate(self.keys))
+
+        # Mapped right away, mappings outlive the files if the snapshot is replaced.
+        self._values = dict((name, np.load(pjoin(self.path, name + ".npy"), mmap_mode="r"))
+                            for name in self.header['attributes'])
+
+    def values(self, attribute):
+        return self._values[attribute.name]
+
+    def bucketkeys(self):
+        return list(self.keys)
+
+    def buckets_size(self):
+        return np.diff(self.offsets).tolist(), self.bucketkeys()
+
+    def bucket_sizes(self, bucketkeys):
+        """ Number of patches in every bucket of `bucketkeys`, without reading them. """
+        rows = [self._rows.get(key) for key in bucketkeys]
+        return [int(self.offsets[i+1] - self.offsets[i]) if i is not None else 0 for i in rows]
+
+    def retrieve(self, bucketkeys, attribute):
+        values = self.values(attribute)
+        buckets = []
+        for key in bucketkeys:
+            i = self._rows.get(key)
+            if i is None:
+                buckets.append(values[:0])
+            else:
+                buckets.append(values[self.offsets[i]:self.offsets[i+1]])
+
+        return buckets
+
+    def _readonly(self, *args, **kwargs):
+        raise IOError("Snapshot storage is read-only: " + self.path)
+
+    store = store_batch = clear = set_info = del_info = _readonly
+
+
+class ReadOnlyInfoStorage(object):
+    """ Read-only view of a catalog storage, every info is read only once. """
+    def __init__(self, storage):
+        self.storage = storage
+        self._infos = {}
+
+    def get_info(self, key):
+        if key not in self._infos:
+            self._infos[key] = self.storage.get_info(key)
+
+        return self._infos[key]
+
+    def set_info(self, *args, **kwargs):
+        raise IOError("Brain databases were opened in read-only mode.")
+
+    del_info = set_info
+
+
+_REDIS_POOLS = {}
+
+
+def redis_connection_pool(host="localhost", port=6379, db=0):
+    """ Connection pool shared by every storage using the same redis server. """
+    import redis
+    if (host, port, db) not in _REDIS_POOLS:
+        _REDIS_POOLS[host, port, db] = redis.ConnectionPool(host=host, port=port, db=db)
+
+    return _REDIS_POOLS[host, port, db]
+
+
+class PipelinedRedisStorage(object):
+    """ Redis storage sending commands in pipelined batches.
+
+    Every bucket attribute is a redis list of raw binary chunks (one per
+    append). Instead of a round trip per bucket, fetches and appends are
+    queued in a pipeline and sent `batch_size` buckets at a time. Storages
+    connected to the same server share a connection pool.
+
+    Parameters
+    ----------
+    keyprefix : str, optional
+        Prefix of every key (e.g. name of the brain database).
+    host, port, db : redis server to connect to.
+    batch_size : int, optional
+        Number of buckets per round trip.
+    connection : redis client, optional
+        Use this client instead of connecting through the shared pool.
+    """
+    def __init__(self, keyprefix="", host="localhost", port=6379, db=0, batch_size=1000, connection=None, **kwargs):
+        self.keyprefix = keyprefix
+        self.batch_size = batch_size
+        self.redis = connection
+        if self.redis is None:
+            import redis
+            self.redis = redis.StrictRedis(connection_pool=redis_connection_pool(host, port, db))
+
+        self._buckets_key = "{}:buckets".format(keyprefix)
+        self._attributes_key = "{}:attributes".format(keyprefix)
+        self._sizes_key = "{}:sizes".format(keyprefix)
+
+    def _key(self, bucketkey, attribute_name):
+        return "{}:{}:{}".format(self.keyprefix, bucketkey, attribute_name)
+
+    def _batches(self, items):
+        for start in range(0, len(items), self.batch_size):
+            yield items[start:start+self.batch_size]
+
+    def store(self, bucketkeys, data):
+        """ Appends the i-th row of every attribute of `data` to bucket `bucketkeys[i]`. """
+        rows = {}
+        for i, bucketkey in enumerate(bucketkeys):
+            rows.setdefault(bucketkey, []).append(i)
+
+        self.redis.sadd(self._attributes_key, *[attribute.name for attribute in data])
+        for batch in self._batches(rows.items()):
+            pipeline = self.redis.pipeline(transaction=False)
+            for bucketkey, indices in batch:
+                for attribute, values in data.items():
+                    chunk = np.ascontiguousarray(np.asarray(values)[indices], dtype=attribute.dtype)
+                    pipeline.rpush(self._key(bucketkey, attribute.name), chunk.tostring())
+
+                pipeline.hincrby(self._sizes_key, bucketkey, len(indices))
+
+            pipeline.sadd(self._buckets_key, *[bucketkey for bucketkey, _ in batch])
+            pipeline.execute()
+
+    def retrieve(self, bucketkeys, attribute):
+        shape = (-1,) + tuple(attribute.shape)
+        buckets = []
+        for batch in self._batches(list(bucketkeys)):
+            pipeline = self.redis.pipeline(transaction=False)
+            for bucketkey in batch:
+                pipeline.lrange(self._key(bucketkey, attribute.name), 0, -1)
+
+            for chunks in pipeline.execute():
+                buckets.append(np.frombuffer(b"".join(chunks), dtype=attribute.dtype).reshape(shape))
+
+        return buckets
+
+    def bucketkeys(self):
+        return list(self.redis.smembers(self._buckets_key))
+
+    def buckets_size(self):
+        sizes = self.redis.hgetall(self._sizes_key)
+        bucketkeys = self.bucketkeys()
+        return [int(sizes.get(bucketkey, 0)) for bucketkey in bucketkeys], bucketkeys
+
+    def bucket_sizes(self, bucketkeys):
+        """ Number of patches in every bucket of `bucketkeys`, without reading them. """
+        bucketkeys = list(bucketkeys)
+        if len(bucketkeys) == 0:
+            return []
+
+        return [int(size or 0) for size in self.redis.hmget(self._sizes_key, bucketkeys)]
+
+    def clear(self, bucketkeys=None):
+        if bucketkeys is None:
+            bucketkeys = self.bucketkeys()
+
+        attribute_names = list(self.redis.smembers(self._attributes_key))
+        for batch in self._batches(list(bucketkeys)):
+            pipeline = self.redis.pipeline(transaction=False)
+            for bucketkey in batch:
+                for attribute_name in attribute_names:
+                    pipeline.delete(self._key(bucketkey, attribute_name))
+
+            if len(batch) > 0:
+                pipeline.srem(self._buckets_key, *batch)
+                pipeline.hdel(self._sizes_key, *batch)
+            pipeline.execute()
+
+    def get_info(self, key):
+        value = self.redis.get("{}:info:{}".format(self.keyprefix, key))
+        return pickle.loads(value) if value is not None else None
+
+    def set_info(self, key, value, append=False):
+        if append:
+            value = (self.get_info(key) or []) + [value]
+
+        self.redis.set("{}:info:{}".format(self.keyprefix, key), pickle.dumps(value))
+
+    def del_info(self, key, value=None):
+        if value is not None:
+            values = [v for v in (self.get_info(key) or []) if v != value]
+            return self.set_info(key, values)
+
+        self.redis.delete("{}:info:{}".format(self.keyprefix, key))
+
+
+class HashTableStorage(object):
+    """ In-memory storage finding buckets through a NumPy hash table.
+
+    Bucket keys (binary strings or integers) are turned into uint64 codes
+    and resolved by a `HashTable` a whole batch at a time, instead of
+    hashing every key string one by one. Appended rows are kept as chunks,
+    merged into a single array the first time a bucket is retrieved.
+    """
+    def __init__(self, **kwargs):
+        self.table = HashTable()
+        self.keys = []  # Original key of every bucket.
+        self.buckets = []  # Maps attributes' name to a list of chunks, for every bucket.
+        self.sizes = np.zeros(0, dtype=np.int64)
+
+    def store(self, bucketkeys, data):
+        """ Appends the i-th row of every attribute of `data` to bucket `bucketkeys[i]`. """
+        buckets = self.table.insert(key_codes(bucketkeys))
+        if len(self.table) > len(self.keys):
+            # New buckets got the next values, in order of their first row.
+            rows = np.flatnonzero(buckets >= len(self.keys))
+            _, firsts = np.unique(buckets[rows], return_index=True)
+            for i in rows[firsts]:
+                self.keys.append(bucketkeys[i])
+                self.buckets.append({})
+
+            self.sizes = np.r_[self.sizes, np.zeros(len(self.table) - len(self.sizes), dtype=np.int64)]
+
+        order = np.argsort(buckets, kind="mergesort")
+        uniques, starts = np.unique(buckets[order], return_index=True)
+        for bucket, rows in zip(uniques, np.split(order, starts[1:])):
+            for attribute, values in data.items():
+                chunk = np.asarray(values)[rows].astype(attribute.dtype).reshape((-1,) + tuple(attribute.shape))
+                self.buckets[bucket].setdefault(attribute.name, []).append(chunk)
+
+        self.sizes += np.bincount(buckets, minlength=len(self.sizes))
+
+    def retrieve(self, bucketkeys, attribute):
+        empty = np.zeros((0,) + tuple(attribute.shape), dtype=attribute.dtype)
+        buckets = []
+        for bucket in self.table.lookup(key_codes(bucketkeys)):
+            chunks = self.buckets[bucket].get(attribute.name) if bucket >= 0 else None
+            if not chunks:
+                buckets.append(empty)
+                continue
+
+            if len(chunks) > 1:
+                chunks[:] = [np.concatenate(chunks)]
+
+            buckets.append(chunks[0])
+
+        return buckets
+
+    def bucketkeys(self):
+        return [self.keys[bucket] for bucket in np.flatnonzero(self.sizes)]
+
+    def buckets_size(self):
+        buckets = np.flatnonzero(self.sizes)
+        return self.sizes[buckets].tolist(), [self.keys[bucket] for bucket in buckets]
+
+    def bucket_sizes(self, bucketkeys):
+        """ Number of patches in every bucket of `bucketkeys`, without reading them. """
+        buckets = self.table.lookup(key_codes(bucketkeys))
+        sizes = np.zeros(len(buckets), dtype=np.int64)
+        sizes[buckets >= 0] = self.sizes[buckets[buckets >= 0]]
+        return sizes.tolist()
+
+    def nbytes(self):
+        """ Memory used by the stored rows and the hash table. """
+        nbytes = self.table.slot_codes.nbytes + self.table.slot_values.nbytes + self.sizes.nbytes
+        for bucket in self.buckets:
+            nbytes += sum(chunk.nbytes for chunks in bucket.values() for chunk in chunks)
+
+        return nbytes
+
+    def clear(self, bucketkeys=None):
+        if bucketkeys is None:
+            self.__init__()
+            return
+
+        # Buckets stay in the table, emptied.
+        for bucket in self.table.lookup(key_codes(bucketkeys)):
+            if bucket >= 0:
+                self.buckets[bucket] = {}
+                self.sizes[bucket] = 0
+
+
+def storage_factory(storage_type, **params):
+    """ Builds the storage of a brain database.
+
+    Storage types provided by brainsearch are handled here, the others are
+    delegated to nearpy's `storage_factory`.
+    """
+    if storage_type == "redis-pipelined":
+        return PipelinedRedisStorage(**params)
+
+    if storage_type == "memory":
+        return HashTableStorage(**params)
+
+    import nearpy.storage
+    return nearpy.storage.storage_factory(storage_type, **params)
@@ -0,0 +1,74 @@
+import os
+import csv
+import json
+import shutil
+import tempfile
+import numpy as np
+from collections import namedtuple
+
+from brainsearch import benchmark
+from brainsearch.knn import patch_uids
+
+from nose.tools import assert_equal, assert_almost_equal
+from numpy.testing import assert_array_equal
+
+
+
+class BrainPatches(namedtuple("BrainPatches", ["patches", "positions", "brain_ids"])):
+    def __len__(self):
+        return len(self.patches)
+
+    def create_vectors(self, spatial_weight=0.):
+        return self.patches.reshape((len(self), -1))
+
+
+def test_configurations():
+    configurations = list(benchmark.configurations(["lsh", "PCA"], [8, 16], tables=[1, 4], probes=[0, 2]))
+    assert_equal(len(configurations), 2*2*2 + 2*2)
+    assert_equal(configurations[0], {'hashing': "LSH", 'nbits': 8, 'tables': 1, 'probes': 0})
+    assert_equal(set(config['tables'] for config in configurations if config['hashing'] == "PCA"), set([1]))
+
+    builds = benchmark.builds(configurations)
+    assert_equal(len(builds), 2*2 + 2)
+    assert_equal([config['probes'] for config in builds[0]], [0, 2])
+    assert_equal(builds[1][0], {'hashing': "LSH", 'nbits': 8, 'tables': 4, 'probes': 0})
+
+
+def test_sample_queries_and_recall():
+    rng = np.random.RandomState(42)
+    brains_patches = []
+    for brain_id, size in enumerate([30, 50]):
+        positions = np.c_[np.arange(size), np.zeros((size, 2), dtype=int)]
+        brains_patches.append(BrainPatches(rng.rand(size, 2, 2).astype(np.float32), positions,
+                                           brain_id * np.ones(size, dtype=np.int32)))
+
+    queries = benchmark.sample_queries(brains_patches, 20, rng)
+    assert_equal(len(queries['patches']), 20)
+    assert_equal(queries['vectors'].shape, (20, 4))
+    for patch, position, brain_id in zip(queries['patches'], queries['positions'], queries['ids']):
+        assert_array_equal(patch, brains_patches[brain_id].patches[position[0]])
+
+    true_uids = benchmark.exact_uids(queries, brains_patches, k=3)
+    assert_array_equal(true_uids[:, 0], patch_uids(queries['ids'], queries['positions']))  # Queries are in the dataset.
+
+    # Only the query itself is found.
+    ids = -np.ones((20, 3), dtype=np.int32)
+    ids[:, 0] = queries['ids']
+    positions = np.zeros((20, 3, 3), dtype=np.int32)
+    positions[:, 0] = queries['positions']
+    assert_almost_equal(benchmark.recall({'id': ids, 'position': positions}, true_uids), 1/3.)
+
+
+def test_write_results():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(tmpdir, "results")
+        results = [{'hashing': "LSH", 'nbits': 8, 'tables': 1, 'probes': 0, 'recall': 0.5, 'index_bytes': None}]
+        benchmark.write_results(results, prefix)
+
+        assert_equal(json.load(open(prefix + ".json")), results)
+        rows = list(csv.DictReader(open(prefix + ".csv")))
+        assert_equal(rows[0]['recall'], "0.5")
+        assert_equal(rows[0]['build_time'], "")
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,44 @@
+import numpy as np
+from brainsearch.codes import nb_words, pack_bits, popcount, hamming_distances, SignCodes
+
+from nose.tools import assert_equal, assert_true
+from numpy.testing import assert_array_equal
+
+
+def test_pack_bits():
+    assert_equal([nb_words(nbits) for nbits in [1, 64, 65, 128]], [1, 1, 2, 2])
+
+    bits = np.zeros((2, 70), dtype=bool)
+    bits[0, 0] = bits[1, 63] = bits[1, 64] = True
+    codes = pack_bits(bits)
+    assert_equal(codes.dtype, np.uint64)
+    assert_array_equal(codes, np.array([[2**63, 0], [1, 2**63]], dtype=np.uint64))
+
+
+def test_popcount():
+    rng = np.random.RandomState(42)
+    words = rng.randint(0, 2**62, size=100).astype(np.uint64) * np.uint64(3)
+    words[:2] = [0, 2**64 - 1]
+    assert_array_equal(popcount(words), [bin(int(word)).count("1") for word in words])
+
+
+def test_hamming_distances():
+    rng = np.random.RandomState(42)
+    bits = rng.rand(20, 100) > 0.5
+    queries = rng.rand(5, 100) > 0.5
+
+    distances = hamming_distances(pack_bits(queries), pack_bits(bits))
+    assert_array_equal(distances, np.sum(queries[:, None] != bits[None, :], axis=2))
+
+
+def test_sign_codes():
+    rng = np.random.RandomState(42)
+    coder = SignCodes(128, dimension=8, rng=rng)
+    patches = rng.randn(50, 2, 4).astype(np.float32)
+    codes = coder.encode(patches)
+    assert_equal(codes.shape, (50, 2))
+
+    # Close patches have close codes.
+    noisy = coder.encode(patches + 0.01 * rng.randn(*patches.shape))
+    assert_true(np.all(hamming_distances(codes, noisy).diagonal() < 16))
+    assert_array_equal(hamming_distances(codes, coder.encode(-patches)).diagonal(), 128)
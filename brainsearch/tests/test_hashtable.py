@@ -0,0 +1,39 @@
+import numpy as np
+from brainsearch.hashtable import HashTable, key_codes
+
+from nose.tools import assert_equal, assert_true
+from numpy.testing import assert_array_equal
+
+
+def test_key_codes():
+    assert_array_equal(key_codes(["0", "1", "00", "101", ""]), [0b10, 0b11, 0b100, 0b1101, 0b1])
+    assert_array_equal(key_codes([3, 7]), [3, 7])
+    assert_equal(key_codes([]).dtype, np.uint64)
+
+    # Codes do not depend on the other keys of the batch.
+    keys = ["0110", "0110/1010", "1" * 62, "1" * 70]
+    codes = key_codes(keys)
+    assert_array_equal(codes, np.concatenate([key_codes([key]) for key in keys]))
+    assert_equal(codes[2], 2**63 - 1)
+    assert_true(codes[1] >= 2**63 and codes[3] >= 2**63)  # Hashed.
+    assert_equal(len(set(codes)), 4)
+
+
+def test_hash_table():
+    rng = np.random.RandomState(42)
+    codes = rng.randint(0, 2**62, size=5000).astype(np.uint64) * np.uint64(2)
+    codes = np.unique(codes)
+    rng.shuffle(codes)
+
+    table = HashTable(capacity=16)
+    values = table.insert(np.r_[codes[:100], codes[:10]])
+    assert_array_equal(values, np.r_[np.arange(100), np.arange(10)])
+    assert_equal(len(table), 100)
+
+    table.insert(codes)  # Table grows.
+    assert_equal(len(table), len(codes))
+    assert_true(len(table.slot_values) >= 2 * len(codes))
+
+    assert_array_equal(table.lookup(codes[:100]), np.arange(100))
+    assert_array_equal(table.codes()[table.lookup(codes)], codes)
+    assert_array_equal(table.lookup(codes + np.uint64(1)), -1)
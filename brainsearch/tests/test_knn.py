@@ -0,0 +1,77 @@
+import numpy as np
+from brainsearch.knn import squared_distances, shortlist_squared_distances, top_k, merge_top_k, ExactKNN, patch_uids, recall_at_k
+
+from nose.tools import assert_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+
+def test_squared_distances():
+    rng = np.random.RandomState(42)
+    queries = rng.rand(7, 3, 3, 3).astype("float32")
+    dataset = rng.rand(11, 3, 3, 3).astype("float32")
+
+    distances = squared_distances(queries, dataset)
+    expected = np.sum((queries[:, None] - dataset[None, :])**2, axis=(2, 3, 4))
+
+    assert_equal(distances.shape, (7, 11))
+    assert_array_almost_equal(distances, expected, decimal=5)
+    assert_array_almost_equal(squared_distances(dataset, dataset).diagonal(), np.zeros(11), decimal=5)
+
+
+def test_shortlist_squared_distances():
+    rng = np.random.RandomState(42)
+    queries = rng.rand(7, 3, 3).astype("float32")
+    dataset = rng.rand(11, 3, 3).astype("float32")
+    shortlist = np.array([rng.permutation(11)[:4] for _ in range(7)])
+
+    distances = shortlist_squared_distances(queries, dataset, shortlist)
+    expected = squared_distances(queries, dataset)[np.arange(7)[:, None], shortlist]
+    assert_array_almost_equal(distances, expected, decimal=5)
+
+
+def test_top_k():
+    distances = np.array([[5., 1., 3., 2.],
+                          [0., 4., 1., 9.]])
+
+    assert_array_equal(top_k(distances, 2), [[1, 3], [0, 2]])
+    assert_array_equal(top_k(distances, 10), [[1, 3, 2, 0], [0, 2, 1, 3]])
+    assert_equal(top_k(distances, 0).shape, (2, 0))
+
+
+def test_merge_top_k():
+    dists = [np.array([[1., 4.], [2., np.nan]]), np.array([[3.], [1.]])]
+    ids = [np.array([[10, 40], [20, -1]]), np.array([[30], [10]])]
+    merged_dists, merged = merge_top_k(2, dists, ids=ids)
+
+    assert_array_equal(merged_dists, [[1., 3.], [1., 2.]])
+    assert_array_equal(merged['ids'], [[10, 30], [10, 20]])
+
+
+def test_exact_knn():
+    rng = np.random.RandomState(42)
+    queries = rng.rand(50, 2, 2, 2).astype("float32")
+    brains = [rng.rand(100, 2, 2, 2).astype("float32") for _ in range(3)]
+    dataset = np.concatenate(brains)
+    labels = np.arange(len(dataset)) % 2
+
+    sqdists = np.sum((queries[:, None] - dataset[None, :])**2, axis=(2, 3, 4))
+    expected = np.argsort(sqdists, axis=1)[:, :5]
+
+    for nb_threads in [1, 4]:
+        knn = ExactKNN(queries, k=5, query_block_size=8, dataset_block_size=30, nb_threads=nb_threads)
+        for i, brain in enumerate(brains):
+            rows = np.arange(len(brain)) + i*len(brain)
+            knn.update(brain, rows=rows, labels=labels[rows])
+
+        assert_array_equal(knn.attributes['rows'], expected)
+        assert_array_equal(knn.attributes['labels'], expected % 2)
+        assert_array_almost_equal(knn.dists, np.sqrt(np.sort(sqdists, axis=1)[:, :5]), decimal=5)
+
+
+def test_recall_at_k():
+    positions = np.array([[[1, 2, 3], [4, 5, 6]], [[7, 8, 9], [0, 0, 0]]])
+    true_uids = patch_uids(np.array([[0, 1], [2, 2]]), positions)
+    found_uids = patch_uids(np.array([[1, -1], [2, 3]]), positions[:, ::-1])
+
+    assert_equal(len(set(true_uids.flatten())), 4)
+    assert_array_equal(recall_at_k(found_uids, true_uids), [0.5, 0.5])
@@ -0,0 +1,33 @@
+import numpy as np
+from brainsearch.maps import neighbor_weights, proximity_map
+
+from nose.tools import assert_equal, assert_raises
+from numpy.testing import assert_array_almost_equal
+
+
+def test_neighbor_weights():
+    dists = np.array([0., 0.25, 1.])
+    assert_array_almost_equal(neighbor_weights(dists, "count"), [1, 1, 1])
+    assert_array_almost_equal(neighbor_weights(dists, "1-dist"), [1, 0.75, 0])
+    assert_array_almost_equal(neighbor_weights(dists, "exp", alpha=2.), np.exp(-2 * dists))
+    assert_raises(ValueError, neighbor_weights, dists, "unknown")
+
+
+def test_proximity_map():
+    rng = np.random.RandomState(42)
+    shape = (6, 7, 8)
+    positions = np.array([rng.randint(0, s - 1, size=(50, 4)) for s in shape]).transpose((1, 2, 0))
+    dists = rng.rand(50, 4).astype(np.float32)
+    dists[rng.rand(50, 4) < 0.2] = np.nan  # Missing neighbors.
+    positions[np.isnan(dists)] = -1
+
+    for weighting in ["count", "1-dist", "exp"]:
+        expected = np.zeros(shape, dtype=np.float32)
+        for (x, y, z), dist in zip(positions.reshape((-1, 3)) + 1, dists.ravel()):
+            if np.isfinite(dist):
+                expected[x, y, z] += neighbor_weights(dist, weighting, alpha=3.)
+
+        # Chunks smaller than the number of neighbors give the same map.
+        proxmap = proximity_map(shape, positions, dists, offset=1, weighting=weighting, alpha=3., chunk_size=17)
+        assert_equal(proxmap.shape, shape)
+        assert_array_almost_equal(proxmap, expected, decimal=5)
@@ -0,0 +1,38 @@
+import numpy as np
+from brainsearch.probing import perturbations, flip_key, probe_keys
+
+from nose.tools import assert_equal, assert_true
+
+
+def test_perturbations():
+    margins = np.array([[0.5, 0.1, 0.9, 0.3]], dtype="float32")
+    flips = perturbations(margins, nb_probes=4)
+
+    assert_equal(flips.shape, (1, 4, 4))
+    # Least confident bits are flipped first, one at a time before pairs.
+    assert_equal(flips[0, 0].tolist(), [False, True, False, False])
+    assert_equal(flips[0, 1].tolist(), [False, False, False, True])
+    assert_equal(flips[0, 2].tolist(), [False, True, False, True])
+    assert_equal(flips[0, 3].tolist(), [True, False, False, False])
+
+    # Never more probes than there are other codes.
+    flips = perturbations(np.ones((3, 2), dtype="float32"), nb_probes=10)
+    assert_equal(flips.shape, (3, 3, 2))
+    assert_true(np.all(flips.any(axis=2)))
+
+
+def test_flip_key():
+    assert_equal(flip_key("0110", np.array([True, False, False, True])), "1111")
+    assert_equal(flip_key("db_0110", np.array([False, False, True, False])), "db_0100")
+
+
+def test_probe_keys():
+    class Hash(object):
+        normals = np.array([[1., 0.], [0., 1.]])
+
+    vectors = np.array([[0.1, -2.], [3., 0.2]])
+    keys = ["10", "11"]
+    probes = probe_keys(Hash(), vectors, keys, nb_probes=3)
+
+    assert_equal(probes[0], ["00", "11", "01"])
+    assert_equal(probes[1], ["10", "01", "00"])
@@ -0,0 +1,232 @@
+import numpy as np
+from collections import namedtuple
+from brainsearch.query import QueryPlanner, iter_neighbors, table_bucketkeys
+from brainsearch.codes import SignCodes
+
+from nose.tools import assert_equal, assert_true
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+Attribute = namedtuple("Attribute", ["name", "dtype", "shape"])
+
+
+class SignHash(object):
+    """ 1-bit hash: sign of a given dimension. """
+    def __init__(self, dim):
+        self.dim = dim
+        self.name = "sign{}".format(dim)
+
+    def hash_vector(self, vectors):
+        return ["{}_{}".format(self.dim, int(v[self.dim] > 0)) for v in vectors]
+
+
+class BitHash(SignHash):
+    """ Same as `SignHash` but with bare binary keys, like the hashes of brain databases. """
+    def hash_vector(self, vectors):
+        return [str(int(v[self.dim] > 0)) for v in vectors]
+
+
+class DictStorage(object):
+    def __init__(self):
+        self.buckets = {}
+        self.nb_retrieve = 0
+
+    def store(self, bucketkeys, data):
+        for i, bucketkey in enumerate(bucketkeys):
+            bucket = self.buckets.setdefault(bucketkey, dict((a, []) for a in data))
+            for attribute, values in data.items():
+                bucket[attribute].append(values[i])
+
+    def retrieve(self, bucketkeys, attribute):
+        self.nb_retrieve += 1
+        return [np.array(self.buckets[key][attribute], dtype=attribute.dtype).reshape((-1,) + attribute.shape)
+                if key in self.buckets else np.zeros((0,) + attribute.shape, dtype=attribute.dtype)
+                for key in bucketkeys]
+
+
+class FakeBrainDatabase(object):
+    def __init__(self, lshashes, patches, ids, coder=None):
+        self.metadata = {'patch': Attribute('patch', np.dtype(np.float32), patches.shape[1:]),
+                         'id': Attribute('id', np.dtype(np.int32), (1,)),
+                         'label': Attribute('label', np.dtype(np.int8), (1,)),
+                         'position': Attribute('position', np.dtype(np.int32), (3,))}
+
+        self.engine = namedtuple("Engine", ["lshashes", "storage"])(lshashes, DictStorage())
+        data = {self.metadata['patch']: patches,
+                self.metadata['id']: ids,
+                self.metadata['label']: ids % 2,
+                self.metadata['position']: np.c_[np.arange(len(ids)), np.zeros((len(ids), 2), dtype=int)]}
+        self.coder = coder
+        if coder is not None:
+            self.metadata['code'] = Attribute('code', np.dtype(np.uint64), (coder.nb_words,))
+            data[self.metadata['code']] = coder.encode(patches)
+
+        for bucketkeys in table_bucketkeys(lshashes, [lhash.hash_vector(patches) for lhash in lshashes]):
+            self.engine.storage.store(bucketkeys, data)
+
+    def resolve(self, bucketkeys, patches):
+        return list(bucketkeys)
+
+
+def brute_force(queries, patches, candidates, k):
+    distances = np.sqrt(np.sum((queries[:, None] - patches[None, candidates])**2, axis=2))
+    return candidates[np.argsort(distances, axis=1)[:, :k]], np.sort(distances, axis=1)[:, :k]
+
+
+def test_planner():
+    rng = np.random.RandomState(42)
+    patches = rng.randn(50, 4).astype("float32")
+    queries = rng.randn(20, 4).astype("float32")
+    ids = np.arange(len(patches), dtype=np.int32)
+
+    brain_db = FakeBrainDatabase([SignHash(0)], patches, ids)
+    planner = QueryPlanner(brain_db, k=3)
+    neighbors = planner.execute(queries, queries, ['id', 'label'])
+
+    assert_equal(neighbors['id'].shape, (20, 3))
+    assert_equal(planner.nb_buckets_fetched, 2)  # Each bucket is fetched only once.
+    assert_equal(brain_db.engine.storage.nb_retrieve, 4)  # One call per needed attribute.
+
+    for i, query in enumerate(queries):
+        candidates = np.where((patches[:, 0] > 0) == (query[0] > 0))[0]
+        expected_ids, expected_dists = brute_force(query[None], patches, candidates, 3)
+        assert_array_equal(neighbors['id'][i], expected_ids[0])
+        assert_array_almost_equal(neighbors['dist'][i], expected_dists[0], decimal=5)
+        assert_array_equal(neighbors['label'][i], expected_ids[0] % 2)
+
+
+def test_planner_blocks():
+    rng = np.random.RandomState(42)
+    patches = rng.randn(200, 4).astype("float32")
+    queries = rng.randn(20, 4).astype("float32")
+    ids = np.arange(len(patches), dtype=np.int32)
+    positions = np.c_[rng.randint(0, 200, size=20), np.zeros((20, 2), dtype=int)]
+
+    brain_db = FakeBrainDatabase([SignHash(0)], patches, ids)
+    for radius in [None, 50]:
+        expected = QueryPlanner(brain_db, k=5, radius=radius).execute(queries, queries, ['id'], positions=positions)
+        # Queries and candidates compared a few at a time, with a running top-K.
+        planner = QueryPlanner(brain_db, k=5, radius=radius, query_block_size=3, candidate_block_size=7)
+        neighbors = planner.execute(queries, queries, ['id'], positions=positions)
+        assert_array_equal(neighbors['id'], expected['id'])
+        assert_array_almost_equal(neighbors['dist'], expected['dist'], decimal=5)
+
+
+def test_planner_multiple_tables():
+    rng = np.random.RandomState(42)
+    patches = rng.randn(50, 4).astype("float32")
+    queries = rng.randn(20, 4).astype("float32")
+    ids = np.arange(len(patches), dtype=np.int32)
+
+    brain_db = FakeBrainDatabase([SignHash(0), SignHash(1)], patches, ids)
+    neighbors = QueryPlanner(brain_db, k=5).execute(queries, queries, ['id'])
+
+    for i, query in enumerate(queries):
+        candidates = np.where(((patches[:, 0] > 0) == (query[0] > 0)) | ((patches[:, 1] > 0) == (query[1] > 0)))[0]
+        expected_ids, _ = brute_force(query[None], patches, candidates, 5)
+        assert_array_equal(neighbors['id'][i], expected_ids[0])  # No duplicates.
+
+
+def test_planner_multiple_tables_binary_keys():
+    rng = np.random.RandomState(42)
+    patches = rng.randn(50, 4).astype("float32")
+    queries = rng.randn(20, 4).astype("float32")
+    ids = np.arange(len(patches), dtype=np.int32)
+
+    # Both tables hash to "0" or "1", each table keeps its own buckets.
+    brain_db = FakeBrainDatabase([BitHash(0), BitHash(1)], patches, ids)
+    buckets = brain_db.engine.storage.buckets
+    assert_equal(len(buckets), 4)
+    assert_equal(sorted(len(bucket[brain_db.metadata['id']]) for bucket in buckets.values()),
+                 sorted([np.sum(patches[:, 0] > 0), np.sum(patches[:, 0] <= 0),
+                         np.sum(patches[:, 1] > 0), np.sum(patches[:, 1] <= 0)]))
+
+    planner = QueryPlanner(brain_db, k=5)
+    neighbors = planner.execute(queries, queries, ['id'])
+    for i, query in enumerate(queries):
+        candidates = np.where(((patches[:, 0] > 0) == (query[0] > 0)) | ((patches[:, 1] > 0) == (query[1] > 0)))[0]
+        expected_ids, _ = brute_force(query[None], patches, candidates, 5)
+        assert_array_equal(neighbors['id'][i], expected_ids[0])
+
+    # Single tables keep their keys as is.
+    assert_equal(table_bucketkeys([BitHash(0)], [["0", "1"]]), [["0", "1"]])
+
+
+def test_planner_threshold_and_padding():
+    patches = np.array([[1, 0], [2, 0], [10, 0]], dtype="float32")
+    ids = np.arange(3, dtype=np.int32)
+
+    brain_db = FakeBrainDatabase([SignHash(0)], patches, ids)
+    neighbors = QueryPlanner(brain_db, k=5, threshold=5.).execute(patches[:1], patches[:1], ['id'])
+
+    assert_array_equal(neighbors['id'][0], [0, 1, -1, -1, -1])
+    assert_array_almost_equal(neighbors['dist'][0, :2], [0, 1])
+    assert_equal(np.isnan(neighbors['dist'][0, 2:]).all(), True)
+
+    results = list(iter_neighbors(neighbors))
+    assert_array_equal(results[0][1]['id'], [0, 1])
+
+
+def test_planner_radius():
+    rng = np.random.RandomState(42)
+    patches = rng.randn(200, 4).astype("float32")
+    ids = np.arange(len(patches), dtype=np.int32)
+
+    brain_db = FakeBrainDatabase([SignHash(0)], patches, ids)
+    queries_positions = np.array([[5, 0, 0], [120, 0, 0], [300, 0, 0]])
+    neighbors = QueryPlanner(brain_db, k=10, radius=8).execute(patches[:3], patches[:3], ['id', 'position'],
+                                                                 positions=queries_positions)
+
+    for i in range(3):
+        found = neighbors['id'][i][neighbors['id'][i] != -1]
+        candidates = np.where((patches[:, 0] > 0) == (patches[i, 0] > 0))[0]
+        candidates = candidates[np.abs(candidates - queries_positions[i, 0]) <= 8]
+        expected_ids, _ = brute_force(patches[i:i+1], patches, candidates, 10)
+        assert_array_equal(found, expected_ids[0])
+
+
+def test_planner_exclude_ids():
+    rng = np.random.RandomState(42)
+    patches = rng.randn(60, 4).astype("float32")
+    ids = (np.arange(len(patches)) % 3).astype(np.int32)  # 3 brains.
+
+    brain_db = FakeBrainDatabase([SignHash(0)], patches, ids)
+    neighbors = QueryPlanner(brain_db, k=5, exclude_ids=[0]).execute(patches[:10], patches[:10], ['id', 'position'])
+
+    for i in range(10):
+        assert_equal(np.sum(neighbors['id'][i] == 0), 0)
+        candidates = np.where(((patches[:, 0] > 0) == (patches[i, 0] > 0)) & (ids != 0))[0]
+        expected, _ = brute_force(patches[i:i+1], patches, candidates, 5)
+        assert_array_equal(neighbors['position'][i, :, 0], expected[0])  # Still K neighbors.
+
+    # Every query excludes its own brain, on top of brain 0.
+    planner = QueryPlanner(brain_db, k=5, exclude_ids=[0])
+    neighbors = planner.execute(patches[:10], patches[:10], ['id', 'position'], query_exclude_ids=[[i] for i in ids[:10]])
+    for i in range(10):
+        candidates = np.where(((patches[:, 0] > 0) == (patches[i, 0] > 0)) & (ids != 0) & (ids != ids[i]))[0]
+        expected, _ = brute_force(patches[i:i+1], patches, candidates, 5)
+        assert_array_equal(neighbors['position'][i, :, 0], expected[0])
+
+
+def test_planner_rerank():
+    rng = np.random.RandomState(42)
+    patches = rng.randn(400, 8).astype("float32")
+    queries = patches[:20] + 0.01 * rng.randn(20, 8).astype("float32")
+    ids = np.arange(len(patches), dtype=np.int32)
+
+    brain_db = FakeBrainDatabase([SignHash(0)], patches, ids, coder=SignCodes(64, dimension=8, rng=rng))
+    exhaustive = QueryPlanner(brain_db, k=5)
+    expected = exhaustive.execute(queries, queries, ['id'])
+    planner = QueryPlanner(brain_db, k=5, rerank=50)
+    neighbors = planner.execute(queries, queries, ['id'])
+
+    assert_equal(planner.nb_candidates, 20 * 50)  # Distances only computed for the shortlisted candidates.
+    assert_equal(neighbors['id'].shape, (20, 5))
+    assert_array_equal(neighbors['id'][:, 0], np.arange(20))  # Nearly identical patches are found.
+    assert_true(np.mean(neighbors['id'] == expected['id']) > 0.8)
+
+    # Codes and shortlisted patches compared a few queries and candidates at a time.
+    planner = QueryPlanner(brain_db, k=5, rerank=50, query_block_size=2, candidate_block_size=30)
+    blocked = planner.execute(queries, queries, ['id'])
+    assert_equal(planner.nb_candidates, 20 * 50)
+    assert_array_equal(blocked['id'][:, 0], np.arange(20))
+    assert_true(np.mean(blocked['id'] == expected['id']) > 0.8)
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+from collections import namedtuple
+
+from brainsearch.service import QueryServer, QueryClient, parse_address
+
+from nose.tools import assert_equal, assert_true, assert_raises
+
+Attribute = namedtuple("Attribute", ["name", "dtype", "shape"])
+
+
+class FakeBrainDatabase(object):
+    metadata = {'patch': Attribute('patch', np.dtype(np.float32), (2,)),
+                'id': Attribute('id', np.dtype(np.int32), (1,))}
+
+    def __init__(self):
+        self.batches = []
+        self.excluded = []
+
+    def labels_count(self):
+        return [3, 1]
+
+    def nb_patches(self):
+        return 4
+
+    def get_neighbors_dense(self, vectors, patches, attributes, k=None, threshold=None, probes=0, positions=None, radius=None,
+                            exclude_ids=None, query_exclude_ids=None):
+        self.batches.append(len(vectors))
+        self.excluded.append(query_exclude_ids)
+        # Neighbors of a query are its own rows' values.
+        return {'dist': np.tile(vectors[:, :1], (1, k)),
+                'id': np.tile(np.arange(len(vectors))[:, None], (1, k))}
+
+    def bucket_votes(self, vectors, patches, exclude_ids=()):
+        if len(exclude_ids) > 0:
+            raise ValueError("No per-bucket summaries maintained for brain database: db")
+
+        return np.ones((len(vectors), 2), dtype=np.int64)
+
+
+def test_parse_address():
+    assert_equal(parse_address("localhost:4242"), ("localhost", 4242))
+    assert_equal(parse_address("/tmp/brain_search.sock"), "/tmp/brain_search.sock")
+
+
+def test_query_server():
+    tmpdir = tempfile.mkdtemp()
+    address = os.path.join(tmpdir, "brain_search.sock")
+    brain_db = FakeBrainDatabase()
+    server = QueryServer({"db": brain_db}, address, max_delay=0.2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        remote_db = QueryClient(address)["db"]
+        assert_equal(remote_db.name, "db")
+        assert_equal(remote_db.metadata['patch'].shape, (2,))
+        assert_equal(remote_db.nb_patches(), 4)
+        assert_true(np.allclose(remote_db.label_proportions(), [0.75, 0.25]))
+
+        # Concurrent queries end up in the same batch, whatever brains they exclude.
+        results = {}
+
+        def _query(i):
+            vectors = i * np.ones((i, 2), dtype=np.float32)
+            results[i] = QueryClient(address)["db"].get_neighbors_dense(vectors, vectors, ['id'], k=3, exclude_ids=[i])
+
+        threads = [threading.Thread(target=_query, args=(i,)) for i in (1, 2, 3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert_equal(brain_db.batches, [6])
+        assert_equal(sorted(brain_db.excluded[0]), [[1], [2], [2], [3], [3], [3]])
+        for i in (1, 2, 3):
+            assert_equal(results[i]['dist'].shape, (i, 3))
+            assert_true(np.all(results[i]['dist'] == i))
+
+        neighbors = list(remote_db.get_neighbors(np.ones((2, 2)), np.ones((2, 2)), ['id'], k=2))
+        assert_equal(len(neighbors), 2)
+        assert_equal(neighbors[1][1]['id'].tolist(), [1, 1])
+
+        assert_equal(remote_db.bucket_votes(np.ones((3, 2)), np.ones((3, 2))).tolist(), [[1, 1]] * 3)
+        assert_raises(ValueError, remote_db.bucket_votes, np.ones((3, 2)), np.ones((3, 2)), [0])
+
+        assert_raises(ValueError, QueryClient(address).__getitem__, "unknown")
+    finally:
+        server.shutdown()
+        thread.join()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,33 @@
+import numpy as np
+from brainsearch.spatial import SpatialGrid, group_by_cell
+
+from nose.tools import assert_equal, assert_true
+from numpy.testing import assert_array_equal
+
+
+def test_spatial_grid():
+    rng = np.random.RandomState(42)
+    positions = rng.randint(0, 50, size=(1000, 3))
+    grid = SpatialGrid(positions, cell_size=4)
+
+    assert_equal(len(grid), 1000)
+    assert_array_equal(np.sort(grid.rows), np.arange(1000))
+
+    for center, radius in [((25, 25, 25), 4), ((0, 0, 0), 7), ((49, 10, 3), 1), ((100, 100, 100), 5)]:
+        center = np.array(center)
+        expected = np.where(np.sum((positions - center)**2, axis=1) <= radius**2)[0]
+        assert_array_equal(np.sort(grid.query_ball(center, radius)), expected)
+
+        # Only cells overlapping the sphere are looked at.
+        assert_true(len(grid.query(center, center, radius)) < len(positions))
+
+
+def test_group_by_cell():
+    positions = np.array([[0, 0, 0], [5, 5, 5], [1, 2, 3], [7, 4, 6]])
+    groups = list(group_by_cell(positions, cell_size=4))
+
+    assert_equal(len(groups), 2)
+    assert_array_equal(groups[0][0], [0, 0, 0])
+    assert_array_equal(groups[0][1], [3, 3, 3])
+    assert_array_equal(groups[0][2], [0, 2])
+    assert_array_equal(groups[1][2], [1, 3])
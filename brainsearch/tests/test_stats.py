@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from os.path import join as pjoin
+
+from brainsearch.stats import BucketStats, BucketBrains, size_bin, merge_summaries, describe
+from brainsearch.stats import write_details, read_details, remove_details
+
+from nose.tools import assert_equal, assert_almost_equal, assert_true
+from numpy.testing import assert_array_equal
+
+
+def test_size_bin():
+    assert_equal([size_bin(size) for size in [1, 2, 3, 4, 7, 8, 1000]], [0, 1, 1, 2, 2, 3, 9])
+
+
+def test_bucket_stats():
+    stats = BucketStats()
+    for key, size in [("a", 1), ("b", 3), ("c", 10), ("b", 2)]:
+        stats.add(key, {'position': np.zeros((size, 3))})
+
+    sizes = np.array([1, 5, 10])
+    assert_equal(stats.sizes, {"a": 1, "b": 5, "c": 10})
+    summary = stats.summary()
+    assert_equal(summary['nb_buckets'], 3)
+    assert_equal(summary['nb_patches'], 16)
+    assert_equal(summary['max'], 10)
+    assert_equal(summary['histogram'][:4], [1, 0, 1, 1])
+
+    description = describe(summary)
+    assert_almost_equal(description['mean'], np.mean(sizes))
+    assert_almost_equal(description['std'], np.std(sizes))
+    assert_equal(description['nb_pairs'], np.sum(sizes*(sizes-1)))
+    assert_equal(description['min_bin'], 1)
+
+    # Buckets shrinking or emptied (e.g. split or brain removed).
+    stats.set_size("c", 0)
+    stats.set_size("b", 4)
+    assert_equal(stats.summary()['max'], 4)
+    assert_equal(stats.summary()['nb_patches'], 5)
+    assert_equal(stats.nb_buckets, 2)
+
+    # Restored from a summary and sizes.
+    restored = BucketStats(stats.summary(), stats.sizes)
+    restored.add("a", {'position': np.zeros((1, 3))})
+    stats.add("a", {'position': np.zeros((1, 3))})
+    assert_equal(restored.summary(), stats.summary())
+
+    merged = merge_summaries([stats.summary(), None, BucketStats().summary()])
+    assert_equal(merged, stats.summary())
+
+
+def test_bucket_stats_samples():
+    rng = np.random.RandomState(42)
+    stats = BucketStats(sample_size=10, min_sampled_size=20, rng=rng)
+    buckets = {}
+
+    def fetch(key):
+        return {'position': np.concatenate(buckets[key])}
+
+    for i in range(10):
+        rows = {'position': i * np.ones((5, 3), dtype=np.int32)}
+        buckets.setdefault("a", []).append(rows['position'])
+        stats.add_batch(["a"] * 5, rows, fetch)
+        if i < 3:
+            assert_true("a" not in stats.samples)
+
+    sample = stats.samples["a"]
+    assert_equal(sample['seen'], 50)
+    assert_equal(sample['position'].shape, (10, 3))
+    # Every sampled patch comes from the bucket, patches of later inserts get in.
+    assert_true(np.all(sample['position'] >= 0) and np.all(sample['position'] < 10))
+    assert_true(np.any(sample['position'] >= 4))
+
+    # Samples of shrinking buckets are dropped.
+    stats.set_size("a", 30)
+    assert_true("a" not in stats.samples)
+
+
+def test_bucket_brains():
+    bucket_brains = BucketBrains()
+    bucket_brains.add_batch(["a", "b", "a", "a"], [0, 0, 1, 2], [0, 0, 1, 1])
+    bucket_brains.add_batch(["b", "c"], [2, 2], [1, 1])
+    assert_equal(bucket_brains.counts, {"a": {0: 1, 1: 1, 2: 1}, "b": {0: 1, 2: 1}, "c": {2: 1}})
+    assert_equal(bucket_brains.labels, {0: 0, 1: 1, 2: 1})
+
+    assert_array_equal(bucket_brains.label_counts(["a", "b", "d", "a"]), [[1, 2], [1, 1], [0, 0], [1, 2]])
+    assert_array_equal(bucket_brains.label_counts(["a", "b"], exclude_ids=[2]), [[1, 1], [1, 0]])
+
+    bucket_brains.remove("a", 1)
+    bucket_brains.remove("c", 2)
+    bucket_brains.remove("b")
+    assert_equal(bucket_brains.counts, {"a": {0: 1, 2: 1}})
+
+
+def test_details():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = pjoin(tmp_dir, "db.stats")
+        assert_equal(read_details(path, 0), None)
+
+        write_details(path, 3, sizes={"a": 1}, samples={})
+        assert_equal(read_details(path, 3), {'generation': 3, 'sizes': {"a": 1}, 'samples': {}})
+        # Details of another generation are outdated.
+        assert_equal(read_details(path, 4), None)
+
+        write_details(path, 4, sizes={})
+        assert_equal(read_details(path, 4)['sizes'], {})
+        assert_equal(os.listdir(tmp_dir), ["db.stats"])
+
+        remove_details(path)
+        assert_equal(read_details(path, 4), None)
+    finally:
+        shutil.rmtree(tmp_dir)
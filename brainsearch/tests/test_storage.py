@@ -0,0 +1,220 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from os.path import join as pjoin
+from collections import namedtuple
+
+from brainsearch.storage import MmapStorage, ReadOnlyInfoStorage, PipelinedRedisStorage, HashTableStorage
+from brainsearch.storage import write_snapshot, read_snapshot_header, remove_snapshot
+
+from nose.tools import assert_equal, assert_true, assert_raises
+from numpy.testing import assert_array_equal
+
+Attribute = namedtuple("Attribute", ["name", "dtype", "shape"])
+
+
+class DictStorage(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.infos = {}
+
+    def bucketkeys(self):
+        return self.buckets.keys()
+
+    def retrieve(self, bucketkeys, attribute):
+        return [self.buckets[key][attribute.name] for key in bucketkeys]
+
+    def get_info(self, key):
+        self.infos[key] = self.infos.get(key, 0) + 1
+        return {'name': key}
+
+
+def test_snapshot():
+    metadata = {'patch': Attribute('patch', np.dtype(np.float32), (2, 2)),
+                'id': Attribute('id', np.dtype(np.int32), (1,))}
+
+    rng = np.random.RandomState(42)
+    buckets = {}
+    for key, size in [("01", 3), ("10", 0), ("11", 5)]:
+        buckets[key] = {'patch': rng.rand(size, 2, 2).astype(np.float32),
+                        'id': rng.randint(0, 10, size=(size, 1)).astype(np.int32)}
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = pjoin(tmpdir, "db.snapshot")
+        assert_equal(read_snapshot_header(path), None)
+        assert_equal(write_snapshot(DictStorage(buckets), metadata, path, chunk_size=1, generation=3), (["01", "11"], ["10"]))
+        header = read_snapshot_header(path)
+        assert_equal(header['generation'], 3)
+        assert_equal(header['nb_patches'], 8)
+        assert_equal(header['nb_buckets'], 2)
+        assert_equal(header['attributes']['patch'], {'dtype': "<f4", 'shape': [2, 2]})
+
+        storage = MmapStorage(path)
+        assert_equal(storage.bucketkeys(), ["01", "11"])
+        assert_equal(storage.buckets_size(), ([3, 5], ["01", "11"]))
+        assert_equal(storage.bucket_sizes(["11", "10"]), [5, 0])
+
+        for name, attribute in metadata.items():
+            values = storage.retrieve(["11", "00", "01", "10"], attribute=attribute)
+            assert_array_equal(values[0], buckets["11"][name])
+            assert_equal(values[1].shape, (0,) + attribute.shape)
+            assert_array_equal(values[2], buckets["01"][name])
+            assert_equal(len(values[3]), 0)
+            assert_true(isinstance(values[0], np.memmap))
+
+        assert_raises(IOError, storage.store, ["01"], {})
+        assert_raises(IOError, storage.clear)
+
+        # A new snapshot is swapped in, the old one is removed.
+        del buckets["01"]
+        write_snapshot(DictStorage(buckets), metadata, path)
+        assert_equal(read_snapshot_header(path)['nb_patches'], 5)
+        assert_equal(MmapStorage(path).bucketkeys(), ["11"])
+        assert_equal(len(os.listdir(tmpdir)), 2)  # Symlink and snapshot.
+
+        remove_snapshot(path)
+        assert_equal(os.listdir(tmpdir), [])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_readonly_info_storage():
+    storage = DictStorage({})
+    readonly = ReadOnlyInfoStorage(storage)
+    assert_equal(readonly.get_info("db"), {'name': "db"})
+    assert_equal(readonly.get_info("db"), {'name': "db"})
+    assert_equal(storage.infos, {"db": 1})
+    assert_raises(IOError, readonly.set_info, "db", {})
+    assert_raises(IOError, readonly.del_info, "db")
+
+
+class FakeRedis(object):
+    """ In-process stand-in of the few redis commands used by the storage. """
+    def __init__(self):
+        self.data = {}
+        self.nb_round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(values)
+
+    def lrange(self, key, start, end):
+        return list(self.data.get(key, []))
+
+    def sadd(self, key, *values):
+        self.data.setdefault(key, set()).update(values)
+
+    def srem(self, key, *values):
+        self.data.setdefault(key, set()).difference_update(values)
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def hincrby(self, key, field, amount):
+        self.data.setdefault(key, {})[field] = self.data.get(key, {}).get(field, 0) + amount
+
+    def hmget(self, key, fields):
+        return [self.data.get(key, {}).get(field) for field in fields]
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.data.get(key, {}).pop(field, None)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((getattr(self.redis, name), args))
+
+    def execute(self):
+        self.redis.nb_round_trips += 1
+        return [command(*args) for command, args in self.commands]
+
+
+def test_pipelined_redis_storage():
+    redis = FakeRedis()
+    storage = PipelinedRedisStorage("db", batch_size=2, connection=redis)
+    patch = Attribute('patch', np.dtype(np.float32), (2,))
+    ids = Attribute('id', np.dtype(np.int32), (1,))
+
+    patches = np.arange(10, dtype=np.float32).reshape((5, 2))
+    bucketkeys = ["a", "b", "a", "c", "b"]
+    storage.store(bucketkeys, {patch: patches, ids: np.arange(5).reshape((5, 1))})
+    assert_equal(redis.nb_round_trips, 2)  # 3 buckets, 2 per round trip.
+    storage.store(["c"], {patch: patches[:1], ids: np.array([[5]])})
+
+    assert_equal(sorted(storage.bucketkeys()), ["a", "b", "c"])
+    redis.nb_round_trips = 0
+    buckets = storage.retrieve(["a", "b", "c", "d"], attribute=patch)
+    assert_equal(redis.nb_round_trips, 2)
+    assert_array_equal(buckets[0], patches[[0, 2]])
+    assert_array_equal(buckets[1], patches[[1, 4]])
+    assert_array_equal(buckets[2], patches[[3, 0]])
+    assert_equal(buckets[3].shape, (0, 2))
+    assert_array_equal(storage.retrieve(["c"], attribute=ids)[0], [[3], [5]])
+
+    sizes, keys = storage.buckets_size()
+    assert_equal(dict(zip(keys, sizes)), {"a": 2, "b": 2, "c": 2})
+    assert_equal(storage.bucket_sizes(["c", "d"]), [2, 0])
+
+    storage.clear(["a"])
+    assert_equal(sorted(storage.bucketkeys()), ["b", "c"])
+    assert_equal(len(storage.retrieve(["a"], attribute=ids)[0]), 0)
+
+    storage.set_info("list", "db1", append=True)
+    storage.set_info("list", "db2", append=True)
+    storage.set_info("db", {'nb_patches': 6})
+    assert_equal(storage.get_info("db"), {'nb_patches': 6})
+    storage.del_info("list", "db1")
+    assert_equal(storage.get_info("list"), ["db2"])
+    storage.del_info("db")
+    assert_equal(storage.get_info("db"), None)
+
+
+def test_hash_table_storage():
+    storage = HashTableStorage(keyprefix="db")
+    patch = Attribute('patch', np.dtype(np.float32), (2,))
+    ids = Attribute('id', np.dtype(np.int32), (1,))
+
+    patches = np.arange(10, dtype=np.float32).reshape((5, 2))
+    storage.store(["01", "10", "01", "11", "10"], {patch: patches, ids: np.arange(5).reshape((5, 1))})
+    storage.store(["11"], {patch: patches[:1], ids: np.array([[5]])})
+
+    assert_equal(storage.bucketkeys(), ["01", "10", "11"])
+    assert_equal(storage.buckets_size(), ([2, 2, 2], ["01", "10", "11"]))
+    assert_equal(storage.bucket_sizes(["11", "00", "01"]), [2, 0, 2])
+
+    buckets = storage.retrieve(["11", "00", "01"], attribute=patch)
+    assert_array_equal(buckets[0], patches[[3, 0]])
+    assert_equal(buckets[1].shape, (0, 2))
+    assert_array_equal(buckets[2], patches[[0, 2]])
+    assert_array_equal(storage.retrieve(["10"], attribute=ids)[0], [[1], [4]])
+    assert_true(storage.nbytes() >= patches.nbytes + 6 * 4)
+
+    storage.clear(["01"])
+    assert_equal(storage.bucketkeys(), ["10", "11"])
+    assert_equal(len(storage.retrieve(["01"], attribute=ids)[0]), 0)
+    storage.store(["01"], {patch: patches[:1], ids: np.array([[6]])})
+    assert_array_equal(storage.retrieve(["01"], attribute=ids)[0], [[6]])
+
+    storage.clear()
+    assert_equal(storage.bucketkeys(), [])
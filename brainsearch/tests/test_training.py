@@ -0,0 +1,92 @@
+import numpy as np
+from brainsearch.training import ReservoirSampler, StreamingPCA, iter_chunks, subsample, train_pca, train_pca_hash
+from brainsearch.training import fingerprint, check_inputs
+
+from nose.tools import assert_equal, assert_true, assert_raises
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+
+def test_reservoir_sampler():
+    rng = np.random.RandomState(42)
+    sampler = ReservoirSampler(budget=100, rng=rng)
+    assert_equal(sampler.sample, None)
+
+    sampler.update(np.arange(30).reshape((30, 1)))
+    assert_array_equal(sampler.sample.ravel(), np.arange(30))
+
+    for start in range(30, 10000, 500):
+        sampler.update(np.arange(start, start + 500).reshape((500, 1)))
+
+    sample = sampler.sample.ravel()
+    assert_equal(sampler.nb_seen, 10030)
+    assert_equal(len(sample), 100)
+    assert_equal(len(np.unique(sample)), 100)
+    # Patches of every part of the stream are sampled.
+    assert_true(np.mean(sample) > 3000 and np.mean(sample) < 7000)
+
+
+def test_streaming_pca():
+    rng = np.random.RandomState(42)
+    patches = np.dot(rng.randn(2000, 3), rng.randn(3, 6)) + 10 * rng.rand(6)
+
+    pca = StreamingPCA()
+    for chunk in iter_chunks(patches, chunk_size=300):
+        pca.partial_fit(chunk)
+
+    assert_equal(pca.nb_patches, 2000)
+    assert_array_almost_equal(pca.mean, patches.mean(axis=0))
+    assert_array_almost_equal(pca.covariance(), np.cov(patches.T))
+
+    axes, variances = pca.components(2)
+    assert_equal(axes.shape, (2, 6))
+    expected_variances, expected_axes = np.linalg.eigh(np.cov(patches.T))
+    assert_array_almost_equal(variances, expected_variances[::-1][:2])
+    assert_array_almost_equal(np.abs(np.dot(axes, expected_axes[:, ::-1][:, :2])), np.eye(2))
+
+
+def test_pca_hash():
+    rng = np.random.RandomState(42)
+    patches = rng.randn(500, 4, 4).astype(np.float32) + 5
+    brains = [patches[i:i+100] for i in range(0, 500, 100)]
+
+    lhash = train_pca_hash("PCAH3", 3, iter(brains), budget=200, rng=rng)
+    assert_equal((lhash.nbits, lhash.dimension), (3, 16))
+
+    keys = lhash.hash_vector(patches)
+    assert_equal(len(keys), 500)
+    assert_true(all(len(key) == 3 and set(key) <= set("01") for key in keys))
+    assert_equal(keys[:5], ["".join("1" if p > 0 else "0" for p in projections)
+                            for projections in lhash.project(patches[:5])])
+
+    # Codes are balanced: bits split the (centered) patches in two.
+    bits = np.array([list(key) for key in keys]) == "1"
+    assert_true(np.all(np.abs(bits.mean(axis=0) - 0.5) < 0.15))
+
+    assert_equal(len(subsample(iter(brains), 1000)), 500)
+
+
+def test_pca_model():
+    rng = np.random.RandomState(42)
+    patches = rng.randn(300, 8).astype(np.float32)
+
+    model = train_pca(iter([patches[:150], patches[150:]]), budget=0)
+    assert_equal((model.nb_components, model.nb_patches), (8, 300))
+    assert_true(np.all(np.diff(model.variances) <= 0))
+
+    # Hashes of any length share the same leading bits.
+    keys4 = model.hash("PCAH4", 4).hash_vector(patches)
+    keys2 = model.hash("PCAH2", 2).hash_vector(patches)
+    assert_equal([key[:2] for key in keys4], keys2)
+    assert_raises(ValueError, model.hash, "PCAH9", 9)
+
+
+def test_training_inputs():
+    inputs = {'patch_shape': (9, 9, 9), 'spatial_weight': 0., 'normalization': True, 'resampling_factor': 1.,
+              'trainset': "abc"}
+    assert_equal(fingerprint(inputs), fingerprint(dict(inputs)))
+    assert_true(fingerprint(inputs) != fingerprint(dict(inputs, trainset="abd")))
+
+    # Models can be shared across trainsets, not across patch spaces.
+    check_inputs(inputs, dict(inputs, patch_shape=[9, 9, 9], trainset="other"))
+    assert_raises(ValueError, check_inputs, inputs, dict(inputs, patch_shape=[5, 5, 5]))
+    assert_raises(ValueError, check_inputs, inputs, dict(inputs, normalization=False))
@@ -0,0 +1,274 @@
+from __future__ import division
+
+import json
+import time
+import hashlib
+import resource
+
+import numpy as np
+
+# Default number of patches hash functions are trained on.
+DEFAULT_BUDGET = 1000000
+# Training inputs defining the space patches live in: a hash model only fits patches extracted the same way.
+SPACE_INPUTS = ['patch_shape', 'spatial_weight', 'normalization', 'resampling_factor']
+
+
+def fingerprint(inputs):
+    """ Digest of the inputs (a JSON-serializable dict) a hash model was trained with. """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def file_digest(path):
+    """ Digest of the content of a file (e.g. the trainset's JSON). """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def check_inputs(trained_inputs, inputs):
+    """ Raises a ValueError if patches of `inputs` do not live in the space a model was trained in. """
+    trained_inputs = json.loads(json.dumps(trained_inputs))
+    inputs = json.loads(json.dumps(inputs))
+    for key in SPACE_INPUTS:
+        if trained_inputs.get(key) != inputs.get(key):
+            raise ValueError("Hash model was trained with {}={} instead of {}.".format(key, trained_inputs.get(key),
+                                                                                       inputs.get(key)))
+
+
+def peak_memory():
+    """ Peak resident memory of the process, in bytes. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Progress(object):
+    """ Reports how far a pass over chunks of patches went (e.g. brain by brain).
+
+    Parameters
+    ----------
+    title : str
+    total : int, optional
+        Number of chunks expected.
+    every : float, optional
+        Minimum number of seconds between two reports.
+    """
+    def __init__(self, title, total=None, every=5.):
+        self.title = title
+        self.total = total
+        self.every = every
+        self.nb_chunks = 0
+        self.nb_patches = 0
+        self.start = self.last = time.time()
+
+    def update(self, nb_patches, **extra):
+        self.nb_chunks += 1
+        self.nb_patches += nb_patches
+        if time.time() - self.last >= self.every or self.nb_chunks == self.total:
+            self.report(**extra)
+
+    def report(self, **extra):
+        self.last = time.time()
+        elapsed = max(self.last - self.start, 1e-6)
+        chunks = "{}/{}".format(self.nb_chunks, self.total) if self.total else str(self.nb_chunks)
+        details = "".join(", {:,} {}".format(value, name) for name, value in sorted(extra.items()))
+        print "{}: {} chunks, {:,} patches{} ({:,.0f} patches/sec., {:.1f} MB peak memory).".format(
+            self.title, chunks, self.nb_patches, details, self.nb_patches / elapsed, peak_memory() / 1024**2)
+
+
+class ReservoirSampler(object):
+    """ Uniform sample of at most `budget` patches out of a stream of chunks.
+
+    Patches are seen once (reservoir sampling), so the memory used is
+    bounded by the budget whatever the number of patches in the stream.
+
+    Parameters
+    ----------
+    budget : int
+        Maximum number of patches sampled.
+    rng : `numpy.random.RandomState`, optional
+    """
+    def __init__(self, budget, rng=None):
+        self.budget = budget
+        self.rng = rng if rng is not None else np.random.RandomState()
+        self.nb_seen = 0
+        self._sample = None
+
+    @property
+    def sample(self):
+        if self._sample is None:
+            return None
+
+        return self._sample[:min(self.nb_seen, self.budget)]
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk).reshape((len(chunk), -1))
+        if self._sample is None:
+            self._sample = np.empty((self.budget, chunk.shape[1]), dtype=np.float32)
+
+        # The reservoir is filled first.
+        nb_free = max(min(self.budget - self.nb_seen, len(chunk)), 0)
+        self._sample[self.nb_seen:self.nb_seen+nb_free] = chunk[:nb_free]
+
+        # Then the i-th patch seen replaces a sampled one with probability budget/i.
+        rest = chunk[nb_free:]
+        if len(rest) > 0:
+            seen = self.nb_seen + nb_free + np.arange(1, len(rest) + 1)
+            slots = (self.rng.rand(len(rest)) * seen).astype(np.int64)
+            kept = slots < self.budget
+            self._sample[slots[kept]] = rest[kept]  # The last patch wins a slot drawn twice, as it would one by one.
+
+        self.nb_seen += len(chunk)
+
+
+def subsample(chunks, budget, rng=None, total=None):
+    """ Uniform sample of at most `budget` patches, in a single pass over `chunks`. """
+    sampler = ReservoirSampler(budget, rng)
+    progress = Progress("Sampling training patches", total)
+    for chunk in chunks:
+        sampler.update(chunk)
+        progress.update(len(chunk), sampled=len(sampler.sample))
+
+    if sampler.sample is None:
+        raise ValueError("No patches to train on.")
+
+    return sampler.sample
+
+
+def iter_chunks(patches, chunk_size=10000):
+    for start in range(0, len(patches), chunk_size):
+        yield patches[start:start+chunk_size]
+
+
+class StreamingPCA(object):
+    """ Principal components of patches given chunk by chunk.
+
+    The mean and scatter matrix of every chunk are merged into the running
+    ones (Chan et al.), in float64. Only a (dimension, dimension) matrix is
+    kept, whatever the number of patches.
+    """
+    def __init__(self):
+        self.nb_patches = 0
+        self.mean = None
+        self.scatter = None
+
+    def partial_fit(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64).reshape((len(chunk), -1))
+        if len(chunk) == 0:
+            return
+
+        if self.mean is None:
+            self.mean = np.zeros(chunk.shape[1])
+            self.scatter = np.zeros((chunk.shape[1], chunk.shape[1]))
+
+        chunk_mean = chunk.mean(axis=0)
+        centered = chunk - chunk_mean
+        delta = chunk_mean - self.mean
+        nb_patches = self.nb_patches + len(chunk)
+
+        self.scatter += np.dot(centered.T, centered)
+        self.scatter += np.outer(delta, delta) * (self.nb_patches * len(chunk) / nb_patches)
+        self.mean += delta * (len(chunk) / nb_patches)
+        self.nb_patches = nb_patches
+
+    def covariance(self):
+        return self.scatter / max(self.nb_patches - 1, 1)
+
+    def components(self, nb_components):
+        """ Principal axes (rows) and their variance, by decreasing variance. """
+        variances, axes = np.linalg.eigh(self.covariance())
+        order = np.argsort(variances)[::-1][:nb_components]
+        return axes[:, order].T, variances[order]
+
+
+class PCAHash(object):
+    """ Hash codes given by the signs of the principal components of patches.
+
+    Parameters
+    ----------
+    name : str
+    mean : 1D array (dimension,)
+        Mean of the training patches.
+    components : 2D array (nbits, dimension)
+        Principal axes, one per bit.
+    """
+    def __init__(self, name, mean, components):
+        self.name = name
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+
+    @property
+    def nbits(self):
+        return len(self.components)
+
+    @property
+    def dimension(self):
+        return len(self.mean)
+
+    def project(self, vectors):
+        vectors = np.asarray(vectors).reshape((len(vectors), -1))
+        return np.dot(vectors - self.mean, self.components.T)
+
+    def hash_vector(self, vectors, querying=False):
+        bits = self.project(vectors) > 0
+        chars = np.where(bits, ord('1'), ord('0')).astype(np.uint8)
+        return chars.view("S{}".format(self.nbits)).ravel().tolist()
+
+
+class PCAModel(object):
+    """ Principal components of training patches, PCA hashes of any length are made out of it.
+
+    Parameters
+    ----------
+    mean : 1D array (dimension,)
+    axes : 2D array (nb_components, dimension)
+        Principal axes by decreasing variance.
+    variances : 1D array (nb_components,)
+    nb_patches : int
+        Number of patches the model was trained on.
+    """
+    def __init__(self, mean, axes, variances, nb_patches):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.axes = np.asarray(axes, dtype=np.float32)
+        self.variances = np.asarray(variances)
+        self.nb_patches = nb_patches
+
+    @property
+    def nb_components(self):
+        return len(self.axes)
+
+    def hash(self, name, nbits):
+        if nbits > self.nb_components:
+            raise ValueError("Hash model only has {} components, {} bits requested.".format(self.nb_components, nbits))
+
+        return PCAHash(name, self.mean, self.axes[:nbits])
+
+
+def train_pca(chunks, nb_components=None, budget=DEFAULT_BUDGET, rng=None, total=None):
+    """ Trains a `PCAModel` in a single pass over `chunks` of patches.
+
+    If `budget` is positive, the principal components are those of a
+    uniform sample of `budget` patches (see `subsample`), otherwise of
+    every patch. Every component is kept unless `nb_components` is given.
+    """
+    if budget > 0:
+        chunks = iter_chunks(subsample(chunks, budget, rng, total))
+        total = None
+
+    pca = StreamingPCA()
+    progress = Progress("Computing principal components", total)
+    for chunk in chunks:
+        pca.partial_fit(chunk)
+        progress.update(len(chunk))
+
+    if pca.nb_patches == 0:
+        raise ValueError("No patches to train on.")
+
+    axes, variances = pca.components(nb_components or len(pca.mean))
+    return PCAModel(pca.mean, axes, variances, pca.nb_patches)
+
+
+def train_pca_hash(name, nbits, chunks, budget=DEFAULT_BUDGET, rng=None, total=None):
+    """ Trains a `PCAHash` of `nbits` bits (see `train_pca`). """
+    return train_pca(chunks, nbits, budget, rng, total).hash(name, nbits)
@@ -26,6 +26,7 @@ from brainsearch.brain_data import brain_data_factory
 
 from brainsearch.brain_processing import BrainPipelineProcessing, BrainNormalization, BrainResampling
 from brainsearch import framework
+from brainsearch import benchmark
 from brainsearch.utils import Timer
 
 import argparse
@@ -90,6 +91,28 @@ def build_subcommand_add(subparser):
     p.add_argument('config', type=str, help='contained in a JSON file')
 
 
+def build_subcommand_benchmark(subparser):
+    DESCRIPTION = "Measure build time, memory, throughput and recall@K of hashing configurations."
+
+    p = subparser.add_parser("benchmark",
+                             description=DESCRIPTION,
+                             help=DESCRIPTION,
+                             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    p.add_argument('config', type=str, help='brains to index and sample queries from, contained in a JSON file')
+    p.add_argument('shape', metavar="X,Y,...", type=str, help="patch shape")
+    p.add_argument('--hashing', metavar="TYPE", type=str, nargs="+", default=["LSH"], help='hash types to try: LSH, PCA, SH')
+    p.add_argument('--nbits', metavar="N", type=int, nargs="+", default=[16], help='code lengths to try')
+    p.add_argument('--tables', metavar="L", type=int, nargs="+", default=[1], help='numbers of hash tables to try (LSH only)')
+    p.add_argument('--probes', metavar="P", type=int, nargs="+", default=[0], help='numbers of probes to try')
+    p.add_argument('-k', metavar="K", type=int, default=10, help='number of neighbors (recall@K)')
+    p.add_argument('--queries', metavar="N", type=int, default=1000, help='number of query patches sampled')
+    p.add_argument('--spatial_weight', type=float, default=0., help='weight of the spatial position in a patch hashcode')
+    p.add_argument('--train-budget', metavar="N", type=int, default=100000, help='train PCA/SH on N patches (0: all)')
+    p.add_argument('--seed', type=int, default=1234, help='seed used to sample queries')
+    p.add_argument('--out', type=str, default="benchmark", help='results are written in OUT.json and OUT.csv')
+
+
 def build_subcommand_vizu(subparser):
     DESCRIPTION = "Run some vizu for a brain given an existing brain database."
 
@@ -132,6 +155,7 @@ def buildArgsParser():
     build_subcommand_add(subparser)
     build_subcommand_vizu(subparser)
     build_subcommand_check(subparser)
+    build_subcommand_benchmark(subparser)
     build_subcommand_clear(subparser)
 
     return p
@@ -214,6 +238,15 @@ def main(brain_manager=None):
                       min_nonempty=args.min_nonempty,
                       use_spatial_code=args.use_spatial_code)
 
+    elif args.command == "benchmark":
+        config = json.load(open(args.config))
+        brain_data = brain_data_factory(config, pipeline=pipeline)
+        configurations = list(benchmark.configurations(args.hashing, args.nbits, args.tables, args.probes))
+        framework.benchmark_hashing(brain_data, tuple(map(int, args.shape.split(","))), configurations,
+                                    K=args.k, nb_queries=args.queries, min_nonempty=args.min_nonempty,
+                                    spatial_weight=args.spatial_weight, train_budget=args.train_budget,
+                                    out=args.out, seed=args.seed)
+
     elif args.command == "check":
         names = args.names
         if len(args.names) == 0:
@@ -16,8 +16,11 @@ import brainsearch.vizu as vizu
 #from brainsearch.imagespeed import blockify
 from brainsearch.brain_database import BrainDatabaseManager
 from brainsearch.brain_data import brain_data_factory
+from brainsearch.service import QueryServer, QueryClient
 from brainsearch.utils import Timer
 from brainsearch import framework
+from brainsearch import training
+from brainsearch import maps
 
 from nearpy.distances import EuclideanDistance
 from nearpy.filters import NearestFilter
@@ -44,6 +47,30 @@ def build_subcommand_list(subparser):
     p.add_argument('-f', action='store_true', help='check integrity of brain databases')
 
 
+def build_subcommand_rebalance(subparser):
+    DESCRIPTION = "Split oversized buckets of an existing brain database."
+
+    p = subparser.add_parser("rebalance",
+                             description=DESCRIPTION,
+                             help=DESCRIPTION,
+                             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    p.add_argument('name', type=str, help='name of the brain database')
+    p.add_argument('--max-size', metavar="N", type=int, help="split buckets holding more than N patches (default: database's setting)")
+
+
+def build_subcommand_compact(subparser):
+    DESCRIPTION = ("Rewrite a brain database into a contiguous snapshot (dropping empty buckets), "
+                   "memory-mapped by read-only commands (e.g. map).")
+
+    p = subparser.add_parser("compact",
+                             description=DESCRIPTION,
+                             help=DESCRIPTION,
+                             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    p.add_argument('name', type=str, help='name of the brain database')
+
+
 def build_subcommand_clear(subparser):
     DESCRIPTION = "Clear brain databases."
 
@@ -56,6 +83,21 @@ def build_subcommand_clear(subparser):
     p.add_argument('-f', action='store_true', help='clear also metadata')
 
 
+def build_subcommand_train(subparser):
+    DESCRIPTION = "Train a PCA hash model once, shared by brain databases (see init --hash-model)."
+
+    p = subparser.add_parser("train",
+                             description=DESCRIPTION,
+                             help=DESCRIPTION)
+
+    p.add_argument('name', type=str, help='name of the hash model')
+    p.add_argument('shape', metavar="X,Y,...", type=str, help="patch shape")
+    p.add_argument('trainset', type=str, help='JSON file listing the brains to train on')
+    p.add_argument('--components', metavar="K", type=int, help='keep only the K first principal components (default: all)')
+    p.add_argument('--train-budget', metavar="N", type=int, default=training.DEFAULT_BUDGET,
+                   help='train on a uniform sample of N patches of the trainset (0: every patch)')
+
+
 def build_subcommand_init(subparser):
     DESCRIPTION = "Build a new brain database (nearpy's engine)."
 
@@ -70,8 +112,17 @@ def build_subcommand_init(subparser):
     p.add_argument('--PCA', metavar="K", type=int, help='use K eigenvectors')
     p.add_argument('--SH', metavar="K", type=int, help='length of hash codes generated by Spectral Hashing')
     p.add_argument('--trainset', type=str, help='JSON file use to "train" PCA')
+    p.add_argument('--hash-model', metavar="NAME", type=str, help='use the PCA of a trained hash model (see train) instead of a trainset')
     p.add_argument('--pca_pkl', type=str, help='pickle file containing the PCA information of the data')
     p.add_argument('--bounds_pkl', type=str, help='pickle file containing the bounds used by spectral hashing')
+    p.add_argument('--train-budget', metavar="N", type=int, default=training.DEFAULT_BUDGET,
+                   help='train PCA/SH on a uniform sample of N patches of the trainset (0: every patch)')
+    p.add_argument('--tables', metavar="L", type=int, default=1, help='number of independent hash tables (LSH only)')
+    p.add_argument('--max-bucket-size', metavar="N", type=int, default=0, help='split buckets holding more than N patches (0: never)')
+    p.add_argument('--shards', metavar="N", type=int, default=1, help='partition the brain database into N shards')
+    p.add_argument('--partition', choices=["id", "bucket"], default="id", help='partition shards by brain id or by bucket key')
+    p.add_argument('--codes', metavar="NBITS", type=int, default=0, help='store a binary code of NBITS bits along every patch (0: none)')
+    p.add_argument('--rerank', metavar="N", type=int, default=1000, help='only compute the distance of the N candidates closest in Hamming distance (requires --codes)')
 
 
 def build_subcommand_add(subparser):
@@ -84,6 +135,19 @@ def build_subcommand_add(subparser):
 
     p.add_argument('name', type=str, help='name of the brain database')
     p.add_argument('config', type=str, help='contained in a JSON file')
+    p.add_argument('--replace', action='store_true', help='replace the patches of brains already in the database')
+
+
+def build_subcommand_remove(subparser):
+    DESCRIPTION = "Remove some brains from an existing brain database."
+
+    p = subparser.add_parser("remove",
+                             description=DESCRIPTION,
+                             help=DESCRIPTION,
+                             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    p.add_argument('name', type=str, help='name of the brain database')
+    p.add_argument('ids', metavar="id", type=int, nargs='+', help='id of the brains to remove')
 
 
 def build_subcommand_eval(subparser):
@@ -115,6 +179,12 @@ def build_subcommand_map(subparser):
     p.add_argument('--prefix', type=str, help="prefix for the name of the results files", default="")
     p.add_argument('--radius', type=int, help="only look at neighbors within a certain radius")
     p.add_argument('--use-dist', action='store_true', help="when computing proportion weigh by the exp(-distance)")
+    p.add_argument('--probes', metavar="T", type=int, default=0, help="also probe the T nearest hash codes until K candidates are found")
+    p.add_argument('--mode', choices=["knn", "bucket-vote"], default="knn",
+                   help="knn: vote of the K nearest neighbors; bucket-vote: fast screening from per-bucket label counts")
+    p.add_argument('--server', metavar="ADDRESS", type=str, help="send queries to a running 'serve' command (socket path or host:port)")
+    p.add_argument('--jobs', metavar="N", type=int, default=1,
+                   help="map brains in N worker processes, each opening the database read-only (compact it first to share its snapshot)")
 
 
 def build_subcommand_proximity_map(subparser):
@@ -132,6 +202,9 @@ def build_subcommand_proximity_map(subparser):
     p.add_argument('-k', type=int, help='consider at most K nearest-neighbors.', default=100)
     p.add_argument('-t', '--threshold', type=float, help='keep neighbors with distance < threshold.', default=np.inf)
     p.add_argument('--prefix', type=str, help="prefix for the name of the results files", default="")
+    p.add_argument('--weighting', choices=maps.WEIGHTINGS, default="1-dist",
+                   help="contribution of a neighbor: count: 1; 1-dist: 1-distance; exp: exp(-alpha*distance)")
+    p.add_argument('--alpha', type=float, default=20000., help="decay of the 'exp' weighting")
 
 
 def build_subcommand_vizu(subparser):
@@ -146,6 +219,20 @@ def build_subcommand_vizu(subparser):
     p.add_argument('config', type=str, help='contained in a JSON file')
 
 
+def build_subcommand_serve(subparser):
+    DESCRIPTION = "Keep brain databases open and answer neighbor queries sent over a socket."
+
+    p = subparser.add_parser("serve",
+                             description=DESCRIPTION,
+                             help=DESCRIPTION,
+                             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    p.add_argument('names', metavar="name", type=str, nargs='+', help='name of the brain databases to serve')
+    p.add_argument('--socket', metavar="ADDRESS", type=str, default="./brain_search.sock", help='Unix socket path or host:port to listen on')
+    p.add_argument('--max-delay', metavar="SEC", type=float, default=0.005, help='time to wait for concurrent queries to join a batch')
+    p.add_argument('--max-batch', metavar="N", type=int, default=100000, help='maximum number of query patches per batch')
+
+
 def build_subcommand_check(subparser):
     DESCRIPTION = "Check candidates distribution given an existing brain database."
 
@@ -155,6 +242,7 @@ def build_subcommand_check(subparser):
                              formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     p.add_argument('names', type=str, nargs='*', help='name of the brain database')
+    p.add_argument('--full', action='store_true', help='scan every bucket instead of using maintained statistics')
     #p.add_argument('config', type=str, nargs='?', help='contained in a JSON file')
     #p.add_argument('-m', dest="min_nonempty", type=int, help='consider only patches having this minimum number of non-empty voxels')
 
@@ -163,8 +251,11 @@ def buildArgsParser():
     DESCRIPTION = "Script to perform brain searches."
     p = argparse.ArgumentParser(description=DESCRIPTION)
 
-    p.add_argument('--storage', type=str, default="redis", help='which storage to use: redis, memory, file')
+    p.add_argument('--storage', type=str, default="redis", help='which storage to use: redis, redis-pipelined, memory, file')
+    p.add_argument('--redis-batch', metavar="N", type=int, default=1000, help='buckets per round trip (redis-pipelined only)')
     p.add_argument('--dir', type=str, default="./", help='folder where to store brain databases (where applicable)')
+    p.add_argument('--shard-processes', metavar="N", type=int, default=1,
+                   help='query the shards of a sharded brain database in N worker processes (redis, file or compacted storages)')
 
     p.add_argument('--spatial_weight', type=float, help='weight of the spatial position in a patch hashcode', default=0.)
     p.add_argument('-m', dest="min_nonempty", type=float, help='consider only patches having this minimum percent of non-empty voxels')
@@ -174,13 +265,18 @@ def buildArgsParser():
 
     subparser = p.add_subparsers(title="brain_search commands", metavar="", dest="command")
     build_subcommand_list(subparser)
+    build_subcommand_train(subparser)
     build_subcommand_init(subparser)
     build_subcommand_add(subparser)
+    build_subcommand_remove(subparser)
     build_subcommand_eval(subparser)
     build_subcommand_map(subparser)
     build_subcommand_proximity_map(subparser)
     build_subcommand_vizu(subparser)
     build_subcommand_check(subparser)
+    build_subcommand_serve(subparser)
+    build_subcommand_rebalance(subparser)
+    build_subcommand_compact(subparser)
     build_subcommand_clear(subparser)
 
     return p
@@ -219,6 +315,24 @@ def hack_map(positives, negatives, ratio_pos):
     return (m+1)/2.
 
 
+def iter_trainset(args, pipeline, patch_shape, trainset):
+    """ Vectors of the patches of every brain of `trainset`, brain by brain. """
+    config = json.load(open(trainset))
+    brain_data = brain_data_factory(config, pipeline=pipeline)
+    for brain in brain_data:
+        brain_patches = brain.extract_patches(patch_shape, min_nonempty=args.min_nonempty)
+        yield brain_patches.create_vectors(spatial_weight=args.spatial_weight)
+
+
+def training_inputs(args, patch_shape):
+    """ How patches are extracted, hash models are only shared by brain databases extracting them the same way. """
+    return {'patch_shape': list(patch_shape),
+            'spatial_weight': args.spatial_weight,
+            'min_nonempty': args.min_nonempty,
+            'normalization': args.do_normalization,
+            'resampling_factor': args.resampling_factor}
+
+
 def save_nifti(image, affine, name):
     nifti = nib.Nifti1Image(image, affine)
     nib.save(nifti, name)
@@ -228,10 +342,19 @@ def main(brain_manager=None):
     parser = buildArgsParser()
     args = parser.parse_args()
 
-    readonly = args.command not in ["init", "add", "clear"]
+    readonly = args.command not in ["train", "init", "add", "remove", "clear", "rebalance", "compact"]
+    if args.command == "list" and args.f:
+        readonly = False  # Checking integrity fixes counters.
 
     if brain_manager is None:
-        brain_manager = BrainDatabaseManager(args.storage, dir=args.dir, readonly=readonly)
+        if getattr(args, "server", None) is not None:
+            brain_manager = QueryClient(args.server)
+        else:
+            storage_params = {'dir': args.dir, 'readonly': readonly}
+            if args.storage == "redis-pipelined":
+                storage_params['batch_size'] = args.redis_batch
+
+            brain_manager = BrainDatabaseManager(args.storage, shard_processes=args.shard_processes, **storage_params)
 
     # Build processing pipeline
     pipeline = BrainPipelineProcessing()
@@ -240,12 +363,33 @@ def main(brain_manager=None):
     if args.resampling_factor > 1:
         pipeline.add(BrainResampling(args.resampling_factor))
 
+    try:
+        run_command(args, brain_manager, pipeline)
+    finally:
+        brain_manager.close()  # e.g. worker processes querying shards.
+
+    return brain_manager
+
+
+def run_command(args, brain_manager, pipeline):
     if args.command == "list":
         framework.list(brain_manager, args.name, verbose=args.v, check_integrity=args.f)
     elif args.command == "clear":
         with Timer("Clearing"):
             framework.clear(brain_manager, args.names, force=args.f)
 
+    elif args.command == "train":
+        print "Training hash model {}...".format(args.name)
+        start = time.time()
+        patch_shape = tuple(map(int, args.shape.split(",")))
+        inputs = training_inputs(args, patch_shape)
+        inputs['trainset'] = training.file_digest(args.trainset)
+        inputs['train_budget'] = args.train_budget
+        framework.train(brain_manager, args.name, iter_trainset(args, pipeline, patch_shape, args.trainset), inputs,
+                        nb_components=args.components, train_budget=args.train_budget)
+
+        print "Trained in {0:.2f} sec.".format(time.time()-start)
+
     elif args.command == "init":
         print "Creating brain database {}...".format(args.name)
         if args.name in brain_manager:
@@ -257,19 +401,13 @@ def main(brain_manager=None):
         patch_shape = tuple(map(int, args.shape.split(",")))
 
         def _get_all_patches():
-            config = json.load(open(args.trainset))
-            brain_data = brain_data_factory(config, pipeline=pipeline)
-            for brain_id, brain in enumerate(brain_data):
-                print "ID: {0}/{1}".format(brain_id, len(brain_data))
-                brain_patches = brain.extract_patches(patch_shape, min_nonempty=args.min_nonempty)
-                vectors = brain_patches.create_vectors(spatial_weight=args.spatial_weight)
-                yield vectors
+            return iter_trainset(args, pipeline, patch_shape, args.trainset)
 
         dimension = np.prod(patch_shape)
         if args.spatial_weight:
             dimension += len(patch_shape)
 
-        hash_params = {}
+        hash_params = {'train_budget': args.train_budget}
         if args.SH is not None:
             hashtype, nbits = "SH", args.SH
             hash_params['trainset'] = _get_all_patches
@@ -285,8 +423,21 @@ def main(brain_manager=None):
             print "Must provide one of the following options: --SH, --LSH or --PCA"
             exit(-1)
 
-        hashing = framework.hashing_factory(hashtype, dimension, nbits, **hash_params)
-        framework.init(brain_manager, args.name, patch_shape, hashing)
+        if args.hash_model is not None:
+            if hashtype != "PCA":
+                print "Hash models can only be used with --PCA."
+                exit(-1)
+
+            if args.tables > 1:
+                print "Hash models provide a single hash table, --tables cannot be used with --hash-model."
+                exit(-1)
+
+            hashing = framework.hash_model_hashing(brain_manager, args.hash_model, nbits, training_inputs(args, patch_shape))
+        else:
+            hashing = framework.hash_tables_factory(hashtype, dimension, nbits, nb_tables=args.tables, **hash_params)
+
+        framework.init(brain_manager, args.name, patch_shape, hashing, max_bucket_size=args.max_bucket_size,
+                       nb_shards=args.shards, partition=args.partition, code_nbits=args.codes, rerank=args.rerank)
 
         print "Created in {0:.2f} sec.".format(time.time()-start)
 
@@ -295,7 +446,11 @@ def main(brain_manager=None):
         brain_data = brain_data_factory(config, pipeline=pipeline)
         framework.add(brain_manager, args.name, brain_data,
                       min_nonempty=args.min_nonempty,
-                      spatial_weight=args.spatial_weight)
+                      spatial_weight=args.spatial_weight,
+                      replace=args.replace)
+
+    elif args.command == "remove":
+        framework.remove_brains(brain_manager, args.name, args.ids)
 
     elif args.command == "check":
         names = args.names
@@ -306,10 +461,32 @@ def main(brain_manager=None):
             try:
                 print "\n" + name
                 framework.check(brain_manager, name,
-                                spatial_weight=args.spatial_weight)
+                                spatial_weight=args.spatial_weight,
+                                full=args.full)
             except Exception as e:
                 print e.message
 
+    elif args.command == "serve":
+        databases = {}
+        for name in args.names:
+            if name not in brain_manager:
+                raise ValueError("Unexisting brain database: " + name)
+
+            databases[name] = brain_manager[name]
+
+        server = QueryServer(databases, args.socket, max_delay=args.max_delay, max_batch_size=args.max_batch)
+        print "Serving {} on {}...".format(", ".join(args.names), args.socket)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    elif args.command == "compact":
+        framework.compact(brain_manager, args.name)
+
+    elif args.command == "rebalance":
+        framework.rebalance(brain_manager, args.name, max_size=args.max_size)
+
     elif args.command == "eval":
         brain_database = brain_manager[args.name]
         if brain_database is None:
@@ -363,14 +540,20 @@ def main(brain_manager=None):
         framework.create_map(brain_manager, args.name, brain_data, K=args.k, threshold=args.threshold,
                              min_nonempty=args.min_nonempty,
                              spatial_weight=args.spatial_weight,
-                             use_dist=args.use_dist)
+                             use_dist=args.use_dist,
+                             probes=args.probes,
+                             radius=args.radius,
+                             mode=args.mode,
+                             jobs=args.jobs)
 
     elif args.command == "proximity-map":
         config = json.load(open(args.config))
         brain_data = brain_data_factory(config, pipeline=pipeline, id=args.id)
         framework.create_proximity_map(brain_manager, args.name, brain_data, K=args.k, threshold=args.threshold,
                                        min_nonempty=args.min_nonempty,
-                                       spatial_weight=args.spatial_weight)
+                                       spatial_weight=args.spatial_weight,
+                                       weighting=args.weighting,
+                                       alpha=args.alpha)
 
     elif args.command == "vizu":
         from brainsearch.vizu_chaco import NoisyBrainsearchViewer
@@ -393,8 +576,6 @@ def main(brain_manager=None):
             viewer = NoisyBrainsearchViewer(query, brain_db.engine, brain_voxels=brain.image)
             viewer.configure_traits()
 
-    return brain_manager
-
 
 if __name__ == '__main__':
     main()
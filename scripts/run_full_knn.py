@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 from __future__ import division
 
+import os
 import json
 import argparse
 import numpy as np
 import nibabel as nib
 from time import time
+from multiprocessing import Pool
 
 from brainsearch.imagespeed import blockify
 from brainsearch.brain_data import brain_data_factory
+from brainsearch.knn import ExactKNN, merge_top_k
 
 #import theano
 #import theano.tensor as T
@@ -63,33 +66,103 @@ def find_kNN_theano(query_patches, best, k, brain, patch_shape, min_nonempty):
         """
 
 
-def find_kNN(query_patches, best, k, brain, patch_shape, min_nonempty, filename):
-    patches, datainfo = brain.extract_patches(patch_shape, min_nonempty=min_nonempty, with_info=True)
+def find_kNN(knn, brain, patch_shape, min_nonempty):
+    brain_patches = brain.extract_patches(patch_shape, min_nonempty=min_nonempty)
+    knn.update(brain_patches.patches,
+               labels=brain_patches.labels,
+               ids=brain_patches.brain_ids,
+               positions=brain_patches.positions.astype("int32"))
 
-    for i, query_patch in enumerate(query_patches):
-        if i % 1000 == 0:
-            print "{}/{}".format(i, len(query_patches))
-            np.savez(filename + '.part', part=np.array(i), dist=best[0], labels=best[1], ids=best[2], positions=best[3])
 
-        distances = np.sum((patches - query_patch)**2, axis=(1, 2, 3))
-        top_k = np.argsort(distances)[:k]
+def partial_filename(out, batch_id, brain_id):
+    return pjoin(out, "{batch_id}_{brain_id}.npz".format(batch_id=batch_id, brain_id=brain_id))
 
-        distances = distances[top_k]
-        labels = datainfo["label"][top_k]
-        ids = datainfo["id"][top_k]
-        positions = datainfo["position"][top_k]
 
-        # Keep best
-        best_distances = np.r_[best[0][i], distances]
-        best_labels = np.r_[best[1][i], labels]
-        best_ids = np.r_[best[2][i], ids]
-        best_positions = np.r_[best[3][i], positions]
+def knn_task(args, patches, batch_id, brain_id, checkpoint=10000):
+    """ Finds the kNN of the batch of query `patches` among the patches of one brain.
 
-        best_top_k = np.argsort(best_distances)[:k]
-        best[0][i] = best_distances[best_top_k]
-        best[1][i] = best_labels[best_top_k]
-        best[2][i] = best_ids[best_top_k]
-        best[3][i] = best_positions[best_top_k]
+    Results are saved in '{batch_id}_{brain_id}.npz'. Every `checkpoint`
+    query patches, what has been done so far is saved in a '.part' file from
+    which the task resumes if it is interrupted.
+    """
+    filename = partial_filename(args.out, batch_id, brain_id)
+    if os.path.isfile(filename):
+        return filename  # Already done.
+
+    best = {'dist': np.inf * np.ones((len(patches), args.k), dtype="float32"),
+            'labels': -1 * np.ones((len(patches), args.k), dtype="int8"),
+            'ids': -1 * np.ones((len(patches), args.k), dtype="int32"),
+            'positions': -1 * np.ones((len(patches), args.k, 3), dtype="int32")}
+
+    part = 0
+    if os.path.isfile(filename + '.part.npz'):
+        partial = np.load(filename + '.part.npz')
+        part = int(partial['part'])
+        for name in best:
+            best[name] = partial[name]
+
+    config = json.load(open(args.dataset))
+    brain = next(iter(brain_data_factory(config, id=brain_id)))
+    brain_patches = brain.extract_patches(args.shape, min_nonempty=args.min_nonempty)
+
+    for start in range(part, len(patches), checkpoint):
+        knn = ExactKNN(patches[start:start+checkpoint], args.k, nb_threads=args.threads)
+        knn.update(brain_patches.patches,
+                   labels=brain_patches.labels,
+                   ids=brain_patches.brain_ids,
+                   positions=brain_patches.positions.astype("int32"))
+
+        best['dist'][start:start+checkpoint] = knn.sqdists
+        for name, values in knn.attributes.items():
+            best[name][start:start+checkpoint] = values
+
+        np.savez(filename + '.part', part=np.array(start+checkpoint), **best)
+
+    np.savez(filename, **best)
+    if os.path.isfile(filename + '.part.npz'):
+        os.remove(filename + '.part.npz')
+
+    return filename
+
+
+def _run_knn_task(task):
+    return knn_task(*task)
+
+
+def run_local(args, patches, nb_batches, nb_brains):
+    """ Runs every (batch, brain) task on a local pool of processes. """
+    tasks = [(args, patches[batch_id*args.batch_size:(batch_id+1)*args.batch_size], batch_id, brain_id)
+             for batch_id in range(nb_batches) for brain_id in range(nb_brains)]
+    todo = [task for task in tasks if not os.path.isfile(partial_filename(args.out, task[2], task[3]))]
+    print "{:,} tasks to run ({:,} already done)".format(len(todo), len(tasks)-len(todo))
+
+    start = time()
+    pool = Pool(args.jobs)
+    for i, filename in enumerate(pool.imap_unordered(_run_knn_task, todo), start=1):
+        print "{}/{} {} ({:.2f} sec.)".format(i, len(todo), filename, time()-start)
+
+    pool.close()
+    pool.join()
+
+
+def merge(out, nb_batches, nb_brains, k):
+    """ Merges the partial results of every (batch, brain) task into one top-K. """
+    missing = [partial_filename(out, batch_id, brain_id)
+               for batch_id in range(nb_batches) for brain_id in range(nb_brains)
+               if not os.path.isfile(partial_filename(out, batch_id, brain_id))]
+    if len(missing) > 0:
+        raise IOError("Missing {} partial results: {}".format(len(missing), ", ".join(missing[:10])))
+
+    results = []
+    for batch_id in range(nb_batches):
+        partials = [np.load(partial_filename(out, batch_id, brain_id)) for brain_id in range(nb_brains)]
+        dists, merged = merge_top_k(k, [partial['dist'] for partial in partials],
+                                    **dict((name, [partial[name] for partial in partials])
+                                           for name in ['labels', 'ids', 'positions']))
+        merged['dist'] = dists
+        results.append(merged)
+
+    return dict((name, np.concatenate([result[name] for result in results])) for name in results[0])
 
 
 def buildArgsParser():
@@ -103,10 +176,15 @@ def buildArgsParser():
 
     p.add_argument('--brain_id', type=int, help='ID of the brain in the dataset.')
     p.add_argument('--batch_id', type=int, help='ID of the batch of query patches to be processed.')
-    p.add_argument('--batch_size', type=int, help='Number of query patches in a batch.', default=1)
+    p.add_argument('--batch_size', type=int,
+                   help='Number of query patches in a batch (default: 1, or split evenly across --jobs). '
+                        'Keep it the same to resume or merge partial results.')
     p.add_argument('--out', type=str, help='Directory where to save intermediate results.', default='./')
+    p.add_argument('--threads', type=int, help='Number of threads computing distances.', default=1)
 
     p.add_argument('-x', action="store_true", help='Print smart_dispatch command to launch and quit.')
+    p.add_argument('--jobs', type=int, help='Run every batch x brain task using a local pool of N processes, then merge.')
+    p.add_argument('--merge', action="store_true", help='Only merge partial results found in --out.')
 
     return p
 
@@ -121,14 +199,32 @@ def main():
 
     brain_data = brain_data_factory(json.load(open(args.dataset)))
 
+    if args.batch_size is None:
+        if args.merge and args.jobs is None:
+            parser.error("--merge needs the --batch_size (or --jobs) partial results were computed with.")
+
+        # Local runs: one batch per process, every task loads its brain once for many query patches.
+        args.batch_size = max(int(np.ceil(len(patches) / args.jobs)), 1) if args.jobs is not None else 1
+
+    nb_batches = int(np.ceil(len(patches) / args.batch_size))
+
     if args.x:
-        nb_batches = int(np.ceil(len(patches) / args.batch_size))
         print ("\nsmart_dispatch.py -q qwork@mp2 --pool {} launch "
                "run_full_knn.py {} {} --brain_id [0:{}] --batch_id [0:{}] --batch_size {}"
                ).format(nb_batches*len(brain_data), args.query, args.dataset,
                         len(brain_data), nb_batches, args.batch_size)
         return
 
+    if args.jobs is not None or args.merge:
+        if not args.merge:
+            run_local(args, patches, nb_batches, len(brain_data))
+
+        start = time()
+        results = merge(args.out, nb_batches, len(brain_data), args.k)
+        np.savez(pjoin(args.out, "knn.npz"), **results)
+        print "Merged into {} in {:.2f} sec.".format(pjoin(args.out, "knn.npz"), time()-start)
+        return
+
     if args.batch_id is not None:
         start = args.batch_id * args.batch_size
         end = (args.batch_id+1) * args.batch_size
@@ -136,25 +232,24 @@ def main():
         print "Will process patches #{}-{}".format(start, end-1)
         patches = patches[start:end]
 
-    best_distances = np.empty((len(patches), args.k), dtype="float32")
-    best_labels = np.empty((len(patches), args.k), dtype="int8")
-    best_ids = np.empty((len(patches), args.k), dtype="int32")
-    best_positions = np.empty((len(patches), args.k, 3), dtype="int32")
-    best = best_distances, best_labels, best_ids, best_positions
+    if args.brain_id is not None and args.batch_id is not None:
+        knn_task(args, patches, args.batch_id, args.brain_id)
+        return
 
-    name = "{batch_id}_{brain_id}.npz".format(batch_id=args.batch_id, brain_id=args.brain_id)
-    filename = pjoin(args.out, name)
+    filename = partial_filename(args.out, args.batch_id, args.brain_id)
 
+    knn = ExactKNN(patches, args.k, nb_threads=args.threads)
     for i, brain in enumerate(brain_data):
         if args.brain_id is not None and args.brain_id != i:
             continue
 
         print "Processing brain #{} ...".format(i)
         start = time()
-        find_kNN(patches, best, args.k, brain, args.shape, args.min_nonempty, filename)
+        find_kNN(knn, brain, args.shape, args.min_nonempty)
         print "Brain #{}, done in {:.2f} sec".format(i, time()-start)
 
-    np.savez(filename, dist=best_distances, labels=best_labels, ids=best_ids, positions=best_positions)
+    np.savez(filename, dist=knn.sqdists, labels=knn.attributes['labels'], ids=knn.attributes['ids'],
+             positions=knn.attributes['positions'])
 
 if __name__ == '__main__':
     main()